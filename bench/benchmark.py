@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+"""
+Benchmarks the bot against synthetic networks of various sizes served by stubnet.
+
+For each network size this times fetching the supernode lists (get_json_data), filling the block
+header cache from scratch (update_headers), a full poll cycle (rta_poll: fetch, parse, reconcile,
+notify; both the first cycle, where every SN is new, and steady-state cycles with churn and a warm
+header cache), get_dist, /sn lookups and sn_info, and records the peak memory
+allocated during a first poll cycle.  Results are written as JSON so that runs of different
+versions can be compared:
+
+    bench/benchmark.py --sizes 1000,10000 --output before.json
+    ... change things ...
+    bench/benchmark.py --sizes 1000,10000 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import botloader
+import fakes
+import stubnet
+from timing import timings
+
+
+def summarize(name, size, times, **extra):
+    r = {
+        'benchmark': name,
+        'sns': size,
+        'runs': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+    r.update(extra)
+    return r
+
+
+def reset_state(bot, net):
+    net.globalsns = {}
+    net.lastresults = None
+    net.lastheight = None
+    net.last_alert_height = None
+    bot.notifications = {}
+    net.expiry_alerts.clear()
+    net.archived.clear()
+    net.observations.clear()
+    net.ranks.clear()
+    net.rank_state.clear()
+
+
+def reset_headers(bot, net):
+    net.headers['file'].truncate(0)
+    net.headers['count'] = 0
+    net.headers['window'].clear()
+    net.stimulus = None
+
+
+def poll(bot, net, errors):
+    """Runs a poll cycle, including delivering its events to the subscribers; like rta_updater, a
+    failed cycle (e.g. from injected failures) is counted rather than aborting the benchmark"""
+    try:
+        if not bot.rta_poll(net):
+            errors.append(None)
+        bot.flush_events()
+    except Exception as e:
+        errors.append(e)
+
+
+def bench_size(bot, net, size, args):
+    stub = stubnet.StubNetwork(size, churn=args.churn, testnet=net.testnet)
+    hosts = stubnet.start_hosts(stub, args.hosts, latency=args.latency, failure=args.failure)
+    net.supernodes = [('stub{}'.format(i), h.url) for i, h in enumerate(hosts)]
+    net.nodes = list(net.supernodes)
+    results = []
+    try:
+        urls = [sn[1] + '/debug/supernode_list/1' for sn in net.supernodes]
+        results.append(summarize('get_json_data', size, timings(
+            lambda: bot.run_io(bot.get_json_data(urls)), args.repeat), hosts=args.hosts))
+
+        # Filling the header cache from scratch (spread over several polls by the bot, done all at
+        # once here); the polls below then only fetch new blocks
+        def headers_cold():
+            reset_headers(bot, net)
+            while net.stimulus is None:
+                bot.update_headers(net, stub.height)
+        results.append(summarize('update_headers_cold', size, timings(headers_cold, args.repeat),
+            blocks=bot.STIMULUS_WINDOW))
+
+        # The first poll sees every SN as new
+        cold, errors = [], []
+        for _ in range(args.repeat):
+            reset_state(bot, net)
+            start = time.perf_counter()
+            poll(bot, net, errors)
+            cold.append(time.perf_counter() - start)
+        results.append(summarize('rta_poll_first', size, cold, hosts=args.hosts, failed=len(errors)))
+
+        errors = []
+        def steady():
+            stub.tick()
+            poll(bot, net, errors)
+        results.append(summarize('rta_poll', size, timings(steady, args.repeat),
+            hosts=args.hosts, churn=args.churn, failed=len(errors)))
+        if not net.globalsns:
+            poll(bot, net, errors)
+
+        if not net.lastresults:
+            print("  every poll failed; skipping the remaining benchmarks", file=sys.stderr)
+            return results
+
+        results.append(summarize('get_dist', size, timings(lambda: bot.get_dist(net), args.repeat)))
+        pubkeys = list(net.globalsns.keys())
+        rng = random.Random(size)
+        lookups = [rng.choice(pubkeys) for _ in range(args.lookups)]
+        bot_ = fakes.FakeBot()
+
+        def show_sn():
+            for p in lookups:
+                bot.show_sn(bot_, fakes.FakeUpdate(bot_, '/sn ' + p[:8]), user_data={}, args=[p[:8]])
+        results.append(summarize('show_sn', size, [t / len(lookups) for t in timings(show_sn, args.repeat)],
+            per='lookup'))
+
+        def sn_info():
+            for p in lookups:
+                bot.sn_info(net, p)
+        results.append(summarize('sn_info', size, [t / len(lookups) for t in timings(sn_info, args.repeat)],
+            per='lookup'))
+
+        # Peak memory of a first poll cycle (measured separately: tracemalloc skews the timings)
+        reset_state(bot, net)
+        tracemalloc.start()
+        poll(bot, net, [])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({ 'benchmark': 'memory', 'sns': size, 'peak_bytes': peak, 'retained_bytes': current })
+    finally:
+        for h in hosts:
+            h.stop()
+    return results
+
+
+def bot_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(botloader.BOT_PATH), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = { (r['benchmark'], r['sns']): r for r in json.load(f)['results'] }
+    print("\n{:<16} {:>8} {:>12} {:>12} {:>8}".format('benchmark', 'sns', 'baseline', 'now', 'ratio'))
+    for r in results:
+        b = baseline.get((r['benchmark'], r['sns']))
+        if not b:
+            continue
+        key = 'peak_bytes' if r['benchmark'] == 'memory' else 'median'
+        print("{:<16} {:>8} {:>12.6g} {:>12.6g} {:>7.2f}x".format(
+            r['benchmark'], r['sns'], b[key], r[key], r[key] / b[key] if b[key] else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bot against a synthetic network')
+    parser.add_argument('--sizes', default='1000,10000', help='comma-separated network sizes (number of SNs)')
+    parser.add_argument('--hosts', type=int, default=7, help='number of stub supernodes to poll')
+    parser.add_argument('--latency', type=float, default=0.0, help='average stub response latency, in seconds')
+    parser.add_argument('--failure', type=float, default=0.0, help='fraction of stub requests that fail')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of SNs changing state per poll')
+    parser.add_argument('--sample', type=int, help='poll this many of the hosts each cycle (POLL_SAMPLE_SIZE)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark')
+    parser.add_argument('--lookups', type=int, default=50, help='/sn lookups per show_sn/sn_info run')
+    parser.add_argument('--output', default='bench-results.json', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    bot = botloader.load_bot(HISTORY_DIR=None, ARCHIVE_AFTER=None, SEND_TO=1, SUMMARY_FREQUENCY=float('inf'),
+            EXTRA_NETWORKS=[], OUTBOUND_RATE=None, POLL_SAMPLE_SIZE=args.sample)
+    bot.updater = fakes.FakeUpdater()
+    net = bot.create_networks()
+    cache_dir = tempfile.mkdtemp()
+    net.header_cache_filename = os.path.join(cache_dir, 'headers.data')
+    bot.headers_open(net)
+    bot.start_subscribers()
+
+    results = []
+    for size in (int(x) for x in args.sizes.split(',')):
+        print("Benchmarking with {} SNs...".format(size), file=sys.stderr)
+        for r in bench_size(bot, net, size, args):
+            results.append(r)
+            if 'median' in r:
+                print("  {:<16} median {:.6f}s  (min {:.6f}s)".format(r['benchmark'], r['median'], r['min']), file=sys.stderr)
+            else:
+                print("  {:<16} peak {:.1f} MiB".format(r['benchmark'], r['peak_bytes'] / 2**20), file=sys.stderr)
+    bot.stop_io()
+    net.headers['file'].close()
+    shutil.rmtree(cache_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'version': bot_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': int(time.time()),
+            'params': vars(args),
+            'results': results,
+        }, f, indent=2)
+    print("Wrote {}".format(args.output), file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
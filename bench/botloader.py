@@ -0,0 +1,27 @@
+"""
+Loads graft-alpha-bot.py as a module for the benchmark and test tools in this directory.
+
+The bot's config uses bare FIXME placeholders for values that must be filled in before running it for
+real; those are given a value of None here so that an unconfigured checkout can still be loaded.
+"""
+
+import importlib.util
+import os
+import sys
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'graft-alpha-bot.py')
+
+
+def load_bot(path=BOT_PATH, **config):
+    """Loads the bot module (without running main()) and overrides any of its config values given as
+    keyword arguments, e.g. load_bot(HISTORY_DIR=None, TESTNET=True)"""
+    spec = importlib.util.spec_from_file_location('graftbot', path)
+    bot = importlib.util.module_from_spec(spec)
+    bot.__dict__['FIXME'] = None
+    sys.modules['graftbot'] = bot
+    spec.loader.exec_module(bot)
+    for k, v in config.items():
+        if not hasattr(bot, k):
+            raise AttributeError("The bot has no config setting named {}".format(k))
+        setattr(bot, k, v)
+    return bot
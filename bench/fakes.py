@@ -0,0 +1,85 @@
+"""
+Minimal stand-ins for the telegram Bot/Update/Message objects used by the bot's handlers.  All outgoing
+messages are captured in memory instead of being sent.
+"""
+
+import datetime
+import itertools
+import threading
+import time
+
+import telegram
+
+message_ids = itertools.count(1)
+
+
+class FakeBot:
+    id = 1
+    username = 'fakebot'
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def capture(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent.append((time.time(), chat_id, text))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.capture(chat_id, text, **kwargs)
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        pass
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        self.capture(chat_id, '<sticker {}>'.format(sticker))
+
+
+class FakeUpdater:
+    def __init__(self, bot=None):
+        self.bot = bot or FakeBot()
+
+
+class FakeChat:
+    def __init__(self, chat_id, chat_type):
+        self.id = chat_id
+        self.type = chat_type
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeMessage:
+    def __init__(self, bot, text, chat_id, chat_type='private', reply_to_message=None):
+        self.bot = bot
+        self.text = text
+        self.chat_id = chat_id
+        self.chat = FakeChat(chat_id, chat_type)
+        self.message_id = next(message_ids)
+        self.reply_to_message = reply_to_message
+
+    def reply_text(self, text, **kwargs):
+        self.bot.capture(self.chat_id, text, **kwargs)
+
+    def reply_sticker(self, sticker, **kwargs):
+        self.bot.send_sticker(self.chat_id, sticker)
+
+
+class FakeUpdate:
+    def __init__(self, bot, text, user_id=1, chat_id=None, chat_type='private'):
+        self.message = FakeMessage(bot, text, chat_id if chat_id is not None else user_id, chat_type)
+        self.effective_user = FakeUser(user_id)
+        self.callback_query = None
+
+
+def command_update(bot, text, user_id=1, chat_id=None, chat_type='private'):
+    """Builds a real telegram Update for the command message `text` (e.g. '/sn abc123'), bound to the
+    fake `bot`, that will be matched by a dispatcher's CommandHandlers"""
+    chat = telegram.Chat(chat_id if chat_id is not None else user_id, chat_type)
+    command = text.split()[0]
+    message = telegram.Message(next(message_ids), telegram.User(user_id, 'user{}'.format(user_id), False),
+            datetime.datetime.now(), chat, text=text, bot=bot,
+            entities=[telegram.MessageEntity(telegram.MessageEntity.BOT_COMMAND, 0, len(command))])
+    return telegram.Update(message.message_id, message=message)
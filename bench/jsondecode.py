@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+"""
+Compares the JSON decoders the bot can use (see JSON_DECODERS: orjson and ujson when installed, and the
+standard library's json) on synthetic /debug/supernode_list/1 responses of various sizes, as generated
+by stubnet.  Each decoder's output is checked against the standard library's before it is timed.
+
+    bench/jsondecode.py --sizes 1000,10000,100000 --output decoders.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+
+import botloader
+import stubnet
+from timing import timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare JSON decoders on synthetic supernode lists')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated list sizes (number of SNs)')
+    parser.add_argument('--repeat', type=int, default=10, help='decodes of each list per decoder')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    bot = botloader.load_bot()
+    print("Decoders available: {}".format(', '.join(bot.JSON_DECODERS)), file=sys.stderr)
+
+    results = []
+    print("{:>8} {:>10} {:>12} {:>12} {:>10} {:>8}".format('sns', 'decoder', 'median', 'min', 'MB/s', 'speedup'))
+    for size in (int(x) for x in args.sizes.split(',')):
+        body = stubnet.StubNetwork(size).list_json
+        expected = json.loads(body)
+        baseline = None
+        for name, loads in reversed(list(bot.JSON_DECODERS.items())):
+            if loads(body) != expected:
+                print("  {} decodes the {} SN list differently; skipping it".format(name, size), file=sys.stderr)
+                continue
+            times = timings(lambda: loads(body), args.repeat)
+            median = statistics.median(times)
+            if baseline is None:
+                baseline = median
+            results.append({ 'decoder': name, 'sns': size, 'bytes': len(body), 'runs': len(times),
+                'median': median, 'min': min(times), 'max': max(times) })
+            print("{:>8} {:>10} {:>11.6f}s {:>11.6f}s {:>10.1f} {:>7.2f}x".format(
+                size, name, median, min(times), len(body) / median / 1e6, baseline / median))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'params': vars(args), 'results': results }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+"""
+Load-tests the bot's telegram command handlers, without telegram.
+
+A snapshot of a synthetic network (from one poll of a stubnet network) is loaded into the bot, then
+the handlers registered by add_handlers() are driven through a real telegram dispatcher by a number
+of simulated users, each sending a command and waiting for it to be handled before sending the next.
+Replies are captured in memory.  For each combination of dispatcher worker count (HANDLER_WORKERS;
+0 means None, i.e. one command at a time) and concurrent users, this reports throughput and latency
+percentiles per command, measured from an update being queued to its handler finishing:
+
+    bench/loadtest.py --sns 5000 --workers 0,2,4,8 --concurrency 1,8,32 --mix sn:4,dist:1,tracking:2,snodes:1
+
+With --webhook, the users instead post their updates as JSON to the bot's webhook listener
+(WEBHOOK_LISTEN, on a local port), the way telegram would, so that latencies include receiving and
+queueing the update; updates the bot sheds because its backlog (--backlog) is full are counted as busy.
+"""
+
+import argparse
+import itertools
+import json
+import queue
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+import warnings
+
+from telegram.ext import Dispatcher
+
+import botloader
+import fakes
+import stubnet
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def load_snapshot(bot, net, size, hosts):
+    """Polls a synthetic network of `size` SNs once to fill in the network's globalsns/lastresults"""
+    stub = stubnet.StubNetwork(size, testnet=net.testnet)
+    stubs = stubnet.start_hosts(stub, hosts)
+    net.supernodes = [('stub{}'.format(i), h.url) for i, h in enumerate(stubs)]
+    net.nodes = list(net.supernodes)
+    try:
+        if not bot.rta_poll(net):
+            raise RuntimeError("Polling the synthetic network failed")
+    finally:
+        for h in stubs:
+            h.stop()
+
+
+def command_text(command, rng, pubkeys):
+    if command == 'sn':
+        return '/sn ' + rng.choice(pubkeys)[:8]
+    return '/' + command
+
+
+def run(bot, workers, concurrency, args, mix, pubkeys):
+    bot.HANDLER_WORKERS = workers or None
+    fake = fakes.FakeBot()
+    with warnings.catch_warnings():
+        # We use the old-style (non-context) handler API, like the bot
+        warnings.simplefilter('ignore')
+        dp = Dispatcher(fake, queue.Queue(), workers=max(workers, 1))
+
+    pending = {}
+    errors = {}
+    busy = [0]
+    lock = threading.Lock()
+
+    def wrap(command, func):
+        def wrapped(b, update, *a, **kw):
+            try:
+                return func(b, update, *a, **kw)
+            except Exception as e:
+                with lock:
+                    if command not in errors:
+                        print("  /{} raised: {!r}".format(command, e), file=sys.stderr)
+                    errors[command] = errors.get(command, 0) + 1
+            finally:
+                pending.pop(update.message.message_id).set()
+        return wrapped
+
+    if args.webhook:
+        bot.WEBHOOK_LISTEN = ('127.0.0.1', 0)
+        bot.WEBHOOK_SECRET = 'loadtest'
+        bot.WEBHOOK_BACKLOG = args.backlog
+        bot.updater = fakes.FakeUpdater(fake)
+        bot.updater.dispatcher = dp
+        url = 'http://127.0.0.1:{}/'.format(bot.start_webhook().server_address[1])
+    bot.add_handlers(dp, wrap=wrap)
+    rng = random.Random(args.seed)
+    for user_id in range(1, concurrency + 1):
+        dp.user_data[user_id]['notify_about'] = set(rng.sample(pubkeys, min(args.tracked, len(pubkeys))))
+
+    commands, weights = zip(*mix)
+    latencies = { c: [] for c in commands }
+    timeouts = [0]
+    counter = itertools.count()
+
+    def user(user_id):
+        urng = random.Random(args.seed * 1000 + user_id)
+        while next(counter) < args.requests:
+            command = urng.choices(commands, weights)[0]
+            update = fakes.command_update(fake, command_text(command, urng, pubkeys), user_id=user_id)
+            done = threading.Event()
+            pending[update.message.message_id] = done
+            start = time.perf_counter()
+            if args.webhook:
+                request = urllib.request.Request(url, json.dumps(update.to_dict()).encode(),
+                        { 'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': bot.WEBHOOK_SECRET })
+                with urllib.request.urlopen(request) as r:
+                    if r.read():
+                        # Answered with a "busy" reply rather than handled
+                        pending.pop(update.message.message_id)
+                        with lock:
+                            busy[0] += 1
+                        continue
+            else:
+                dp.update_queue.put(update)
+            if not done.wait(args.timeout):
+                with lock:
+                    timeouts[0] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies[command].append(elapsed)
+
+    if not args.webhook:
+        threading.Thread(target=dp.start, daemon=True).start()
+        while not dp.running:
+            time.sleep(0.01)
+    users = [threading.Thread(target=user, args=(u,)) for u in range(1, concurrency + 1)]
+    start = time.perf_counter()
+    for t in users:
+        t.start()
+    for t in users:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if args.webhook:
+        bot.stop_webhook()
+        bot.WEBHOOK_LISTEN = None
+    else:
+        dp.stop()
+
+    handled = sum(len(l) for l in latencies.values())
+    result = {
+        'workers': workers,
+        'concurrency': concurrency,
+        'requests': handled,
+        'timeouts': timeouts[0],
+        'busy': busy[0],
+        'replies': len(fake.sent),
+        'seconds': elapsed,
+        'throughput': handled / elapsed,
+        'commands': {},
+    }
+    for command, l in latencies.items():
+        if not l:
+            continue
+        l.sort()
+        result['commands'][command] = {
+            'count': len(l),
+            'errors': errors.get(command, 0),
+            'p50': statistics.median(l),
+            'p90': percentile(l, 0.9),
+            'p99': percentile(l, 0.99),
+            'max': l[-1],
+        }
+    return result
+
+
+def print_result(r):
+    print("workers={workers} users={concurrency}: {requests} commands in {seconds:.2f}s, {throughput:.1f}/s, "
+            "{replies} replies, {timeouts} timeouts, {busy} busy".format(**r))
+    for command, c in sorted(r['commands'].items()):
+        print("  /{:<10} {:>6} {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms{}".format(
+            command, c['count'], c['p50'] * 1000, c['p90'] * 1000, c['p99'] * 1000, c['max'] * 1000,
+            '  ({} errors)'.format(c['errors']) if c['errors'] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the bot\'s command handlers')
+    parser.add_argument('--sns', type=int, default=5000, help='number of SNs in the synthetic network')
+    parser.add_argument('--hosts', type=int, default=7, help='number of stub supernodes in the snapshot')
+    parser.add_argument('--workers', default='0,2,4,8',
+            help='comma-separated HANDLER_WORKERS values to try (0 handles commands one at a time)')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated numbers of concurrent users')
+    parser.add_argument('--mix', default='sn:4,dist:1,tracking:2,snodes:1',
+            help='commands to send, with relative weights')
+    parser.add_argument('--requests', type=int, default=2000, help='commands to send in each run')
+    parser.add_argument('--tracked', type=int, default=5, help='SNs tracked by each user (for /tracking)')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for a command to be handled')
+    parser.add_argument('--webhook', action='store_true', help='send the updates through the bot\'s webhook listener')
+    parser.add_argument('--backlog', type=int, default=100, help='WEBHOOK_BACKLOG to use with --webhook')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    mix = []
+    for m in args.mix.split(','):
+        command, _, weight = m.partition(':')
+        mix.append((command, float(weight or 1)))
+
+    bot = botloader.load_bot(HISTORY_DIR=None, ARCHIVE_AFTER=None, CAPTURE_DIR=None, METRICS_LISTEN=None,
+            SEND_TO=1, SUMMARY_FREQUENCY=float('inf'), EXTRA_NETWORKS=[], OUTBOUND_RATE=None)
+    bot.updater = fakes.FakeUpdater()
+    net = bot.create_networks()
+    net.globalsns = {}
+    print("Polling a synthetic network of {} SNs...".format(args.sns), file=sys.stderr)
+    load_snapshot(bot, net, args.sns, args.hosts)
+    bot.stop_io()
+    pubkeys = sorted(net.globalsns.keys())
+
+    print("{:<11} {:>6} {:>12} {:>12} {:>12} {:>12}".format('command', 'count', 'p50', 'p90', 'p99', 'max'))
+    results = []
+    for workers in (int(x) for x in args.workers.split(',')):
+        for concurrency in (int(x) for x in args.concurrency.split(',')):
+            r = run(bot, workers, concurrency, args, mix, pubkeys)
+            print_result(r)
+            results.append(r)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'sns': args.sns, 'params': vars(args), 'results': results }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
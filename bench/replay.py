@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""
+Replays poll logs captured by the bot (with CAPTURE_DIR set) through its reconciliation and
+notification pipeline, as fast as possible, with a fake clock and without any network or telegram
+access.
+
+Each captured poll goes through process_poll() with the clock set to the time it was captured, so
+transitions (new SNs, tier changes, going offline, coming back) and the messages they produce are
+reproduced deterministically.  Messages are captured in memory and can be written out with
+--messages (e.g. to diff the output of two versions; the messages of each poll are sorted by chat,
+since the bot's subscribers send them concurrently); throughput is reported at the end, along with
+the time each poll held up the polling thread.
+
+    bench/replay.py captures/polls-20190410.jsonl.xz --messages out.txt
+"""
+
+import argparse
+import lzma
+import json
+import os
+import statistics
+import sys
+import time
+
+import botloader
+import fakes
+
+
+class FakeClock:
+    """Stands in for the bot's `time` module, with time() returning the replayed poll's time"""
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def capture_files(paths):
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(os.path.join(p, f) for f in os.listdir(p) if f.endswith('.jsonl.xz'))
+        else:
+            files.append(p)
+    return sorted(files)
+
+
+def read_polls(files):
+    for path in files:
+        with lzma.open(path, 'rt') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured polls through the bot')
+    parser.add_argument('captures', nargs='+', help='capture files or directories of them')
+    parser.add_argument('--messages', help='file to write the produced messages to')
+    parser.add_argument('--tracking', action='store_true',
+            help='track every SN, to exercise the per-user notification path')
+    parser.add_argument('--sampled', action='store_true',
+            help='the captures are of sampled polls (POLL_SAMPLE_SIZE); merge them with earlier observations')
+    args = parser.parse_args()
+
+    bot = botloader.load_bot(CAPTURE_DIR=None, HISTORY_DIR=None, METRICS_LISTEN=None, SEND_TO=1, SEND_DIST_TO=None,
+            EXTRA_NETWORKS=[], OUTBOUND_RATE=None)
+    clock = FakeClock()
+    bot.time = clock
+    bot.updater = fakes.FakeUpdater()
+    net = bot.create_networks()
+    net.globalsns = {}
+    net.archive = {}
+    bot.start_subscribers()
+
+    net.supernodes = []
+    known = set()
+    out = open(args.messages, 'w') if args.messages else None
+    durations = []
+    records = 0
+    sent = 0
+    start = time.perf_counter()
+    for poll in read_polls(capture_files(args.captures)):
+        clock.now = poll['time']
+        for tag in poll['supernodes']:
+            if tag not in known:
+                known.add(tag)
+                net.supernodes.append((tag, None))
+        if args.sampled:
+            net.poll_sample_size = len(poll['supernodes'])
+        if args.tracking:
+            for r in poll['responses']:
+                for x in (r['result']['items'] if r else ()):
+                    bot.notifications.setdefault(x['PublicId'], {2})
+
+        t = time.perf_counter()
+        bot.process_poll(net, poll['height'], poll['supernodes'], poll['responses'], poll['time'])
+        durations.append(time.perf_counter() - t)
+        bot.flush_events()
+        records += sum(len(r['result']['items']) for r in poll['responses'] if r)
+
+        messages = sorted(bot.updater.bot.sent[sent:], key=lambda m: (m[1], m[2]))
+        sent = len(bot.updater.bot.sent)
+        if out:
+            for _, chat_id, text in messages:
+                out.write('[{} @{}] -> {}\n{}\n\n'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(poll['time'])), poll['height'], chat_id, text))
+    elapsed = time.perf_counter() - start
+    if out:
+        out.close()
+
+    if not durations:
+        print("No polls found", file=sys.stderr)
+        sys.exit(1)
+    durations.sort()
+    print("Replayed {} polls ({} SN records) in {:.3f}s: {:.1f} polls/s, {:.0f} records/s".format(
+        len(durations), records, elapsed, len(durations) / elapsed, records / elapsed))
+    print("Per poll: median {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+        statistics.median(durations) * 1000, durations[int(len(durations) * 0.99)] * 1000, durations[-1] * 1000))
+    print("{} messages produced; {} SNs known at the end".format(sent, len(net.globalsns)))
+
+
+if __name__ == '__main__':
+    main()
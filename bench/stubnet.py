@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+"""
+A synthetic graft network for benchmarking the bot: a set of local HTTP servers imitating the
+supernode (/debug/supernode_list/1, /debug/auth_sample/ID) and node (/getheight, /getinfo, and
+get_block_headers_range on /json_rpc) endpoints the bot talks to.
+
+Every host serves the same StubNetwork, each with its own injected latency and failure rate.
+Calling StubNetwork.tick() advances the network by one poll interval, applying churn: SNs going
+offline or coming back, stakes changing, and SNs disappearing and being replaced by new ones.
+
+Can also be run standalone to point a real bot instance at:
+
+    bench/stubnet.py --sns 10000 --hosts 7 --churn 0.01
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+
+GRFT = 10000000000
+TIER_STAKES = (0, 50000 * GRFT, 90000 * GRFT, 150000 * GRFT, 250000 * GRFT)
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+class StubNetwork:
+    def __init__(self, size, seed=1, churn=0.0, testnet=False, height=300000, interval=60):
+        """
+        size - number of SNs
+        churn - fraction of SNs that change state (online/offline, stake, replaced) on each tick
+        testnet - generate testnet (F...) rather than mainnet (G...) wallet addresses
+        interval - seconds that each tick() advances the network by
+        """
+        self.rng = random.Random(seed)
+        self.churn = churn
+        self.testnet = testnet
+        self.height = height
+        self.start_height = height
+        self.interval = interval
+        self.start_time = int(time.time())
+        self.lock = threading.Lock()
+        self.items = [self.make_item() for _ in range(size)]
+        self.encode()
+
+    def make_item(self):
+        rng = self.rng
+        t = rng.choice((0, 1, 1, 2, 2, 3, 4))
+        first_valid = self.height - rng.randrange(0, 5000)
+        return {
+            'PublicId': '{:064x}'.format(rng.getrandbits(256)),
+            'Address': ('F' if self.testnet else 'G') + rng.choice('456789ABCD') + ''.join(rng.choice(BASE58) for _ in range(93)),
+            'StakeAmount': TIER_STAKES[t] + (rng.randrange(0, 1000) * GRFT if t else 0),
+            'StakeFirstValidBlock': first_valid,
+            'StakeExpiringBlock': first_valid + 5040,
+            'IsStakeValid': t > 0,
+            'BlockchainBasedListTier': t,
+            'LastUpdateAge': rng.randrange(0, 600) if rng.random() < 0.9 else rng.randrange(3600, 86400),
+        }
+
+    def tick(self):
+        """Advances the network by one poll interval"""
+        rng = self.rng
+        with self.lock:
+            self.height += max(self.interval // 120, 1)
+            for x in self.items:
+                x['LastUpdateAge'] += self.interval
+                # Online SNs announce regularly
+                if x['LastUpdateAge'] < 3600 and x['LastUpdateAge'] >= 120:
+                    x['LastUpdateAge'] = rng.randrange(0, 120)
+            for _ in range(int(len(self.items) * self.churn)):
+                i = rng.randrange(len(self.items))
+                x = self.items[i]
+                r = rng.random()
+                if r < 0.4:
+                    # Goes offline
+                    x['LastUpdateAge'] = 3600 + rng.randrange(0, 600)
+                elif r < 0.8:
+                    # Comes (back) online
+                    x['LastUpdateAge'] = rng.randrange(0, 120)
+                elif r < 0.9:
+                    t = rng.randrange(0, len(TIER_STAKES))
+                    x['StakeAmount'] = TIER_STAKES[t]
+                    x['BlockchainBasedListTier'] = t
+                    x['StakeExpiringBlock'] = self.height + 5040
+                else:
+                    self.items[i] = self.make_item()
+        self.encode()
+
+    def encode(self):
+        with self.lock:
+            self.list_json = json.dumps({ 'result': { 'items': self.items } }).encode()
+            self.height_json = json.dumps({ 'height': self.height, 'status': 'OK' }).encode()
+
+    def auth_sample_json(self, payment_id):
+        rng = random.Random(payment_id)
+        with self.lock:
+            sample = rng.sample(self.items, min(8, len(self.items)))
+        return json.dumps({ 'result': { 'items': sample } }).encode()
+
+    def block_header(self, height):
+        """The (deterministic) header of block `height`: two minutes apart on average, with a reward
+        of about 300 GRFT"""
+        rng = random.Random(height)
+        return {
+            'height': height,
+            'timestamp': self.start_time + (height - self.start_height) * 120 + rng.randrange(-30, 30),
+            'reward': 300 * GRFT + rng.randrange(0, 10 * GRFT),
+            'hash': hashlib.sha256(str(height).encode()).hexdigest(),
+            'prev_hash': hashlib.sha256(str(height - 1).encode()).hexdigest(),
+        }
+
+    def headers_json(self, start, end):
+        with self.lock:
+            end = min(end, self.height - 1)
+        return json.dumps({ 'jsonrpc': '2.0', 'id': '0', 'result': {
+            'headers': [self.block_header(h) for h in range(start, end + 1)], 'status': 'OK' } }).encode()
+
+    def info_json(self):
+        return json.dumps({
+            'height': self.height, 'outgoing_connections_count': 8, 'incoming_connections_count': 12,
+            'start_time': self.start_time, 'status': 'OK',
+        }).encode()
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        host = self.server.stub
+        host.requests += 1
+        if host.latency:
+            time.sleep(host.latency * random.uniform(0.5, 1.5))
+        if host.failure and random.random() < host.failure:
+            host.failures += 1
+            return self.reply(500, b'<html>Internal error</html>', 'text/html')
+
+        net = host.network
+        path = self.path.split('?')[0]
+        if path == '/debug/supernode_list/1':
+            body = net.list_json
+        elif path.startswith('/debug/auth_sample/'):
+            body = net.auth_sample_json(path.rsplit('/', 1)[1])
+        elif path == '/getheight':
+            body = net.height_json
+        elif path == '/getinfo':
+            body = net.info_json()
+        else:
+            return self.reply(404, b'Not found', 'text/plain')
+        # Supernodes don't always send a JSON content type
+        self.reply(200, body, host.content_type)
+
+    def do_POST(self):
+        host = self.server.stub
+        host.requests += 1
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path != '/json_rpc' or request.get('method') != 'get_block_headers_range':
+            return self.reply(404, b'Not found', 'text/plain')
+        params = request['params']
+        self.reply(200, host.network.headers_json(params['start_height'], params['end_height']), 'application/json')
+
+    def reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class StubHost:
+    """A single stub supernode/node serving `network` on its own port"""
+    def __init__(self, network, port=0, latency=0.0, failure=0.0, content_type='application/json'):
+        self.network = network
+        self.latency = latency
+        self.failure = failure
+        self.content_type = content_type
+        self.requests = 0
+        self.failures = 0
+        self.server = StubServer(('127.0.0.1', port), StubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_hosts(network, count, latency=0.0, failure=0.0, base_port=0):
+    """Starts `count` stub hosts for `network`.  latency and failure are either a single value for
+    all hosts or a list with a value per host."""
+    def per_host(v, i):
+        return v[i] if isinstance(v, (list, tuple)) else v
+    return [StubHost(network, port=base_port + i if base_port else 0,
+        latency=per_host(latency, i), failure=per_host(failure, i)) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic graft network for the bot to poll')
+    parser.add_argument('--sns', type=int, default=1000, help='number of supernodes in the network')
+    parser.add_argument('--hosts', type=int, default=7, help='number of stub supernode/node hosts to run')
+    parser.add_argument('--port', type=int, default=29000, help='port of the first host')
+    parser.add_argument('--latency', type=float, default=0.0, help='average response latency, in seconds')
+    parser.add_argument('--failure', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of SNs changing state per tick')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between network ticks')
+    parser.add_argument('--testnet', action='store_true', help='use testnet wallet addresses')
+    args = parser.parse_args()
+
+    net = StubNetwork(args.sns, churn=args.churn, testnet=args.testnet, interval=args.interval)
+    hosts = start_hosts(net, args.hosts, latency=args.latency, failure=args.failure, base_port=args.port)
+    print("SUPERNODES = NODES = [")
+    for i, h in enumerate(hosts):
+        print("        ('stub{}', '{}'),".format(i, h.url))
+    print("]")
+    while True:
+        time.sleep(args.interval)
+        net.tick()
+
+
+if __name__ == '__main__':
+    main()
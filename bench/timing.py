@@ -0,0 +1,15 @@
+"""
+Timing helpers shared by the benchmark tools in this directory.
+"""
+
+import time
+
+
+def timings(func, repeat):
+    """Calls func() `repeat` times and returns the list of how long each call took, in seconds"""
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        result.append(time.perf_counter() - start)
+    return result
@@ -1,21 +1,36 @@
 #!/usr/bin/python3
 
-import threading
 import time
+# When the bot started loading, for the startup report (see startup_phase)
+load_started = time.time()
+
+import threading
 import re
-import requests
-import asyncio
-import aiohttp
 import json.decoder
+import hmac
 import html
-import shelve
 import random
+import heapq
+import bisect
+import copy
+import os
+import struct
+import http.server
+import socketserver
+import queue
+import signal
+import urllib.parse
+from collections import namedtuple, deque
 from functools import wraps, partial
+from contextlib import contextmanager
 import logging
-import uuid
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ChatAction
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler,
-                          PicklePersistence)
+import logging.handlers
+import sys
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ChatAction, Update
+from telegram.error import BadRequest
+# (requests, aiohttp, telegram.ext and the modules only some commands or optional features need, such as
+# gzip, lzma and mmap, are imported where they are used, so that the bot can start answering commands
+# before they are loaded)
 
 # auth token for the telegram bot; get this from @BotFather
 TELEGRAM_TOKEN = "FIXME"
@@ -26,6 +41,28 @@ PERSISTENCE_USER_FILENAME = 'rta-user.data'
 # file to store persistent global data in
 PERSISTENCE_GLOBAL_SNS_FILENAME = 'rta-global.data'
 
+# file to archive long-gone SNs in (see ARCHIVE_AFTER)
+PERSISTENCE_ARCHIVE_FILENAME = 'rta-archive.data'
+
+# file to store the ledger of stakes sent by /send in (only used when /send is enabled)
+PERSISTENCE_STAKES_FILENAME = 'rta-stakes.data'
+
+# directory to store the SN uptime history in (for /uptime and /netsize); None disables the history
+HISTORY_DIR = 'rta-history'
+
+# file to cache block headers in, used to estimate the actual stimulus emission for ROI (see
+# STIMULUS_WINDOW); None uses the fixed STIMULUS_PER_DAY instead
+HEADER_CACHE_FILENAME = 'rta-headers.data'
+
+# The history keeps a frame for every poll for this many days, and hourly frames for this many days.
+# Daily frames are kept forever.
+HISTORY_POLL_DAYS = 3
+HISTORY_HOUR_DAYS = 90
+
+# directory to write an xz-compressed log of every poll's height and raw supernode responses to, for
+# reproducing problems with bench/replay.py; None disables capturing
+CAPTURE_DIR = None
+
 # URL to graft supernodes.  Should not end in a /
 SUPERNODES = [
         ('Jas1', 'http://localhost:29001'),
@@ -37,6 +74,30 @@ SUPERNODES = [
         ('dev4', 'http://34.192.115.160:28690'),
 ]
 
+# File listing more supernodes to poll, one "TAG URL" per line, added to SUPERNODES.  It is re-read
+# when it changes, so that it can be maintained by a separate discovery job.  None to not use one.
+SUPERNODES_FILE = None
+
+# If set, poll only this many of SUPERNODES each cycle, picked in rotation and spread across hosts,
+# and merge their lists with the observations from recent cycles (see OBSERVATION_MAX_AGE).  This
+# keeps the cost of a cycle constant however many supernodes there are.  None polls every
+# supernode every cycle.
+POLL_SAMPLE_SIZE = None
+
+# When sampling, observations older than this many seconds are dropped; newer ones count for less
+# towards ONLINE_MIN_COUNT the older they are (and their LastUpdateAge is aged accordingly).
+OBSERVATION_MAX_AGE = 15*60
+
+# Maximum number of supernodes or nodes fetched from at the same time
+POLL_CONCURRENCY = 16
+
+# JSON decoder for supernode and node responses: 'orjson', 'ujson' or 'json' (the standard library's).
+# None uses the fastest one installed; bench/jsondecode.py compares them.
+JSON_DECODER = None
+
+# Seconds between polls
+POLL_INTERVAL = 60
+
 # URL(s) to graft nodes; typically the one the above RTA_URL supernode is connected to.  The first
 # one is used when we need some info (like current height); they all get used for things like the
 # /nodes and /height commands.
@@ -56,9 +117,21 @@ OWNER = 'FIXME'
 # Warn about a SN going offline if the last uptime becomes greater than this many minutes
 TIMEOUT = 3600
 
+# SNs that have been offline for longer than this many seconds are moved out of the live set into
+# the archive; they are still shown by /sn, and become live again if they come back online.  None
+# keeps every SN ever seen live.
+ARCHIVE_AFTER = 30*24*60*60
+
 # Minimum count of online among queried SNs needed to consider a remote SN as online
 ONLINE_MIN_COUNT = 3
 
+# Average time between blocks, in seconds
+BLOCK_TIME = 120
+
+# Warn users tracking a SN (via /track) when its stake is this many seconds away from expiring.  0
+# means warn when the stake actually expires.
+EXPIRY_WARNINGS = (24*60*60, 60*60, 0)
+
 # Send out a summary of online nodes at most once every (this number) seconds
 SUMMARY_FREQUENCY = 4*60*60
 
@@ -75,14 +148,100 @@ SEE_SEND_TO = 'Please use a DM or join the bot spam group: https://t.me/GraftSNS
 WALLET_RPC = None
 # 'http://localhost:55115'
 
+# If set, authorized /send requests are held for up to this many seconds so that requests arriving
+# close together go out in a single multi-destination transfer.  None sends each /send immediately.
+SEND_BATCH_WINDOW = None
+
+# Send a pending /send batch right away once it has this many destinations
+SEND_BATCH_MAX_DESTINATIONS = 15
+
 TESTNET = False
 
+# Name of the network configured here, used to pick it in commands (e.g. /dist testnet) when
+# monitoring more than one.  None means 'testnet' or 'mainnet', depending on TESTNET.
+NETWORK_NAME = None
+
+# More networks to monitor from the same process.  Each is a dict with a 'NAME' and values for any of
+# the NETWORK_SETTINGS (e.g. TESTNET, SUPERNODES, NODES, SEND_TO) that differ from the network
+# configured above; file and directory settings default to the above prefixed with the name.  For
+# example: [{ 'NAME': 'testnet', 'TESTNET': True, 'SUPERNODES': [...], 'NODES': [...], 'SEND_TO': -123 }]
+EXTRA_NETWORKS = []
+
+# Settings that can be given per network (see EXTRA_NETWORKS)
+NETWORK_SETTINGS = ('TESTNET', 'SUPERNODES', 'NODES', 'SEND_TO', 'SEND_DIST_TO', 'PERSISTENCE_GLOBAL_SNS_FILENAME',
+        'PERSISTENCE_ARCHIVE_FILENAME', 'HISTORY_DIR', 'HEADER_CACHE_FILENAME', 'CAPTURE_DIR', 'SUPERNODES_FILE',
+        'POLL_SAMPLE_SIZE', 'POLL_INTERVAL')
+
+# Maximum number of messages per second sent out for updates, tracking notifications and summaries
+# (across all networks; telegram allows about 30).  None doesn't limit them.
+OUTBOUND_RATE = 20
+
 # Authorized users for restricted commands (e.g. /send)
 # When an unauthorized user sends a /send message, the userid will be printed to stdout
 BOSS_USERS = {
 # 12345: '@some_user',
 }
 
+# Address (host, port) to serve Prometheus metrics on at /metrics, e.g. ('127.0.0.1', 9115).  None
+# disables metrics collection entirely.
+METRICS_LISTEN = None
+
+# Address (host, port) to serve a read-only JSON API of the bot's view of the network on, e.g.
+# ('127.0.0.1', 9116); see ApiHandler for the endpoints.  None disables the API.
+API_LISTEN = None
+
+# Users allowed to use owner-only commands such as /profile (same format as BOSS_USERS)
+OWNER_USERS = {
+# 12345: '@some_user',
+}
+
+# Directory to save /profile results in
+PROFILE_DIR = '.'
+
+# Number of threads to run commands on, so that a slow command doesn't hold up replies to everyone
+# else; None handles commands one at a time.  bench/loadtest.py measures what different values give.
+HANDLER_WORKERS = None
+
+# Address (host, port) to receive telegram updates on by webhook instead of long-polling for them, e.g.
+# ('127.0.0.1', 8443) behind a TLS-terminating reverse proxy.  Updates are handled by HANDLER_WORKERS
+# threads (or one).  None uses long polling.
+WEBHOOK_LISTEN = None
+
+# Public URL telegram should post updates to (it gets registered with telegram on startup); updates are
+# only accepted on its path.  None leaves the webhook registration alone and accepts updates on /, e.g.
+# for testing with a local client.
+WEBHOOK_URL = None
+
+# Secret (1-256 letters, digits, _ and -) that telegram sends with every update in the
+# X-Telegram-Bot-Api-Secret-Token header; it gets registered along with WEBHOOK_URL, and updates without
+# it are rejected.  Required for webhook mode, since anyone who can reach WEBHOOK_LISTEN could otherwise
+# post updates claiming to come from any user.
+WEBHOOK_SECRET = None
+
+# Webhook updates allowed to wait for a handler worker; beyond that, updates are answered with a "busy"
+# reply instead of being queued
+WEBHOOK_BACKLOG = 100
+
+# Largest webhook update body accepted, in bytes; bigger ones are rejected (413) without being read.
+# Telegram's updates are a few KB at most.
+WEBHOOK_MAX_BODY = 2**20
+
+# File to write the bot's log to as JSON lines (one object per event, with its type, time and fields such
+# as timings, for offline analysis), rotated once it reaches LOG_MAX_BYTES with LOG_BACKUPS old files
+# kept.  None only logs to stdout.  e.g. 'rta-log.jsonl'
+LOG_FILE = None
+LOG_MAX_BYTES = 20 * 2**20
+LOG_BACKUPS = 5
+
+# Most log records of each event type (e.g. 'fetch', 'send') to write per minute, with the None entry
+# applying to all other types; records over the limit are dropped, and counted in the next one
+# written.  Errors are never dropped.
+LOG_RATE_LIMITS = { 'fetch': 600, 'send': 600, 'command': 600, None: 120 }
+
+# Log records allowed to wait for the background log writer; beyond that, records are dropped rather
+# than holding up the thread logging them
+LOG_QUEUE_SIZE = 10000
+
 # Enable to broadcast "I'm alive" upon startup
 ANNOUNCE_LIFE = False
 
@@ -100,25 +259,263 @@ TIER_COSTS = (0, 50000, 90000, 150000, 250000)
 # or about 2.6-3.0% slower than 1 per minute.
 #Jason, [10.04.19 22:24]
 # And that means daily emission is running about 112000 rather than 115200
+#
+# This is only used until the block headers of a full STIMULUS_WINDOW have been cached (or if
+# HEADER_CACHE_FILENAME is None); after that the stimulus is estimated from the pace of the chain.
 STIMULUS_PER_DAY = 112000
 
+# Stimulus paid out per block: the counts above come to ~1398 payments of 80 GRFT per 720 blocks.  The
+# block headers don't show the stimulus itself, but they do show how fast blocks (and so stimulus
+# payments) are coming, so the daily emission is estimated as this times the blocks per day measured
+# over the last STIMULUS_WINDOW blocks.
+STIMULUS_PER_BLOCK = 155.3
+STIMULUS_WINDOW = 3 * 720
+
+# Maximum number of block headers to request from a node at once; this is also the most fetched in a
+# single poll, so filling the cache from scratch is spread over several polls
+HEADER_FETCH_BATCH = 500
+
 # One GRFT in atomic units
 GRFT = 10000000000
 
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+
+def log_event(event, msg, *args, level=logging.INFO, exc_info=None, **fields):
+    """Logs `msg` (%-formatted with `args`, but only if `level` is enabled) as an event of type
+    `event`, with `fields` going into its JSON log record"""
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, exc_info=exc_info, extra={ 'event': event, 'fields': fields })
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats a log record as a JSON object: its time, level, logger, event type and message, the
+    event's fields, and any traceback"""
+    def format(self, record):
+        d = { 'time': round(record.created, 6), 'level': record.levelname.lower(), 'logger': record.name,
+                'event': getattr(record, 'event', 'log'), 'msg': record.getMessage() }
+        d.update(getattr(record, 'fields', ()))
+        if getattr(record, 'suppressed', None):
+            d['suppressed'] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d['traceback'] = record.exc_text
+        return json.dumps(d, default=str)
+
+
+class LogRateLimit(logging.Filter):
+    """Lets through at most LOG_RATE_LIMITS records of each event type per minute"""
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        # { event type: [minute, records let through, records dropped] }
+        self.windows = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        limit = LOG_RATE_LIMITS.get(event, LOG_RATE_LIMITS.get(None))
+        if not limit or record.levelno >= logging.ERROR:
+            return True
+        minute = int(record.created // 60)
+        with self.lock:
+            w = self.windows.setdefault(event, [minute, 0, 0])
+            if w[0] != minute:
+                if w[2]:
+                    record.suppressed = w[2]
+                w[:] = [minute, 0, 0]
+            if w[1] >= limit:
+                w[2] += 1
+                metric_inc('graftbot_log_dropped_total', reason='rate')
+                return False
+            w[1] += 1
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues log records for the background writer, and drops them if the queue is full.  As with the
+    stdlib QueueHandler, a record's message and traceback are rendered before it is queued, and its
+    arguments and exception dropped: they could change, or keep whole stack frames alive, while the
+    record waits.  The rest of the formatting happens on the background writer."""
+    exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metric_inc('graftbot_log_dropped_total', reason='full')
+
+
+log_listener = None
+
+
+def start_logging():
+    """Routes all logging (the bot's and the telegram library's) through a queue to a background
+    thread writing it to stdout and, if LOG_FILE is set, as JSON lines including the debug-level timing
+    events, to LOG_FILE"""
+    global log_listener
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [console]
+    if LOG_FILE:
+        f = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        f.setFormatter(JsonLogFormatter())
+        handlers.append(f)
+        logger.setLevel(logging.DEBUG)
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(LogRateLimit())
+    logging.getLogger().handlers[:] = [handler]
+    log_listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_logging():
+    """Writes out the log records still queued and stops the background writer"""
+    log_listener.stop()
+
 pp = None
-globalsns = None
-lastresults = None
-lastheight = None
+stakes = None
 updater = None
 notifications = {}
 
-print = partial(print, flush=True)
+# The monitored networks, by name (see create_networks)
+networks = {}
+
+# Subscribers to the poller's events; see subscribe()
+subscribers = []
+
+
+
+def address_patterns(testnet):
+    """Returns the regexes matching a full wallet address and an abbreviated one (e.g. "G4abc...xyz")"""
+    if testnet:
+        return (r'F[3-9A-D][1-9a-km-zA-HJ-NP-Z]{93}',
+                r'(F[3-9A-D][1-9a-km-zA-HJ-NP-Z]{3,93})(?:\.+([1-9a-km-zA-HJ-NP-Z]{0,90}))?')
+    return (r'G[4-9A-D][1-9a-km-zA-HJ-NP-Z]{93}',
+            r'(G[4-9A-D][1-9a-km-zA-HJ-NP-Z]{3,93})(?:\.+([1-9a-km-zA-HJ-NP-Z]{0,90}))?')
+
+
+class Network:
+    """A monitored network: its settings (the NETWORK_SETTINGS, as lower-case attributes) and all of
+    the bot's state for it"""
+    def __init__(self, name, **settings):
+        self.name = name
+        for k in NETWORK_SETTINGS:
+            setattr(self, k.lower(), settings[k] if k in settings else globals()[k])
+        self.re_addr, self.re_addr_pattern = address_patterns(self.testnet)
+        self.base_supernodes = self.supernodes
+        self.supernodes_file_mtime = None
+
+        self.globalsns = None
+        self.archive = None
+        self.archived = set()
+        self.archive_lock = threading.Lock()
+        self.lastresults = None
+        # How old each supernode's list in lastresults is, when sampling: { tag: seconds }, to be added
+        # to its items' LastUpdateAge (see merge_observations)
+        self.lastages = {}
+        self.lastheight = None
+        self.node_heights = {}
+        # The latest list from each supernode, when sampling: { tag: (time, { pubkey: item }) }
+        self.observations = {}
+        # Sampling rotation state: { stratum: position } and { stratum: fractional share carried over }
+        self.sample_cursor = {}
+        self.sample_credit = {}
+        # Min-heap of upcoming stake expiry warnings: (alert_height, expiry_height, pubkey, stage),
+        # where stage is an index into EXPIRY_WARNINGS.  Each SN has at most one live entry; entries
+        # made stale by a renewed stake are skipped when popped.
+        self.expiry_alerts = []
+        self.last_alert_height = None
+        # Uptime history state; see history_open()
+        self.history = None
+        # Block header cache state, and the stimulus estimated from it; see headers_open()
+        self.headers = None
+        self.stimulus = None
+        # SNs the supernodes disagree about, and how often each supernode is out of line; see
+        # set_disagreement()
+        self.disagreements = {}
+        self.disagree_counts = {}
+        # Ranked indexes of the SNs for /top and /list, and the state each SN is indexed under; see
+        # update_ranks()
+        self.ranks = {}
+        self.rank_state = {}
+        # The JSON API's view of the network; see api_update()
+        self.api = None
+        # Duration of each phase of the current (or last) poll cycle, for the poll log
+        self.poll_timings = {}
+        self.thread = None
+
+
+def create_networks():
+    """Sets up `networks` from the network settings above and EXTRA_NETWORKS"""
+    networks.clear()
+    main = Network(NETWORK_NAME or ('testnet' if TESTNET else 'mainnet'))
+    networks[main.name.lower()] = main
+    for extra in EXTRA_NETWORKS:
+        settings = dict(extra)
+        name = settings.pop('NAME')
+        for k in ('PERSISTENCE_GLOBAL_SNS_FILENAME', 'PERSISTENCE_ARCHIVE_FILENAME', 'HISTORY_DIR', 'HEADER_CACHE_FILENAME'):
+            if k not in settings and globals()[k]:
+                d, f = os.path.split(globals()[k])
+                settings[k] = os.path.join(d, name + '-' + f)
+        if 'CAPTURE_DIR' not in settings and CAPTURE_DIR:
+            settings['CAPTURE_DIR'] = os.path.join(CAPTURE_DIR, name)
+        networks[name.lower()] = Network(name, **settings)
+    return main
+
+
+def primary_network():
+    return next(iter(networks.values()))
+
+
+def network_prefix(name):
+    """Returns a prefix identifying network `name` in messages, if there is more than one network"""
+    return '*[{}]* '.format(name) if len(networks) > 1 else ''
+
+
+def network_header(name):
+    """Returns a line identifying network `name` to start messages with, if there is more than one
+    network"""
+    return network_prefix(name).strip() + '\n' if len(networks) > 1 else ''
+
+
+def open_network(net):
+    """Loads the network's persistent state"""
+    import shelve
+    net.globalsns = shelve.open(net.persistence_global_sns_filename, writeback=True)
+    if ARCHIVE_AFTER:
+        net.archive = shelve.open(net.persistence_archive_filename)
+        net.archived.update(net.archive.keys())
+    for p, g in net.globalsns.items():
+        schedule_expiry(net, p, g)
+    if net.history_dir:
+        history_open(net)
+    if net.header_cache_filename:
+        headers_open(net)
+
+
+def close_network(net):
+    net.globalsns.close()
+    if net.archive is not None:
+        net.archive.close()
+    if net.headers is not None:
+        net.headers['file'].close()
+
 
 def tier(balance):
     for i, c in enumerate(TIER_COSTS):
@@ -158,6 +555,12 @@ def format_tier(t):
     return ('_[t₀]_', '_[t₁]_', '_[t₂]_', '_[t₃]_', '_[t₄]_')[t]
 
 
+def friendly_minutes(minutes):
+    return ('{} mins.'.format(minutes) if minutes <= 60 else
+            '{:.1f} hours'.format(minutes/60) if minutes <= 24*60 else
+            '{:.1f} days'.format(minutes/60/24))
+
+
 def friendly_ago(ago):
     ago = int(ago)
     seconds = ago % 60
@@ -176,6 +579,7 @@ def friendly_ago(ago):
 def send_reply(bot, update, message, reply_to=None, reply_markup=None, parse_mode=ParseMode.MARKDOWN):
     if reply_to is None:
         reply_to = update.message
+    metric_inc('graftbot_messages_sent_total', kind='reply')
     if reply_to:
         reply_to.reply_text(message, reply_markup=reply_markup, parse_mode=parse_mode)
     else:
@@ -185,6 +589,73 @@ def send_reply(bot, update, message, reply_to=None, reply_markup=None, parse_mod
             reply_markup=reply_markup)
 
 
+# Telegram's limit on the length of a message
+MESSAGE_LIMIT = 4096
+
+# The pieces of (telegram) Markdown that a message mustn't be split inside of: entities, escaped
+# characters, and otherwise single characters
+RE_MD_TOKEN = r'```.*?```|`[^`\n]*`|\*[^*\n]*\*|_[^_\n]*_|\[[^\]\n]*\]\([^)\n]*\)|\\.|.'
+
+
+def split_markdown(text, limit):
+    """Splits a block of Markdown into pieces of at most `limit` characters: at the last line break
+    that fits, or failing that the last space, outside of any entity.  An entity that is too long on
+    its own is split into several, each closed and reopened."""
+    pieces = []
+    piece = ''
+    cut = None
+    for m in re.finditer(RE_MD_TOKEN, text, re.S):
+        tok = m.group()
+        while len(piece) + len(tok) > limit:
+            if cut:
+                if piece[:cut[0]].strip():
+                    pieces.append(piece[:cut[0]].rstrip())
+                piece = piece[cut[0]:].lstrip(' ')
+            elif piece:
+                pieces.append(piece)
+                piece = ''
+            else:
+                d = next((d for d in ('```', '`', '*', '_') if len(tok) > 2 * len(d) and tok.startswith(d) and tok.endswith(d)), '')
+                n = limit - 2 * len(d)
+                pieces.append(d + tok[len(d):len(d) + n] + d)
+                tok = d + tok[len(d) + n:]
+            cut = None
+        piece += tok
+        if tok == '\n' or (tok == ' ' and not (cut and cut[1])):
+            cut = (len(piece), tok == '\n')
+    if piece.strip():
+        pieces.append(piece.rstrip())
+    return pieces
+
+
+def pack_messages(blocks, sep='\n\n', header='', limit=MESSAGE_LIMIT):
+    """Packs rendered Markdown blocks into as few messages as possible, each starting with `header`
+    and holding as many whole blocks (joined with `sep`) as fit in `limit` characters.  Only a block
+    too long for a message of its own gets split (see split_markdown)."""
+    limit -= len(header)
+    messages = []
+    msg = None
+    for block in blocks:
+        for piece in split_markdown(block, limit) if len(block) > limit else (block,):
+            if msg is not None and len(msg) + len(sep) + len(piece) <= limit:
+                msg += sep + piece
+            else:
+                if msg is not None:
+                    messages.append(header + msg)
+                msg = piece
+    if msg is not None:
+        messages.append(header + msg)
+    return messages
+
+
+def send_replies(bot, update, blocks, sep='\n\n'):
+    """Sends rendered Markdown blocks to the chat a command came from, packed into as few messages as
+    possible"""
+    for msg in pack_messages(blocks, sep):
+        metric_inc('graftbot_messages_sent_total', kind='reply')
+        bot.send_message(chat_id=update.message.chat_id, text=msg, parse_mode=ParseMode.MARKDOWN)
+
+
 def send_action(action):
     """Sends `action` while processing func command."""
 
@@ -200,10 +671,12 @@ def send_action(action):
 
 
 def needs_data(func):
+    """Replies that we're starting up until the command's network (or, for commands not about a single
+    network, any network) has been polled"""
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
-        global lastresults
-        if not lastresults:
+        net = kwargs.get('net')
+        if not (net.lastresults if net else any(n.lastresults for n in networks.values())):
             send_reply(bot, update, 'I\'m still starting up; try again later')
             return
         return func(bot, update, *args, **kwargs)
@@ -213,19 +686,257 @@ def needs_data(func):
 def nospam(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
-        if SEE_SEND_TO and update.message.chat.type != 'private' and update.message.chat_id != SEND_TO:
+        if (SEE_SEND_TO and update.message.chat.type != 'private' and
+                all(update.message.chat_id != net.send_to for net in networks.values())):
             return send_reply(bot, update, SEE_SEND_TO)
         else:
             return func(bot, update, *args, **kwargs)
     return wrapped
 
 
+def command_network(update, args):
+    """Returns the network a command is about, and its remaining arguments: the network named by the
+    first argument, if any, otherwise the network posting to the chat, otherwise the first one"""
+    if args and args[0].lower() in networks:
+        return networks[args[0].lower()], args[1:]
+    for net in networks.values():
+        if update.message.chat_id in (net.send_to, net.send_dist_to):
+            return net, args
+    return primary_network(), args
+
+
+def with_network(func):
+    """Passes the network the command is about (see command_network) as `net`"""
+    @wraps(func)
+    def wrapped(bot, update, *args, **kwargs):
+        kwargs['net'], kwargs['args'] = command_network(update, kwargs.get('args'))
+        return func(bot, update, *args, **kwargs)
+    return wrapped
+
+
+# Prometheus metrics: name -> (type, help)
+METRICS = {
+        'graftbot_poll_seconds': ('histogram', 'Duration of poll cycles, by phase'),
+        'graftbot_fetch_seconds': ('histogram', 'Latency of requests to supernodes and nodes'),
+        'graftbot_fetch_errors_total': ('counter', 'Failed requests to supernodes and nodes'),
+        'graftbot_handler_seconds': ('histogram', 'Latency of telegram command handlers'),
+        'graftbot_dispatch_seconds': ('histogram', 'Time webhook updates waited for a handler worker'),
+        'graftbot_webhook_updates_total': ('counter', 'Updates received by webhook, by outcome (queued, busy, forbidden or too_large)'),
+        'graftbot_messages_sent_total': ('counter', 'Messages sent to telegram, by kind'),
+        'graftbot_globalsns_entries': ('gauge', 'SNs in the live set (globalsns)'),
+        'graftbot_archived_entries': ('gauge', 'SNs in the archive'),
+        'graftbot_lastresults_records': ('gauge', 'SN records across all supernode lists of the last poll'),
+        'graftbot_events_total': ('counter', 'Events emitted by the poller, by type'),
+        'graftbot_events_dropped_total': ('counter', 'Events dropped because a subscriber\'s queue was full'),
+        'graftbot_api_requests_total': ('counter', 'Requests to the JSON API, by endpoint and status'),
+        'graftbot_observed_supernodes': ('gauge', 'Supernodes with a current observation in the merged view'),
+        'graftbot_headers_fetched_total': ('counter', 'Block headers fetched from nodes into the header cache'),
+        'graftbot_disagreements': ('gauge', 'SNs that supernodes disagree about the stake, wallet or expiry of'),
+        'graftbot_stimulus_per_day': ('gauge', 'Stimulus emission (GRFT per day) estimated from the block time'),
+        'graftbot_log_dropped_total': ('counter', 'Log records dropped by rate limiting or a full log queue'),
+}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# (name, ((label, value), ...)) -> value; histograms are [bucket counts..., +Inf count, sum]
+metric_values = {}
+metrics_lock = threading.Lock()
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def metric_inc(name, value=1, **labels):
+    if not METRICS_LISTEN:
+        return
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
+
+
+def metric_set(name, value, **labels):
+    if not METRICS_LISTEN:
+        return
+    with metrics_lock:
+        metric_values[metric_key(name, labels)] = value
+
+
+def metric_observe(name, value, **labels):
+    if not METRICS_LISTEN:
+        return
+    key = metric_key(name, labels)
+    with metrics_lock:
+        h = metric_values.get(key)
+        if h is None:
+            h = metric_values[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        for i, b in enumerate(METRIC_BUCKETS):
+            if value <= b:
+                h[i] += 1
+        h[-2] += 1
+        h[-1] += value
+
+
+@contextmanager
+def metric_timer(name, timings=None, **labels):
+    """Observes the duration of the block in histogram `name`; if `timings` is given, the duration is
+    also stored in it under the `phase` label"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        metric_observe(name, elapsed, **labels)
+        if timings is not None:
+            timings[labels['phase']] = round(elapsed, 6)
+
+
+def timed_handler(command, func):
+    """Wraps a command handler to record its latency in the metrics (and to profile it while a
+    `/profile handlers` run is active)"""
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        start = time.time()
+        try:
+            p = profiling
+            if p is not None and p['mode'] == 'handlers':
+                return profile_call(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            metric_observe('graftbot_handler_seconds', elapsed, command=command)
+            log_event('command', "Handled /%s in %.3fs", command, elapsed, level=logging.DEBUG,
+                    command=command, seconds=elapsed)
+    return wrapped
+
+
+# The active /profile run, if any: { 'mode': 'polls' or 'handlers', 'count': polls to profile,
+# 'until': end of a handlers run, 'chat_id': where to send the results, 'profiles': [...],
+# 'lock': held while a call is being profiled }
+profiling = None
+profiling_lock = threading.Lock()
+
+
+def profile_call(func, *args, **kwargs):
+    """Calls func, profiling it as part of the active /profile run.  Only one call is profiled at a
+    time; calls made while another is being profiled just run normally."""
+    p = profiling
+    if p is not None and p['mode'] == 'handlers' and time.time() >= p['until']:
+        finish_profile(p)
+        p = None
+    if p is None or not p['lock'].acquire(blocking=False):
+        return func(*args, **kwargs)
+    import cProfile
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func, *args, **kwargs)
+    finally:
+        p['profiles'].append(prof)
+        p['lock'].release()
+        if p['mode'] == 'polls' and len(p['profiles']) >= p['count']:
+            finish_profile(p)
+
+
+def finish_profile(p):
+    """Ends profiling run `p`, saves the combined profile and sends the hottest functions to the user
+    that started it"""
+    global profiling
+    with profiling_lock:
+        if profiling is not p:
+            return
+        profiling = None
+
+    if not p['profiles']:
+        updater.bot.send_message(p['chat_id'], "Profiling finished, but nothing ran while profiling 🤷")
+        return
+    import pstats
+    stats = pstats.Stats(p['profiles'][0])
+    for prof in p['profiles'][1:]:
+        stats.add(prof)
+    path = os.path.join(PROFILE_DIR, 'rta-profile-{}-{}.prof'.format(p['mode'], int(time.time())))
+    stats.dump_stats(path)
+
+    stats.sort_stats('cumulative')
+    top = []
+    for func in stats.fcn_list[:20]:
+        cc, nc, tt, ct, callers = stats.stats[func]
+        filename, line, name = func
+        where = name if filename == '~' else '{}:{}({})'.format(os.path.basename(filename), line, name)
+        top.append('{:8.3f} {:8.3f} {:>7} {}'.format(ct, tt, nc, where))
+    msg = "Profiled {} {} — saved to `{}`\n```\n cumtime  tottime   calls function\n{}\n```".format(
+            len(p['profiles']), 'poll cycles' if p['mode'] == 'polls' else 'handler calls', path, '\n'.join(top))
+    metric_inc('graftbot_messages_sent_total', kind='reply')
+    updater.bot.send_message(p['chat_id'], msg, parse_mode=ParseMode.MARKDOWN)
+
+
+def metrics_text():
+    """Renders all metrics in the Prometheus text exposition format"""
+    def fmt_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    with metrics_lock:
+        values = sorted((k, list(v) if isinstance(v, list) else v) for k, v in metric_values.items())
+    lines = []
+    for name, (mtype, mhelp) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(name, mhelp))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for (n, labels), v in values:
+            if n != name:
+                continue
+            if mtype == 'histogram':
+                for b, count in zip(METRIC_BUCKETS, v):
+                    lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, (('le', b),)), count))
+                lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, (('le', '+Inf'),)), v[-2]))
+                lines.append('{}_count{} {}'.format(name, fmt_labels(labels), v[-2]))
+                lines.append('{}_sum{} {}'.format(name, fmt_labels(labels), v[-1]))
+            else:
+                lines.append('{}{} {}'.format(name, fmt_labels(labels), v))
+    return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 makes bursts of connections wait for SYN retries
+    request_queue_size = 128
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(listen, handler):
+    """Starts a threaded HTTP server on `listen` (a (host, port) tuple) in a background thread"""
+    server = ThreadingHTTPServer(listen, handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log_event('startup', "Listening for HTTP requests on %s:%s", *listen)
+    return server
+
+
 eighths = ' ▏▎▍▌▋▊▉█'
 
-def get_dist(results = None):
-    global globalsns, lastresults
+def dist_data(net, results=None, ages=None):
+    """Returns the tier distribution of the SNs currently online, with ROI and uptime counts, as a
+    dict (or None if no staked SN is online).  `results` and `ages` default to the network's last
+    poll."""
+    globalsns = net.globalsns
     if results is None:
-        results = lastresults
+        results, ages = net.lastresults, net.lastages
+    if ages is None:
+        ages = {}
     num_tiers = [0, 0, 0, 0, 0]
     total_balance, total_stakes = 0, 0
     now = time.time()
@@ -238,245 +949,1558 @@ def get_dist(results = None):
 
     num_sns = sum(num_tiers[1:])
     if num_sns == 0:
+        return None
+    stimulus = net.stimulus
+    per_day = stimulus['per_day'] if stimulus else STIMULUS_PER_DAY
+    uptimes = { '2m': 0, '10m': 0, '30m': 0, '1h': 0 }
+    for x in globalsns.values():
+        if not x['last_seen']:
+            continue
+        ago = now - x['last_seen']
+        if ago <= 2*60:
+            uptimes['2m'] += 1
+        elif ago <= 10*60:
+            uptimes['10m'] += 1
+        elif ago <= 30*60:
+            uptimes['30m'] += 1
+        elif ago <= 60*60:
+            uptimes['1h'] += 1
+
+    num_queried = sum(bool(x) for x in results.values())
+    online_on = { 'all': 0, 'most': 0, 'some': 0, 'one': 0 }
+    queried = [(r, TIMEOUT - ages.get(tag, 0)) for tag, r in results.items() if r]
+    for a in globalsns.keys():
+        count = sum(a in r and r[a]['LastUpdateAge'] < timeout for r, timeout in queried)
+        if count == 0:
+            continue
+        key =  ('all' if count == num_queried else
+                'most' if count >= 0.5*num_queried else
+                'some' if count > 1 else 'one')
+        online_on[key] += 1
+
+    return {
+        'tiers': num_tiers,
+        'online_staked': num_sns,
+        'percent': [x / num_sns * 100 for x in num_tiers],
+        'roi': [None] + [per_day * 30 / (len(TIER_COSTS)-1) / n / TIER_COSTS[t] if n else None
+            for t, n in enumerate(num_tiers) if t > 0],
+        'stimulus_per_day': per_day,
+        # Average block time and number of blocks the stimulus was estimated from (None if fixed)
+        'block_time': stimulus['block_time'] if stimulus else None,
+        'stimulus_blocks': stimulus['blocks'] if stimulus else None,
+        'uptimes': uptimes,
+        'online_on': online_on,
+        'stakes': total_balance,
+        'stakes_required': total_stakes,
+    }
+
+
+def get_dist(net, results = None, ages = None):
+    d = dist_data(net, results, ages)
+    if d is None:
         return 'I\'m still starting up; try again later'
-    num_offline = len(globalsns) - num_sns
-    pct_tiers = [x / num_sns * 100 for x in num_tiers]
     global eighths
     blocks = []
-    for i, pct in enumerate(pct_tiers[1:]):
+    for i, pct in enumerate(d['percent'][1:]):
         x = pct * 2
         blocks.append('█' * int(x // 8))
         e = round(x % 8)
         if e > 0:
             blocks[-1] += eighths[e]
-    dist = "*Supernode distribution:*\n"
-    for t, n in enumerate(num_tiers):
+    dist = network_prefix(net.name) + "*Supernode distribution:*\n"
+    for t, n in enumerate(d['tiers']):
         if t == 0:
             continue
-        roi = STIMULUS_PER_DAY * 30 / (len(TIER_COSTS)-1) / n / TIER_COSTS[t]
-        dist += ('T{}: ' + blocks[t-1] + " ({} = {:.1f}%; ROI = {:.2f}%)\n").format(t, n, pct_tiers[t], roi*100)
+        roi = d['roi'][t]
+        dist += ('T{}: ' + blocks[t-1] + " ({} = {:.1f}%; ROI = {})\n").format(t, n, d['percent'][t],
+                '{:.2f}%'.format(roi*100) if roi is not None else '-')
+    num_sns = d['online_staked']
     dist += '{} supernode{} online and staked\n'.format(num_sns, 's' if num_sns != 1 else '')
-    now = time.time()
-    dist += 'Uptimes: *{}* ≤ _2m_, *{}* ≤ _10m_, *{}* ≤ _30m_, *{}* ≤ _1h_\n'.format(
-            sum(bool(x['last_seen'] and now - x['last_seen'] <= 2*60) for x in globalsns.values()),
-            sum(bool(x['last_seen'] and 2*60 < now - x['last_seen'] <= 10*60) for x in globalsns.values()),
-            sum(bool(x['last_seen'] and 10*60 < now - x['last_seen'] <= 30*60) for x in globalsns.values()),
-            sum(bool(x['last_seen'] and 30*60 < now - x['last_seen'] <= 60*60) for x in globalsns.values()),
-            )
-    num_queried = sum(bool(x) for x in results.values())
-    online_on = { 'all': 0, 'most': 0, 'some': 0, 'one': 0 }
-    for a in globalsns.keys():
-        count = sum(a in r and r[a]['LastUpdateAge'] < TIMEOUT for r in results.values() if r)
-        if count == 0:
-            continue
-        key =  ('all' if count == num_queried else
-                'most' if count >= 0.5*num_queried else
-                'some' if count > 1 else 'one')
-        online_on[key] += 1
+    dist += 'Uptimes: *{2m}* ≤ _2m_, *{10m}* ≤ _10m_, *{30m}* ≤ _30m_, *{1h}* ≤ _1h_\n'.format(**d['uptimes'])
 
-    if len(SUPERNODES) > 1:
-        dist += 'Network:\n_{all}_/_{most}_/_{some}_/_{one}_ SNs online on all/most/some/one queried SNs\n'.format(**online_on)
+    if len(net.supernodes) > 1:
+        dist += 'Network:\n_{all}_/_{most}_/_{some}_/_{one}_ SNs online on all/most/some/one queried SNs\n'.format(**d['online_on'])
 
-    if num_tiers[0] > 0:
-        dist += '{} supernode{} online with < T1 stake\n'.format(num_tiers[0], 's' if num_tiers[0] != 1 else '')
-    #dist += '{} supernode{} offline'.format(num_offline, 's' if num_offline != 1 else '')
+    num_unstaked = d['tiers'][0]
+    if num_unstaked > 0:
+        dist += '{} supernode{} online with < T1 stake\n'.format(num_unstaked, 's' if num_unstaked != 1 else '')
 
     dist += '\nOnline stakes: *{}* (*{}* required)'.format(
-            format_balance(total_balance), format_balance(total_stakes))
+            format_balance(d['stakes']), format_balance(d['stakes_required']))
+    if d['block_time'] is not None:
+        dist += '\nStimulus: ~*{}*/day at the pace of the last {} blocks _({:.1f}s/block)_'.format(
+                format_balance(d['stimulus_per_day'] * GRFT), d['stimulus_blocks'], d['block_time'])
     return dist
 
 
+@with_network
 @needs_data
-def show_dist(bot, update, user_data):
-    send_reply(bot, update, get_dist())
+def show_dist(bot, update, user_data, args, net):
+    send_reply(bot, update, get_dist(net))
     if update.message.chat.type != 'private':
         last_summary = time.time()
 
 
-async def get_json_data(urls, timeout=10):
+# The event loop (run by a thread of its own) and HTTP session shared by all of the bot's requests to
+# supernodes and nodes, across all networks; see run_io()
+io_loop = None
+io_session = None
+io_lock = threading.Lock()
+
+
+def run_io(coro):
+    """Runs coroutine `coro` on the shared I/O loop, starting it if needed, and returns its result"""
+    global io_loop
+    import asyncio
+    with io_lock:
+        if io_loop is None:
+            io_loop = asyncio.new_event_loop()
+            threading.Thread(target=io_loop.run_forever, name='io', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, io_loop).result()
+
+
+def stop_io():
+    global io_loop, io_session
+    if io_loop is None:
+        return
+    if io_session is not None:
+        run_io(io_session.close())
+        io_session = None
+    io_loop.call_soon_threadsafe(io_loop.stop)
+    io_loop = None
+
+
+def load_json_decoders():
+    """Returns the JSON decoders available, fastest first, as { name: loads function }.  Each takes
+    bytes (or str) and raises ValueError if it isn't valid JSON."""
+    decoders = {}
+    try:
+        import orjson
+        decoders['orjson'] = orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        decoders['ujson'] = ujson.loads
+    except ImportError:
+        pass
+    decoders['json'] = json.loads
+    return decoders
+
+JSON_DECODERS = load_json_decoders()
+
+
+def json_loads(data):
+    """Decodes a JSON response body with JSON_DECODER, or the fastest decoder available"""
+    return JSON_DECODERS[JSON_DECODER or next(iter(JSON_DECODERS))](data)
+
+
+async def get_json_data(urls, timeout=10, names=None, endpoint='other', concurrency=POLL_CONCURRENCY):
+    """Fetches JSON from each of `urls`, at most `concurrency` at a time, returning a list of results
+    (None for failed requests).  `names` (a tag for each url) and `endpoint` are used to label the
+    request metrics.  Must be run on the shared I/O loop (see run_io)."""
+    global io_session
+    import asyncio
+    import aiohttp
     results = [None] * len(urls)
-    async with aiohttp.ClientSession(read_timeout=timeout) as session:
-        for i in range(len(urls)):
+    if names is None:
+        names = urls
+    if io_session is None:
+        io_session = aiohttp.ClientSession()
+    session = io_session
+    limit = asyncio.Semaphore(concurrency)
+    async def fetch(i):
+        async with limit:
+            start = time.time()
             try:
-                async with session.get(urls[i]) as resp:
-                    results[i] = await resp.json()
-            except json.decoder.JSONDecodeError as a:
-                print("Something getting wrong with JS during json data fetching: {}".format(e))
+                async with session.get(urls[i], timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    resp.raise_for_status()
+                    body = await resp.read()
+                # Decoded whatever the content type: supernodes don't always send a JSON one
+                results[i] = json_loads(body)
+            except ValueError as e:
+                metric_inc('graftbot_fetch_errors_total', host=names[i], endpoint=endpoint)
+                log_event('fetch_error', "Invalid JSON from %s: %s", names[i], e,
+                        level=logging.WARNING, host=names[i], endpoint=endpoint, seconds=time.time() - start)
             except aiohttp.ClientError as e:
-                print("Something getting wrong with client during json data fetching: {}".format(e))
+                metric_inc('graftbot_fetch_errors_total', host=names[i], endpoint=endpoint)
+                log_event('fetch_error', "Something getting wrong with client during json data fetching: %s", e,
+                        level=logging.WARNING, host=names[i], endpoint=endpoint, seconds=time.time() - start)
             except asyncio.TimeoutError as e:
-                print("Timeout during json data fetching: {}".format(e))
+                metric_inc('graftbot_fetch_errors_total', host=names[i], endpoint=endpoint)
+                log_event('fetch_error', "Timeout during json data fetching: %r", e,
+                        level=logging.WARNING, host=names[i], endpoint=endpoint, seconds=time.time() - start)
+            elapsed = time.time() - start
+            metric_observe('graftbot_fetch_seconds', elapsed, host=names[i], endpoint=endpoint)
+            log_event('fetch', "Fetched %s in %.3fs", urls[i], elapsed, level=logging.DEBUG,
+                    host=names[i], endpoint=endpoint, seconds=elapsed, ok=results[i] is not None)
+    await asyncio.gather(*(fetch(i) for i in range(len(urls))))
     return results
 
 
-time_to_die = False
-def rta_updater():
-    global lastresults, lastheight, time_to_die, updater, notifications
-    last = 0
-    first = ANNOUNCE_LIFE
-    last_summary = time.time()
+def expiry_alert_height(expiry, stage):
+    return expiry - EXPIRY_WARNINGS[stage] // BLOCK_TIME
 
-    loop = asyncio.new_event_loop()
 
-    while not time_to_die:
+def schedule_expiry(net, pub, g):
+    """Pushes the next expiry warning still to be sent for SN `pub` onto the network's expiry_alerts"""
+    stage = g.get('expiry_alerted', 0)
+    if g.get('expiry') is not None and stage < len(EXPIRY_WARNINGS):
+        heapq.heappush(net.expiry_alerts, (expiry_alert_height(g['expiry'], stage), g['expiry'], pub, stage))
+
+
+def observe_expiry(net, pub, g, expiry, height):
+    """Updates the stake expiry of SN `pub` and reschedules its warnings if the expiry changed.  When
+    we first see a stake that is already past some warning thresholds only the latest of those is
+    sent, and nothing at all is sent for a stake that has already expired."""
+    if expiry == g.get('expiry'):
+        return
+    g['expiry'] = expiry
+    crossed = 0 if expiry is None else sum(expiry_alert_height(expiry, i) <= height for i in range(len(EXPIRY_WARNINGS)))
+    g['expiry_alerted'] = len(EXPIRY_WARNINGS) if crossed == len(EXPIRY_WARNINGS) else max(crossed - 1, 0)
+    schedule_expiry(net, pub, g)
+
+
+def pop_expiry_alerts(net, height):
+    """Pops the expiry warnings due at `height` and returns them as a list of (pubkey, expiry, stage).
+    If a SN has crossed several thresholds since the last check only the latest one is returned."""
+    expiry_alerts = net.expiry_alerts
+    due = []
+    while expiry_alerts and expiry_alerts[0][0] <= height:
+        _, exp, pub, stage = heapq.heappop(expiry_alerts)
+        g = net.globalsns.get(pub)
+        if g is None or g.get('expiry') != exp or g.get('expiry_alerted', 0) != stage:
+            continue
+        while stage + 1 < len(EXPIRY_WARNINGS) and expiry_alert_height(exp, stage + 1) <= height:
+            stage += 1
+        g['expiry_alerted'] = stage + 1
+        schedule_expiry(net, pub, g)
+        due.append((pub, exp, stage))
+    return due
+
+
+# The block header cache of each network is a file of fixed-size HEADER_REC records, one per block,
+# for a contiguous range of heights ending at the newest block fetched.  It is opened for appending
+# only; only its last STIMULUS_WINDOW records are needed, so it is compacted down to those once it
+# gets much bigger.
+# height, timestamp, reward (atomic units), block hash
+HEADER_REC = struct.Struct('<IIQ32s')
+
+
+def headers_open(net):
+    """Opens the network's header cache and loads the records of the current window"""
+    f = open(net.header_cache_filename, 'a+b')
+    n = os.path.getsize(net.header_cache_filename) // HEADER_REC.size
+    f.seek(max(n - STIMULUS_WINDOW, 0) * HEADER_REC.size)
+    data = f.read((n - max(n - STIMULUS_WINDOW, 0)) * HEADER_REC.size)
+    window = deque((HEADER_REC.unpack_from(data, i) for i in range(0, len(data), HEADER_REC.size)),
+            maxlen=STIMULUS_WINDOW)
+    net.headers = { 'file': f, 'count': n, 'window': window }
+    net.stimulus = stimulus_estimate(window)
+
+
+def fetch_block_headers(net, start, end):
+    """Fetches the headers of blocks `start` to `end` (inclusive) from the network's first node"""
+    import requests
+    node = net.nodes[0]
+    headers = []
+    for first in range(start, end + 1, HEADER_FETCH_BATCH):
+        last = min(first + HEADER_FETCH_BATCH - 1, end)
+        t = time.time()
         try:
-            if time.time() - last < 60:
-                time.sleep(1.0)
+            data = json_loads(requests.post(node[1] + '/json_rpc', timeout=10, json={
+                "jsonrpc":"2.0","id":"0","method":"get_block_headers_range","params":{
+                    "start_height": first, "end_height": last,
+                }
+            }).content)
+            headers.extend(data['result']['headers'])
+        except Exception:
+            metric_inc('graftbot_fetch_errors_total', host=node[0], endpoint='get_block_headers_range')
+            raise
+        finally:
+            metric_observe('graftbot_fetch_seconds', time.time() - t, host=node[0], endpoint='get_block_headers_range')
+    metric_inc('graftbot_headers_fetched_total', len(headers), network=net.name)
+    return headers
+
+
+def update_headers(net, height):
+    """Adds the headers of blocks up to the chain `height` to the network's header cache (backing out
+    cached blocks that have been reorganized away), and updates its stimulus estimate.  At most
+    HEADER_FETCH_BATCH headers are fetched per call; the cache catches up over later calls."""
+    h = net.headers
+    f, window = h['file'], h['window']
+    top = height - 1
+    if window and top - window[-1][0] >= STIMULUS_WINDOW:
+        # Too far behind (e.g. after a long downtime) for any cached block to still be in the window
+        window.clear()
+    while True:
+        if not window and h['count']:
+            h['count'] = 0
+            f.truncate(0)
+        start = window[-1][0] + 1 if window else max(top - STIMULUS_WINDOW + 1, 0)
+        if start > top:
+            break
+        headers = fetch_block_headers(net, start, min(top, start + HEADER_FETCH_BATCH - 1))
+        if window and headers and headers[0]['prev_hash'] != window[-1][3].hex():
+            # A reorg: drop the last few cached blocks and fetch them again
+            drop = min(10, len(window))
+            for _ in range(drop):
+                window.pop()
+            h['count'] -= drop
+            f.truncate(h['count'] * HEADER_REC.size)
+            continue
+        for x in headers:
+            rec = (x['height'], x['timestamp'], x['reward'], bytes.fromhex(x['hash']))
+            f.write(HEADER_REC.pack(*rec))
+            window.append(rec)
+        f.flush()
+        h['count'] += len(headers)
+        break
+
+    if h['count'] > 4 * STIMULUS_WINDOW:
+        f.truncate(0)
+        f.write(b''.join(HEADER_REC.pack(*rec) for rec in window))
+        f.flush()
+        h['count'] = len(window)
+
+    net.stimulus = stimulus_estimate(window)
+    if net.stimulus:
+        metric_set('graftbot_stimulus_per_day', net.stimulus['per_day'], network=net.name)
+
+
+def stimulus_estimate(window):
+    """Estimates the daily stimulus emission (in GRFT) from the average block time over a full window
+    of cached headers (see STIMULUS_PER_BLOCK); returns None if the window isn't full yet"""
+    if len(window) < max(STIMULUS_WINDOW, 2):
+        return None
+    span = window[-1][1] - window[0][1]
+    if span <= 0:
+        return None
+    block_time = span / (len(window) - 1)
+    return {
+        'per_day': STIMULUS_PER_BLOCK * 86400 / block_time,
+        'block_time': block_time,
+        'blocks': len(window),
+    }
+
+
+# The uptime history of each network is stored in its HISTORY_DIR at three levels: a frame per poll,
+# per hour and per day.  Each SN gets a permanent slot number (its line in the 'slots' file).  Each
+# level is made of append-only segments (one per day for polls, one per month for hours, one for
+# days) consisting of a LEVEL[.PERIOD].idx file of fixed-size HISTORY_IDX records and a .dat file
+# with the frame data they point to.  Poll frames are a bitmap of online slots; hour and day frames
+# are a HISTORY_REC per slot.  Poll frames get rolled up into hours, and hours into days, as each
+# period completes.  The history functions take the network's history state (see history_open).
+HISTORY_LEVELS = (
+        # level, frame length, segment name format
+        ('day', 86400, None),
+        ('hour', 3600, '%Y%m'),
+        ('poll', 60, '%Y%m%d'),
+)
+HISTORY_ROLLUPS = { 'poll': ('hour', 3600), 'hour': ('day', 86400) }
+# timestamp, slots, online SNs, online staked SNs (averages, for hour/day frames), data offset
+HISTORY_IDX = struct.Struct('<IIIIQ')
+# uptime (0-65535), tier, flags (1 = SN was known in this period), stake (whole GRFT)
+HISTORY_REC = struct.Struct('<HBBI')
+
+
+def history_segments(h, level):
+    return sorted(os.path.join(h['dir'], f[:-4]) for f in os.listdir(h['dir'])
+            if f.endswith('.idx') and f.split('.')[0] == level)
+
+
+def history_frames(h, level, t0, t1, with_data=True):
+    """Yields (timestamp, slots, online, online_staked, data, offset) for each frame of `level` with
+    t0 <= timestamp < t1.  `data` is an mmap of the segment's frame data (or None if not
+    `with_data`) that is only valid until the next frame is requested."""
+    import mmap
+    for base in history_segments(h, level):
+        n = os.path.getsize(base + '.idx') // HISTORY_IDX.size
+        if n == 0:
+            continue
+        with open(base + '.idx', 'rb') as fi:
+            idx = mmap.mmap(fi.fileno(), n * HISTORY_IDX.size, access=mmap.ACCESS_READ)
+        try:
+            if HISTORY_IDX.unpack_from(idx, (n-1) * HISTORY_IDX.size)[0] < t0 or HISTORY_IDX.unpack_from(idx, 0)[0] >= t1:
                 continue
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if HISTORY_IDX.unpack_from(idx, mid * HISTORY_IDX.size)[0] < t0:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            data = None
+            if with_data and os.path.getsize(base + '.dat') > 0:
+                with open(base + '.dat', 'rb') as fd:
+                    data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in range(lo, n):
+                    ts, slots, online, staked, offset = HISTORY_IDX.unpack_from(idx, i * HISTORY_IDX.size)
+                    if ts >= t1:
+                        break
+                    yield ts, slots, online, staked, data, offset
+            finally:
+                if data is not None:
+                    data.close()
+        finally:
+            idx.close()
+
+
+def history_last(h, level):
+    """Returns the timestamp of the last frame written at `level`, or None"""
+    segs = history_segments(h, level)
+    while segs:
+        n = os.path.getsize(segs[-1] + '.idx') // HISTORY_IDX.size
+        if n > 0:
+            with open(segs[-1] + '.idx', 'rb') as f:
+                f.seek((n-1) * HISTORY_IDX.size)
+                return HISTORY_IDX.unpack(f.read(HISTORY_IDX.size))[0]
+        segs.pop()
+    return None
+
+
+def history_open(net):
+    """Loads the network's SN slots and rebuilds the rollup accumulators from frames not yet rolled up
+    (e.g. from before a restart).  Must be called after its globalsns has been loaded."""
+    os.makedirs(net.history_dir, exist_ok=True)
+    pubs = []
+    if os.path.exists(os.path.join(net.history_dir, 'slots')):
+        with open(os.path.join(net.history_dir, 'slots')) as f:
+            pubs = [x.strip() for x in f if x.strip()]
+    history = {
+            'dir': net.history_dir,
+            'pubs': pubs,
+            'slots': { p: i for i, p in enumerate(pubs) },
+            # Partial frames being rolled up into the next level: { 'start': T, 'n': frames, 'sum': { slot: uptime } }
+            'acc': {},
+            # Latest (tier, stake) of each slot, used for the hour and day frames
+            'state': {},
+    }
+    history['last'] = { level: history_last(history, level) for level, _, _ in HISTORY_LEVELS }
+    for p, g in net.globalsns.items():
+        if p in history['slots']:
+            history['state'][history['slots'][p]] = (g.get('tier') or 0, min(g.get('stake', 0) // GRFT, 0xffffffff))
+
+    # Replay frames that haven't been rolled up yet, coarser levels first
+    for level in ('hour', 'poll'):
+        up, period = HISTORY_ROLLUPS[level]
+        last_up = history['last'][up]
+        since = 0 if last_up is None else last_up + period
+        replay = [(ts, history_frame_values(level, slots, data, offset))
+                for ts, slots, online, staked, data, offset in history_frames(history, level, since, 2**32)]
+        for ts, values in replay:
+            history_accumulate(history, level, ts, values)
+    net.history = history
+
+
+def history_frame_values(level, slots, data, offset):
+    """Decodes a frame into a { slot: uptime } dict"""
+    if level == 'poll':
+        return { s: data[offset + (s >> 3)] >> (s & 7) & 1 for s in range(slots) }
+    values = {}
+    for s in range(slots):
+        up, t, flags, stake = HISTORY_REC.unpack_from(data, offset + s * HISTORY_REC.size)
+        if flags & 1:
+            values[s] = up / 65535
+    return values
+
+
+def history_append(history, level, ts, slots, data, online, staked):
+    fmt = dict((l, f) for l, _, f in HISTORY_LEVELS)[level]
+    base = os.path.join(history['dir'], level + ('.' + time.strftime(fmt, time.gmtime(ts)) if fmt else ''))
+    with open(base + '.dat', 'ab') as f:
+        offset = f.tell()
+        f.write(data)
+    with open(base + '.idx', 'ab') as f:
+        f.write(HISTORY_IDX.pack(int(ts), slots, int(round(online)), int(round(staked)), offset))
+    history['last'][level] = int(ts)
+
+
+def history_accumulate(history, level, ts, values):
+    """Feeds the per-slot uptimes of a `level` frame into the partial frame of the next coarser level,
+    writing that frame out first if `ts` belongs to a later period."""
+    if level not in HISTORY_ROLLUPS:
+        return
+    up, period = HISTORY_ROLLUPS[level]
+    start = int(ts) // period * period
+    acc = history['acc'].get(up)
+    if acc and acc['start'] != start:
+        del history['acc'][up]
+        history_flush(history, up, acc)
+        acc = None
+    if acc is None:
+        acc = history['acc'][up] = { 'start': start, 'n': 0, 'sum': {} }
+    acc['n'] += 1
+    s = acc['sum']
+    for slot, v in values.items():
+        s[slot] = s.get(slot, 0) + v
+
+
+def history_flush(history, level, acc):
+    slots = len(history['pubs'])
+    data = bytearray(slots * HISTORY_REC.size)
+    values = {}
+    online, staked = 0, 0
+    for slot, total in acc['sum'].items():
+        up = total / acc['n']
+        t, stake = history['state'].get(slot, (0, 0))
+        HISTORY_REC.pack_into(data, slot * HISTORY_REC.size, int(up * 65535), t, 1, stake)
+        values[slot] = up
+        online += up
+        if t > 0:
+            staked += up
+    history_append(history, level, acc['start'], slots, data, online, staked)
+    history_accumulate(history, level, acc['start'], values)
+    history_expire(history, acc['start'])
+
+
+def history_expire(history, now):
+    """Deletes poll and hour segments that are entirely older than their retention period"""
+    for level, keep in (('poll', HISTORY_POLL_DAYS), ('hour', HISTORY_HOUR_DAYS)):
+        for base in history_segments(history, level)[:-1]:
+            n = os.path.getsize(base + '.idx') // HISTORY_IDX.size
+            last = None
+            if n > 0:
+                with open(base + '.idx', 'rb') as f:
+                    f.seek((n-1) * HISTORY_IDX.size)
+                    last = HISTORY_IDX.unpack(f.read(HISTORY_IDX.size))[0]
+            if last is None or last < now - keep * 86400:
+                for ext in ('.idx', '.dat'):
+                    os.remove(base + ext)
+
+
+def history_record(net, now):
+    """Appends a poll frame with the current online state of every SN in the network's globalsns"""
+    history, globalsns = net.history, net.globalsns
+    if history['last']['poll'] is not None and int(now) <= history['last']['poll']:
+        return
+    slots, pubs, state = history['slots'], history['pubs'], history['state']
+    new = [p for p in globalsns.keys() if p not in slots]
+    if new:
+        with open(os.path.join(history['dir'], 'slots'), 'a') as f:
+            for p in new:
+                f.write(p + '\n')
+                slots[p] = len(pubs)
+                pubs.append(p)
+
+    bitmap = bytearray((len(pubs) + 7) // 8)
+    values = {}
+    online, staked = 0, 0
+    for p, g in globalsns.items():
+        slot = slots[p]
+        state[slot] = (g.get('tier') or 0, min(g.get('stake', 0) // GRFT, 0xffffffff))
+        values[slot] = 0
+        if 'online_since' in g:
+            bitmap[slot >> 3] |= 1 << (slot & 7)
+            values[slot] = 1
+            online += 1
+            if g['tier']:
+                staked += 1
+    history_append(history, 'poll', now, len(pubs), bitmap, online, staked)
+    history_accumulate(history, 'poll', now, values)
+
+
+def history_pieces(history, t0, t1):
+    """Splits the period from t0 to t1 into (level, start, end) pieces: the oldest part comes from the
+    coarsest level needed to reach back to t0, with finer levels used for the more recent parts."""
+    now = time.time()
+    levels = [l for l in HISTORY_LEVELS]
+    if t0 >= now - HISTORY_POLL_DAYS * 86400:
+        levels = levels[2:]
+    elif t0 >= now - HISTORY_HOUR_DAYS * 86400:
+        levels = levels[1:]
+    pieces = []
+    start = t0
+    for level, period, _ in levels:
+        start = start // period * period
+        last = history['last'][level]
+        end = t1 if level == 'poll' else min(t1, 0 if last is None else last + period)
+        if end > start:
+            pieces.append((level, period, start, end))
+            start = end
+    return pieces
+
+
+def history_bucket_add(sums, t0, t1, ts, period, value):
+    """Adds a frame's value to the [weighted sum, weight] of each of the buckets (equal sub-periods of
+    t0 to t1) it overlaps, weighted by the overlap."""
+    width = (t1 - t0) / len(sums)
+    first = max(int((ts - t0) // width), 0)
+    for i in range(first, len(sums)):
+        b0 = t0 + i * width
+        overlap = min(ts + period, b0 + width) - max(ts, b0)
+        if overlap <= 0:
+            break
+        sums[i][0] += value * overlap
+        sums[i][1] += overlap
+
+
+def history_uptime(history, pub, t0, t1, buckets=24):
+    """Returns the overall uptime fraction of SN `pub` from t0 to t1 along with a list of `buckets`
+    uptimes for equal sub-periods (None where there is no history)"""
+    slot = history['slots'].get(pub)
+    total = [0, 0]
+    sums = [[0, 0] for _ in range(buckets)]
+    for level, period, start, end in history_pieces(history, t0, t1):
+        for ts, slots, online, staked, data, offset in history_frames(history, level, start, end):
+            if slot is None or slot >= slots:
+                up = 0
+            elif level == 'poll':
+                up = data[offset + (slot >> 3)] >> (slot & 7) & 1
+            else:
+                up = HISTORY_REC.unpack_from(data, offset + slot * HISTORY_REC.size)[0] / 65535
+            total[0] += up * period
+            total[1] += period
+            history_bucket_add(sums, t0, t1, ts, period, up)
+    return (total[0] / total[1] if total[1] else None,
+            [x[0] / x[1] if x[1] else None for x in sums])
+
+
+def history_netsize(history, t0, t1, buckets=24):
+    """Returns a list of `buckets` average counts of online staked SNs for equal sub-periods from t0
+    to t1 (None where there is no history).  Only needs the frame indices."""
+    sums = [[0, 0] for _ in range(buckets)]
+    for level, period, start, end in history_pieces(history, t0, t1):
+        for ts, slots, online, staked, data, offset in history_frames(history, level, start, end, with_data=False):
+            history_bucket_add(sums, t0, t1, ts, period, staked)
+    return [x[0] / x[1] if x[1] else None for x in sums]
+
+
+def archive_sn(net, pub):
+    """Moves a SN from the network's globalsns into its archive"""
+    with net.archive_lock:
+        net.archive[pub] = net.globalsns.pop(pub)
+        net.archived.add(pub)
+
+
+def unarchive_sn(net, pub):
+    """Moves a SN from the network's archive back into its globalsns"""
+    with net.archive_lock:
+        g = net.archive.pop(pub)
+        net.archived.discard(pub)
+    net.globalsns[pub] = g
+    schedule_expiry(net, pub, g)
+    return g
+
+
+def get_archived(net, pub):
+    with net.archive_lock:
+        return net.archive.get(pub)
+
+
+# Events emitted by the pollers.  `network` is the name of the network polled, `time` is the time of
+# the poll that produced the event; heights are block heights.
+NewSupernode = namedtuple('NewSupernode', 'network time pubkey wallet tier last_seen')
+TierChanged = namedtuple('TierChanged', 'network time pubkey old_tier new_tier')
+WentOffline = namedtuple('WentOffline', 'network time pubkey last_seen')
+CameOnline = namedtuple('CameOnline', 'network time pubkey offline_since')
+# The stake of a SN is within one of the EXPIRY_WARNINGS of expiring (ExpiryWarning), or has expired
+ExpiryWarning = namedtuple('ExpiryWarning', 'network time pubkey height expiry')
+Expired = namedtuple('Expired', 'network time pubkey height expiry')
+# Emitted after all the other events of a poll
+PollFinished = namedtuple('PollFinished', 'network time height results ages')
+
+
+class Subscriber:
+    """Receives the poller's events on its own thread.  `handler(event)` is called for each event that
+    is one of `types` (any if None) and for which `accept(event)`, if given, is true.  `accept` is
+    called on the polling thread, so should be cheap.  The events of a poll are queued together, so
+    however many SNs a poll reports on (e.g. every SN on the first poll) it takes one slot; up to
+    `maxsize` polls are buffered, beyond that a new poll's events are dropped rather than holding up
+    the poller."""
+    def __init__(self, name, handler, types=None, accept=None, maxsize=100):
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.accept = accept
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='subscriber-' + name, daemon=True)
+
+    def wants(self, event):
+        return (self.types is None or isinstance(event, self.types)) and (self.accept is None or self.accept(event))
+
+    def run(self):
+        while True:
+            events = self.queue.get()
+            try:
+                if events is None:
+                    return
+                for event in events:
+                    try:
+                        self.handler(event)
+                    except Exception:
+                        log_event('subscriber_error', "An exception occured in the %s subscriber", self.name,
+                                level=logging.ERROR, exc_info=True, subscriber=self.name)
+            finally:
+                self.queue.task_done()
+
+
+def subscribe(subscriber):
+    subscribers.append(subscriber)
+    subscriber.thread.start()
+    return subscriber
+
+
+def publish(events):
+    """Hands the events of a poll to every interested subscriber, without waiting for them"""
+    for event in events:
+        metric_inc('graftbot_events_total', type=type(event).__name__)
+    for s in subscribers:
+        wanted = [e for e in events if s.wants(e)]
+        if not wanted:
+            continue
+        try:
+            s.queue.put_nowait(wanted)
+        except queue.Full:
+            before, s.dropped = s.dropped, s.dropped + len(wanted)
+            metric_inc('graftbot_events_dropped_total', len(wanted), subscriber=s.name)
+            # Logged each time the count passes a power of two
+            if before.bit_length() != s.dropped.bit_length():
+                log_event('events_dropped', "The %s subscriber is falling behind; %d events dropped so far",
+                        s.name, s.dropped, level=logging.WARNING, subscriber=s.name, dropped=s.dropped)
+
+
+def flush_events():
+    """Waits until every subscriber has handled all the events published so far, and the messages
+    they queued have been sent"""
+    for s in subscribers:
+        s.queue.join()
+    outbound.join()
+
+
+def stop_subscribers():
+    """Lets each subscriber finish its queued events, then stops it (and then the outbound sender,
+    once it has sent their messages)"""
+    global outbound_thread
+    for s in subscribers:
+        s.queue.put(None)
+    for s in subscribers:
+        s.thread.join()
+    del subscribers[:]
+    if outbound_thread is not None:
+        outbound.put(None)
+        outbound_thread.join()
+        outbound_thread = None
+
+
+# Messages sent by the subscribers (for all networks), waiting to go out: (chat_id, text, kind, time
+# queued)
+outbound = queue.Queue()
+outbound_thread = None
+
+
+def queue_message(chat_id, text, kind):
+    """Queues a Markdown message for the outbound sender, which paces the bot's unprompted messages
+    to stay under telegram's rate limits; `kind` labels the sent messages metric"""
+    outbound.put((chat_id, text, kind, time.time()))
+
+
+def queue_messages(chat_id, blocks, kind, sep='\n', header=''):
+    """Queues rendered Markdown blocks for the outbound sender, packed into as few messages as
+    possible (see pack_messages)"""
+    for text in pack_messages(blocks, sep, header):
+        queue_message(chat_id, text, kind)
+
+
+def outbound_sender():
+    last = 0
+    while True:
+        m = outbound.get()
+        try:
+            if m is None:
+                return
+            if OUTBOUND_RATE:
+                wait = last + 1 / OUTBOUND_RATE - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last = time.monotonic()
+            chat_id, text, kind, queued = m
+            start = time.time()
+            updater.bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
+            metric_inc('graftbot_messages_sent_total', kind=kind)
+            log_event('send', "Sent a %s message to %s", kind, chat_id, level=logging.DEBUG, kind=kind,
+                    chat_id=chat_id, length=len(text), seconds=time.time() - start, queued=start - queued)
+        except Exception as e:
+            log_event('send_error', "An exception occured while sending a %s message: %s", m[2], e,
+                    level=logging.WARNING, kind=m[2], chat_id=m[0])
+        finally:
+            outbound.task_done()
+
+
+def event_message(e):
+    """Returns the Markdown message describing a SN event"""
+    if isinstance(e, NewSupernode):
+        if e.tier > 0:
+            return "💖 New *T{}* supernode appeared: {}".format(e.tier, format_pubkey(e.pubkey))
+        return "💗 New unstaked supernode appeared: {}".format(format_pubkey(e.pubkey))
+    if isinstance(e, TierChanged):
+        if e.new_tier > e.old_tier:
+            if e.old_tier == 0:
+                return "💖 {} activated as a *T{}*".format(format_pubkey(e.pubkey), e.new_tier)
+            return "💰 {} upgraded from *T{}* to *T{}*".format(format_pubkey(e.pubkey), e.old_tier, e.new_tier)
+        if e.new_tier == 0:
+            return "📅 {} expired (was a *T{}*)".format(format_pubkey(e.pubkey), e.old_tier)
+        return "😢 {} downgraded from *T{}* to *T{}*".format(format_pubkey(e.pubkey), e.old_tier, e.new_tier)
+    if isinstance(e, CameOnline):
+        return "💓 {} is back online _(after {})_!".format(format_pubkey(e.pubkey),
+                'unknown' if e.offline_since is None else friendly_ago(e.time - e.offline_since))
+    if isinstance(e, WentOffline):
+        return "💔 {} is offline!".format(format_pubkey(e.pubkey))
+    if isinstance(e, ExpiryWarning):
+        return "⏳ The stake for {} expires in ~{} _(block {})_".format(
+                format_pubkey(e.pubkey), friendly_minutes(max(e.expiry - e.height, 0) * BLOCK_TIME // 60), e.expiry)
+    if isinstance(e, Expired):
+        return "📅 The stake for {} has expired _(block {})_".format(format_pubkey(e.pubkey), e.expiry)
+
+
+SN_EVENTS = (NewSupernode, TierChanged, CameOnline, WentOffline)
+EXPIRY_EVENTS = (ExpiryWarning, Expired)
+
+
+def group_updates(net, announce=False):
+    """Subscriber sending the SN events of each of the network's polls to its SEND_TO as a single
+    message.  If `announce` is set, the first message starts with an "I'm alive" line."""
+    alive = announce
+    lines = []
+    def handle(e):
+        nonlocal alive
+        if not isinstance(e, PollFinished):
+            lines.append(event_message(e))
+            return
+        msg = (["I'm alive! 🍚 🍅 🍏"] if alive else []) + lines
+        del lines[:]
+        if not msg:
+            return
+        queue_messages(net.send_to, msg, 'update', header=network_header(net.name))
+        alive = False
+    return Subscriber(net.name + '-updates', handle, types=SN_EVENTS + (PollFinished,),
+            accept=lambda e: e.network == net.name)
+
+
+def tracking_updates():
+    """Subscriber sending SN and stake expiry events to the users tracking the SN; each user gets the
+    events of a poll packed into as few messages as possible"""
+    pending = {}
+    def handle(e):
+        if isinstance(e, PollFinished):
+            for uid, lines in pending.pop(e.network, {}).items():
+                queue_messages(uid, lines, 'tracking', header=network_header(e.network))
+            return
+        msg = event_message(e)
+        for uid in list(notifications.get(e.pubkey, ())):
+            pending.setdefault(e.network, {}).setdefault(uid, []).append(msg)
+    return Subscriber('tracking', handle, types=SN_EVENTS + EXPIRY_EVENTS + (PollFinished,),
+            accept=lambda e: isinstance(e, PollFinished) or e.pubkey in notifications)
+
+
+def summaries(net):
+    """Subscriber sending the network's tier distribution to its SEND_TO (and SEND_DIST_TO) every
+    SUMMARY_FREQUENCY"""
+    last_summary = None
+    def handle(e):
+        nonlocal last_summary
+        if last_summary is None:
+            last_summary = e.time
+        if e.time - last_summary < SUMMARY_FREQUENCY:
+            return
+        last_summary = e.time
+        msg = get_dist(net, e.results, e.ages)
+        for chat in (net.send_to, net.send_dist_to) if net.send_dist_to and net.send_dist_to != net.send_to else (net.send_to,):
+            queue_messages(chat, [msg], 'summary')
+    return Subscriber(net.name + '-summaries', handle, types=PollFinished, accept=lambda e: e.network == net.name)
+
+
+def start_subscribers():
+    """Subscribes the bot's own consumers of poll events, and starts the outbound sender"""
+    global outbound_thread
+    outbound_thread = threading.Thread(target=outbound_sender, name='outbound', daemon=True)
+    outbound_thread.start()
+    for net in networks.values():
+        subscribe(group_updates(net, announce=ANNOUNCE_LIFE))
+        subscribe(summaries(net))
+        if API_LISTEN:
+            subscribe(Subscriber(net.name + '-api', partial(api_update, net), types=PollFinished,
+                accept=lambda e, net=net: e.network == net.name, maxsize=1))
+    subscribe(tracking_updates())
+
+
+# Each network's `api` is the JSON API's view of it as of its last poll (see api_update), or None
+# before the first poll: { 'generation': N, 'etag': ..., 'docs': { name: JSON bytes }, 'pubkeys':
+# [sorted pubkeys], 'sns': { pubkey: JSON bytes }, 'cache': { (path or (path, offset, limit), gzipped): body } }
+api_lock = threading.Lock()
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+
+def api_sn(pub, g, results, ages):
+    """The API's consensus view of a SN"""
+    return {
+        'pubkey': pub,
+        'tier': g.get('tier'),
+        'stake': g.get('stake'),
+        'wallet': g.get('wallet'),
+        'last_seen': g.get('last_seen'),
+        'online': 'online_since' in g,
+        'online_since': g.get('online_since'),
+        'offline_since': g.get('offline_since'),
+        'expiry': g.get('expiry'),
+        'online_on': [tag for tag, r in results.items()
+            if r and pub in r and r[pub]['LastUpdateAge'] + ages.get(tag, 0) < TIMEOUT],
+    }
 
-            lastheight = requests.get(NODES[0][1] + '/getheight', timeout=5).json()['height']
 
-            results = loop.run_until_complete(get_json_data([
-                sn[1] + '/debug/supernode_list/1' for sn in SUPERNODES]))
+def api_update(net, e):
+    """Rebuilds the API's documents after each of the network's polls; everything is serialized here
+    once, so requests only have to slice and concatenate"""
+    generation = net.api['generation'] + 1 if net.api else 1
+    sns = { p: json.dumps(api_sn(p, g, e.results, e.ages)).encode() for p, g in list(net.globalsns.items()) }
+    status = {
+        'network': net.name,
+        'generation': generation,
+        'time': e.time,
+        'height': e.height,
+        'node_heights': net.node_heights,
+        'supernodes': [sn[0] for sn in net.supernodes],
+        'sns': len(sns),
+        'archived': len(net.archived),
+    }
+    docs = {
+        'status': json.dumps(status).encode(),
+        'dist': json.dumps(dist_data(net, e.results, e.ages)).encode(),
+        'snodes': json.dumps({ tag: snode_counts(r, e.ages.get(tag, 0)) if r else None
+            for tag, r in e.results.items() }).encode(),
+    }
+    snapshot = { 'generation': generation, 'etag': 'W/"{}-{}"'.format(int(e.time), generation), 'docs': docs,
+            'pubkeys': sorted(sns), 'sns': sns, 'cache': {} }
+    with api_lock:
+        net.api = snapshot
+
+
+def api_page(snapshot, offset, limit):
+    """Returns a page of the SN list"""
+    pubkeys = snapshot['pubkeys'][offset:offset+limit]
+    return b''.join((
+        '{{"generation": {}, "total": {}, "offset": {}, "limit": {}, "items": ['.format(
+            snapshot['generation'], len(snapshot['pubkeys']), offset, limit).encode(),
+        b', '.join(snapshot['sns'][p] for p in pubkeys),
+        b']}'))
+
+
+def accepts_gzip(accept_encoding):
+    """Returns whether an Accept-Encoding header value accepts gzip: named (or covered by *) with a
+    non-zero q-value"""
+    q = {}
+    for coding in accept_encoding.split(','):
+        name, *params = coding.split(';')
+        weight = 1.0
+        for param in params:
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    weight = float(v)
+                except ValueError:
+                    weight = 0.0
+        q[name.strip().lower()] = weight
+    return q.get('gzip', q.get('x-gzip', q.get('*', 0))) > 0
+
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the bot's view of the first network as of its last poll, as JSON (and that of other
+    networks at /api/NETWORK/..., e.g. /api/testnet/status):
+    /api/status - poll generation, time and height, and the heights of all NODES
+    /api/dist - tier distribution, as in /dist
+    /api/snodes - SN counts as seen by each of SUPERNODES, as in /snodes
+    /api/sns?offset=N&limit=M - the SNs' consensus state, a page at a time, ordered by pubkey
+    /api/sns/PUBKEY - a single SN (including archived ones)
+    Responses carry an ETag that changes with each poll, honour If-None-Match, and are gzipped for
+    clients that accept it."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        import gzip
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip('/')
+        net = primary_network()
+        parts = path.split('/', 3)
+        if len(parts) > 2 and parts[1] == 'api' and parts[2].lower() in networks:
+            net = networks[parts[2].lower()]
+            path = '/api' + ('/' + parts[3] if len(parts) > 3 else '')
+        with api_lock:
+            snapshot = net.api
+        if path in ('/api/status', '/api/dist', '/api/snodes', '/api/sns'):
+            endpoint = path
+        elif path.startswith('/api/sns/'):
+            endpoint = '/api/sns/PUBKEY'
+        else:
+            return self.reply('other', 404, b'{"error": "not found"}')
+        if snapshot is None:
+            return self.reply(endpoint, 503, b'{"error": "still starting up"}')
+
+        # Resolve the request fully before looking at If-None-Match, so that only documents that exist
+        # get a 304
+        key, body = path, None
+        if path == '/api/sns':
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                offset = min(max(int(query.get('offset', ['0'])[0]), 0), len(snapshot['pubkeys']))
+                limit = min(max(int(query.get('limit', [str(API_PAGE_SIZE)])[0]), 1), API_MAX_PAGE_SIZE)
+            except ValueError:
+                return self.reply(endpoint, 400, b'{"error": "bad offset or limit"}')
+            # Only pages on API_PAGE_SIZE boundaries are cached, so that clients can't grow the cache
+            # without limit by asking for every possible (offset, limit)
+            key = (path, offset, limit) if offset % API_PAGE_SIZE == 0 and limit % API_PAGE_SIZE == 0 else None
+        elif path.startswith('/api/sns/') and path[9:] not in snapshot['sns']:
+            g = get_archived(net, path[9:]) if path[9:] in net.archived else None
+            if g is None:
+                return self.reply(endpoint, 404, b'{"error": "not found"}')
+            # Not cached: archived SNs are looked up rarely, and arbitrary keys shouldn't grow the cache
+            key, body = None, json.dumps(dict(api_sn(path[9:], g, {}, {}), archived=True)).encode()
+
+        if snapshot['etag'] in (t.strip() for t in self.headers.get('If-None-Match', '').split(',')):
+            return self.reply(endpoint, 304, b'', snapshot)
+
+        gzipped = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        cached = snapshot['cache'].get((key, gzipped)) if key is not None else None
+        if cached is not None:
+            return self.reply(endpoint, 200, cached, snapshot, gzipped)
+        if body is None:
+            if path == '/api/sns':
+                body = api_page(snapshot, offset, limit)
+            elif path.startswith('/api/sns/'):
+                body = snapshot['sns'][path[9:]]
+            else:
+                body = snapshot['docs'][path[5:]]
+        if gzipped:
+            body = gzip.compress(body, 6)
+        if key is not None:
+            snapshot['cache'][(key, gzipped)] = body
+        self.reply(endpoint, 200, body, snapshot, gzipped)
+
+    def reply(self, endpoint, code, body, snapshot=None, gzipped=False):
+        metric_inc('graftbot_api_requests_total', endpoint=endpoint, status=code)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if snapshot:
+            self.send_header('ETag', snapshot['etag'])
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_supernodes_file(net):
+    """Re-reads the network's SUPERNODES_FILE into its supernodes if it has changed"""
+    mtime = os.stat(net.supernodes_file).st_mtime
+    if mtime == net.supernodes_file_mtime:
+        return
+    known = set(sn[0] for sn in net.base_supernodes)
+    extra = []
+    with open(net.supernodes_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and not fields[0].startswith('#') and fields[0] not in known:
+                known.add(fields[0])
+                extra.append((fields[0], fields[1].rstrip('/')))
+    net.supernodes = net.base_supernodes + extra
+    net.supernodes_file_mtime = mtime
+    log_event('supernodes_file', "Loaded %d supernodes from %s", len(extra), net.supernodes_file,
+            network=net.name, supernodes=len(extra))
+
+
+def supernode_stratum(sn):
+    """The group a supernode is sampled from: its host, so that a sample is spread across hosts"""
+    return urllib.parse.urlsplit(sn[1]).hostname
+
+
+def poll_sample(net):
+    """Picks the POLL_SAMPLE_SIZE supernodes of the network to poll this cycle.  Each host's
+    supernodes are polled in rotation, with each host getting a share of the sample proportional to
+    its number of supernodes (fractions of a share carry over to the next cycle, so small hosts get
+    their turn too)."""
+    supernodes, sample_credit, sample_cursor = net.supernodes, net.sample_credit, net.sample_cursor
+    strata = {}
+    for sn in supernodes:
+        strata.setdefault(supernode_stratum(sn), []).append(sn)
+    size = min(net.poll_sample_size, len(supernodes))
+    counts = {}
+    for st, sns in strata.items():
+        sample_credit[st] = sample_credit.get(st, 0) + size * len(sns) / len(supernodes)
+        counts[st] = max(min(int(sample_credit[st]), len(sns)), 0)
+    # Carried-over credit can add up to more or less than the sample: take the excess from the hosts
+    # owed least, and hand out the remaining slots to hosts with supernodes left, owed most first
+    while sum(counts.values()) > size:
+        st = min((st for st in strata if counts[st] > 0), key=lambda st: sample_credit[st] - counts[st])
+        counts[st] -= 1
+    while sum(counts.values()) < size:
+        left = sorted((st for st in strata if counts[st] < len(strata[st])),
+                key=lambda st: sample_credit[st] - counts[st], reverse=True)
+        for st in left[:size - sum(counts.values())]:
+            counts[st] += 1
+    sample = []
+    for st, sns in strata.items():
+        sample_credit[st] -= counts[st]
+        start = sample_cursor.get(st, 0) % len(sns)
+        sample.extend(sns[(start + i) % len(sns)] for i in range(counts[st]))
+        sample_cursor[st] = start + counts[st]
+    return sample
+
+
+def fetch_poll(net):
+    """Fetches the current height and the supernode lists of all of the network's supernodes (or of
+    this cycle's sample of them).  Returns the height, the tags of the supernodes polled and the list
+    of their raw responses (None for supernodes that failed)."""
+    import requests
+    node = net.nodes[0]
+    start = time.time()
+    try:
+        height = json_loads(requests.get(node[1] + '/getheight', timeout=5).content)['height']
+    except Exception:
+        metric_inc('graftbot_fetch_errors_total', host=node[0], endpoint='getheight')
+        raise
+    finally:
+        metric_observe('graftbot_fetch_seconds', time.time() - start, host=node[0], endpoint='getheight')
+
+    if net.supernodes_file:
+        try:
+            load_supernodes_file(net)
+        except Exception as e:
+            log_event('supernodes_file_error', "Unable to load %s: %s", net.supernodes_file, e,
+                    level=logging.WARNING, network=net.name)
+    polled = poll_sample(net) if net.poll_sample_size else net.supernodes
+    raw = run_io(get_json_data([
+        sn[1] + '/debug/supernode_list/1' for sn in polled],
+        names=[sn[0] for sn in polled], endpoint='supernode_list'))
+    return height, [sn[0] for sn in polled], raw
+
+
+def fetch_node_heights(net):
+    """Updates the network's node_heights with the current height of each of its nodes (None if it
+    didn't respond)"""
+    results = run_io(get_json_data([n[1] + '/getheight' for n in net.nodes], timeout=2,
+        names=[n[0] for n in net.nodes], endpoint='getheight'))
+    net.node_heights = { n[0]: r['height'] if r else None for n, r in zip(net.nodes, results) }
+
+
+def parse_poll(tags, raw):
+    """Turns the raw supernode list responses into a dict of { SN tag: { pubkey: item } } (with None
+    for supernodes that didn't return anything)"""
+    return dict(zip(
+        tags,
+        ({ x['PublicId']: x for x in r['result']['items'] } if r else None for r in raw)
+    ))
+
+
+def merge_observations(net, results, now):
+    """Adds a sampled poll's results to the network's recent observations, and returns the merged
+    view: a results dict for all of its supernodes (None where there is no current observation), a
+    dict of the weight each supernode's observation carries, from 1 for this cycle's down to 0 at
+    OBSERVATION_MAX_AGE, and a dict of the age of each older observation, which its items'
+    LastUpdateAge must be increased by.  The observed lists themselves are passed on as they are."""
+    observations = net.observations
+    for tag, stats in results.items():
+        if stats:
+            observations[tag] = (now, stats)
+    merged, weights, ages = {}, {}, {}
+    for sn in net.supernodes:
+        tag = sn[0]
+        if tag not in observations:
+            merged[tag] = None
+            continue
+        seen, stats = observations[tag]
+        age = now - seen
+        if age >= OBSERVATION_MAX_AGE:
+            del observations[tag]
+            merged[tag] = None
+            continue
+        merged[tag] = stats
+        weights[tag] = 1 - age / OBSERVATION_MAX_AGE
+        if age:
+            ages[tag] = age
+    for tag in list(observations):
+        if tag not in merged:
+            del observations[tag]
+    metric_set('graftbot_observed_supernodes', len(weights), network=net.name)
+    return merged, weights, ages
+
+
+# The fields of a SN that supernodes are expected to agree on, with how to get each from a list item
+DISAGREE_FIELDS = (
+        ('stake', lambda x: x['StakeAmount']),
+        ('wallet', lambda x: x['Address']),
+        ('expiry', lambda x: stake_expiry(x)),
+)
+
+
+def sn_disagreement(p, results):
+    """Returns what the supernodes listing SN `p` disagree about: { field: (majority value, { tag:
+    value }) }, giving the value most of them have and the tags and values of the ones that differ"""
+    d = {}
+    for field, get in DISAGREE_FIELDS:
+        values = { tag: get(stats[p]) for tag, stats in results.items() if stats and p in stats }
+        counts = {}
+        for v in values.values():
+            counts[v] = counts.get(v, 0) + 1
+        if len(counts) > 1:
+            majority = max(counts, key=counts.get)
+            d[field] = (majority, { tag: v for tag, v in values.items() if v != majority })
+    return d
+
+
+def set_disagreement(net, p, d):
+    """Replaces the network's disagreement index entry for SN `p` with `d` (see sn_disagreement; empty
+    if they all agree), keeping the per-supernode counts in disagree_counts ({ tag: { field: SNs } })
+    up to date"""
+    old = net.disagreements.get(p)
+    if not old and not d:
+        return
+    counts = net.disagree_counts
+    for entry, delta in ((old, -1), (d, 1)):
+        for field, (_, outliers) in (entry or {}).items():
+            for tag in outliers:
+                c = counts.setdefault(tag, {})
+                c[field] = c.get(field, 0) + delta
+                if not c[field]:
+                    del c[field]
+                    if not c:
+                        del counts[tag]
+    if d:
+        net.disagreements[p] = d
+    else:
+        del net.disagreements[p]
 
-            results = dict(zip(
-                (s[0] for s in SUPERNODES),
-                ({ x['PublicId']: x for x in r['result']['items'] } if r else None for r in results)
-            ))
 
-            if not any(results.values()):
-                print("Something getting very wrong: all SNs returned nothing!")
-                time.sleep(3)
+# The orders SNs can be listed in (/top, /list): order -> (title, how to get a SN's sort key from its
+# (stake, tier, online_since, offline_since) state, None leaving it out of the list)
+RANK_ORDERS = {
+        'stake': ('Biggest stakes', lambda s: -s[0] if s[0] else None),
+        'online': ('Longest online', lambda s: s[2]),
+        'offline': ('Longest offline', lambda s: s[3]),
+}
+
+RANK_PAGE_SIZE = 20
+
+
+def rank_entries(state):
+    """Returns the (index, key) entries of a SN with the given state in the ranked indexes, where an
+    index is (order, tier), with tier None for the index over all tiers"""
+    entries = []
+    for order, (_, key) in RANK_ORDERS.items():
+        k = key(state)
+        if k is not None:
+            entries.append(((order, None), k))
+            if state[1] is not None:
+                entries.append(((order, state[1]), k))
+    return entries
+
+
+def update_ranks(net, p, g):
+    """Moves SN `p` to its place in the network's ranked indexes (net.ranks: { (order, tier): [(key,
+    pubkey), ...] }, each kept sorted) if its stake, tier or online/offline time changed since it was
+    last indexed.  `g` is None to take the SN out of the indexes."""
+    state = None if g is None else (g.get('stake'), g.get('tier'), g.get('online_since'), g.get('offline_since'))
+    old = net.rank_state.get(p)
+    if state == old:
+        return
+    ranks = net.ranks
+    if old is not None:
+        for index, k in rank_entries(old):
+            items = ranks[index]
+            i = bisect.bisect_left(items, (k, p))
+            if i < len(items) and items[i] == (k, p):
+                del items[i]
+    if state is not None:
+        for index, k in rank_entries(state):
+            bisect.insort(ranks.setdefault(index, []), (k, p))
+        net.rank_state[p] = state
+    else:
+        del net.rank_state[p]
+
+
+def reconcile(net, results, now, weights=None, ages=None):
+    """Updates the network's globalsns with the results of a poll and returns the resulting events:
+    NewSupernode, TierChanged, CameOnline and WentOffline, in that order.  `weights` gives the weight
+    of each supernode's results towards ONLINE_MIN_COUNT (1 for any not in it), and `ages` how many
+    seconds to add to the LastUpdateAge of its items (0 for any not in it)."""
+    globalsns, archived, name = net.globalsns, net.archived, net.name
+
+    new_pub = set()
+    new_sns = []
+    timeouts = []
+    returns = []
+    tier_changes = []
+    went_offline = set()
+    offline_since = {}
+    to_archive = []
+
+    if weights is None:
+        weights = {}
+    if ages is None:
+        ages = {}
+    returning = {}
+    for sn_tag, stats in results.items():
+        if not stats:
+            continue
+        for p, x in stats.items():
+            if p in archived:
+                if x['LastUpdateAge'] + ages.get(sn_tag, 0) < TIMEOUT:
+                    returning[p] = returning.get(p, 0) + weights.get(sn_tag, 1)
+            elif p not in globalsns:
+                globalsns[p] = {}
+                new_pub.add(p)
+    for p, count in returning.items():
+        if count >= ONLINE_MIN_COUNT:
+            unarchive_sn(net, p)
+            log_event('restored', "Restored %s from the %s archive", p, name, network=name, pubkey=p)
+
+    for p, g in globalsns.items():
+        for k in ('last_seen', 'tier'):
+            if k not in g:
+                g[k] = None
+
+        count_online = 0
+        best_age = None
+        biggest_stake = None
+        wallet = None
+        expiry = None
+        first = None
+        differs = False
+        for sn_tag, stats in results.items():
+            if not stats or p not in stats:
                 continue
+            x = stats[p]
+            if first is None:
+                first = x
+            elif not differs and (x['StakeAmount'] != first['StakeAmount'] or x['Address'] != first['Address'] or
+                    stake_expiry(x) != stake_expiry(first)):
+                differs = True
+            age = x['LastUpdateAge'] + ages.get(sn_tag, 0)
+            if age < TIMEOUT:
+                count_online += weights.get(sn_tag, 1)
+            if best_age is None or age < best_age:
+                best_age = age
+            stake = stats[p]['StakeAmount']
+            if biggest_stake is None or stake > biggest_stake:
+                biggest_stake = stake
+                wallet = stats[p]['Address']
+                expiry = stake_expiry(stats[p])
+        seen = None if best_age is None or best_age > 1000000000 or count_online < ONLINE_MIN_COUNT else now - best_age
+        if seen and (g['last_seen'] is None or seen > g['last_seen']):
+            g['last_seen'] = seen
+        if biggest_stake is not None:
+            g['stake'] = biggest_stake
+            t = tier(biggest_stake)
+            if g['tier'] != t and g['tier'] is not None:
+                tier_changes.append(TierChanged(name, now, p, g['tier'], t))
+            g['tier'] = tier(biggest_stake)
+            g['wallet'] = wallet
+            observe_expiry(net, p, g, expiry, net.lastheight)
+        set_disagreement(net, p, sn_disagreement(p, results) if differs else None)
+
+        if g['last_seen'] is None or g['last_seen'] < now - TIMEOUT or count_online < ONLINE_MIN_COUNT:
+            if 'online_since' in g:
+                del g['online_since']
+                went_offline.add(p)
+            if 'offline_since' not in g:
+                g['offline_since'] = now if g['last_seen'] is None else g['last_seen'] + TIMEOUT
+            elif ARCHIVE_AFTER and g['offline_since'] < now - ARCHIVE_AFTER:
+                to_archive.append(p)
+        else:
+            if 'offline_since' in g:
+                offline_since[p] = g.pop('offline_since')
+            if 'online_since' not in g:
+                g['online_since'] = g['last_seen']
+        update_ranks(net, p, g)
+
+        seen = g['last_seen']
+        if p in new_pub:
+            if seen is not None and now - seen < TIMEOUT:
+                new_sns.append(NewSupernode(name, now, p, wallet, g['tier'], seen))
+            continue
+        elif p in offline_since:
+            returns.append(CameOnline(name, now, p, offline_since[p]))
+        elif p in went_offline:
+            timeouts.append(WentOffline(name, now, p, seen))
+
+    if net.history is not None:
+        history_record(net, now)
+
+    for p in to_archive:
+        archive_sn(net, p)
+        set_disagreement(net, p, None)
+        update_ranks(net, p, None)
+    if to_archive:
+        log_event('archived', "Archived %d long-offline %s SN%s", len(to_archive), name, '' if len(to_archive) == 1 else 's',
+                network=name, count=len(to_archive))
+
+    return new_sns + tier_changes + returns + timeouts
+
+
+def capture_poll(net, now, height, tags, raw):
+    """Appends a poll's height and raw supernode responses to the day's capture log in the network's
+    CAPTURE_DIR"""
+    import lzma
+    os.makedirs(net.capture_dir, exist_ok=True)
+    path = os.path.join(net.capture_dir, 'polls-{}.jsonl.xz'.format(time.strftime('%Y%m%d', time.gmtime(now))))
+    # Each poll is appended as a separate xz stream; its large window makes the mostly identical
+    # responses from different supernodes compress well.
+    with lzma.open(path, 'at', preset=1) as f:
+        f.write(json.dumps({ 'time': now, 'height': height, 'supernodes': tags,
+            'responses': raw }) + '\n')
+
+
+def rta_poll(net):
+    """Runs a single poll cycle of the network.  Returns False if none of the supernodes returned
+    anything."""
+    with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='fetch', network=net.name):
+        height, tags, raw = fetch_poll(net)
+        if API_LISTEN:
+            fetch_node_heights(net)
+    if net.headers is not None:
+        with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='headers', network=net.name):
+            try:
+                update_headers(net, height)
+            except Exception as e:
+                log_event('headers_error', "An exception occured while updating the %s header cache: %s", net.name, e,
+                        level=logging.WARNING, exc_info=True, network=net.name)
+    now = time.time()
+
+    if net.capture_dir:
+        try:
+            capture_poll(net, now, height, tags, raw)
+        except Exception as e:
+            log_event('capture_error', "An exception occured while capturing the poll: %s", e,
+                    level=logging.WARNING, exc_info=True, network=net.name)
+
+    return process_poll(net, height, tags, raw, now)
+
+
+def expiry_events(net, height, now):
+    """Pops the network's expiry warnings due at `height` and returns them as ExpiryWarning and Expired
+    events.  A SN whose stake has already dropped it to tier 0 gets no Expired event: reconcile()
+    reports that as a TierChanged, which tells the same trackers the same thing."""
+    events = []
+    for p, exp, stage in pop_expiry_alerts(net, height):
+        if EXPIRY_WARNINGS[stage] > 0:
+            events.append(ExpiryWarning(net.name, now, p, height, exp))
+        elif net.globalsns[p].get('tier') != 0:
+            events.append(Expired(net.name, now, p, height, exp))
+    return events
+
+
+def process_poll(net, height, tags, raw, now):
+    """Runs the fetched results of a poll of the network through parsing and reconciliation, and
+    publishes the resulting events.  Returns False if none of the supernodes returned anything."""
+    net.lastheight = height
+    with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='parse', network=net.name):
+        results = parse_poll(tags, raw)
+
+    if not any(results.values()):
+        log_event('poll_empty', "Something getting very wrong: all %s SNs returned nothing!", net.name,
+                level=logging.WARNING, network=net.name)
+        return False
+
+    weights, ages = None, {}
+    if net.poll_sample_size:
+        with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='merge', network=net.name):
+            results, weights, ages = merge_observations(net, results, now)
+
+    with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='reconcile', network=net.name):
+        events = reconcile(net, results, now, weights, ages)
+
+    with metric_timer('graftbot_poll_seconds', net.poll_timings, phase='notify', network=net.name):
+        if height != net.last_alert_height:
+            events += expiry_events(net, height, now)
+            net.last_alert_height = height
+        net.lastages = ages
+        net.lastresults = results
+        events.append(PollFinished(net.name, now, height, results, ages))
+        publish(events)
+    metric_set('graftbot_globalsns_entries', len(net.globalsns), network=net.name)
+    metric_set('graftbot_archived_entries', len(net.archived), network=net.name)
+    metric_set('graftbot_disagreements', len(net.disagreements), network=net.name)
+    metric_set('graftbot_lastresults_records', sum(len(r) for r in results.values() if r), network=net.name)
+    return True
+
+
+# How long each phase of starting up took, in seconds, and when (in seconds since the bot started
+# loading) it reached each milestone ('answering' commands, 'ready' once every network has been polled)
+startup_timings = {}
+startup_milestones = {}
+startup_lock = threading.Lock()
+
+
+@contextmanager
+def startup_phase(name):
+    """Times a phase of starting up, for the startup report"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.time() - start
 
-            now = time.time()
-            last = now
-
-            # Each of these contain: { 'addr': 'F...', 'age': 123, 'tier': [0-4], 'old_tier': [0-4] }
-            # (old_tier is only set if the SN was seen last time and the tier has changed)
-            new_pub = set() 
-            new_sns = []
-            timeouts = []
-            returns = []
-            tier_was = {}
-            went_offline = set()
-            came_online_after = {}
-
-            for sn in SUPERNODES:
-                stats = results[sn[0]]
-                if not stats:
-                    continue
-                for p in stats.keys():
-                    if p not in globalsns:
-                        globalsns[p] = {}
-                        new_pub.add(p)
-
-            for p, g in globalsns.items():
-                for k in ('last_seen', 'tier'):
-                    if k not in g:
-                        g[k] = None
-
-                count_online = 0
-                best_age = None
-                biggest_stake = None
-                wallet = None
-                for sn in SUPERNODES:
-                    sn_tag = sn[0]
-                    stats = results[sn_tag]
-                    if not stats or p not in stats:
-                        continue
-                    age = stats[p]['LastUpdateAge']
-                    if age < TIMEOUT:
-                        count_online += 1
-                    if best_age is None or age < best_age:
-                        best_age = age
-                    stake = stats[p]['StakeAmount']
-                    if biggest_stake is None or stake > biggest_stake:
-                        biggest_stake = stake
-                        wallet = stats[p]['Address']
-                seen = None if best_age is None or best_age > 1000000000 or count_online < ONLINE_MIN_COUNT else now - best_age
-                if seen and (g['last_seen'] is None or seen > g['last_seen']):
-                    g['last_seen'] = seen
-                if biggest_stake is not None:
-                    g['stake'] = biggest_stake
-                    t = tier(biggest_stake)
-                    if g['tier'] != t and g['tier'] is not None:
-                        tier_was[p] = g['tier']
-                    g['tier'] = tier(biggest_stake)
-                    g['wallet'] = wallet
-
-                if g['last_seen'] is None or g['last_seen'] < now - TIMEOUT or count_online < ONLINE_MIN_COUNT:
-                    if 'online_since' in g:
-                        del g['online_since']
-                        went_offline.add(p)
-                    if 'offline_since' not in g:
-                        g['offline_since'] = now if g['last_seen'] is None else g['last_seen'] + TIMEOUT
-                else:
-                    if 'offline_since' in g:
-                        came_online_after[p] = now - g['offline_since']
-                        del g['offline_since']
-                    if 'online_since' not in g:
-                        g['online_since'] = g['last_seen']
-
-                seen, t = g['last_seen'], g['tier']
-                age = None if seen is None else now - seen
-                row = { 'pubkey': p, 'wallet': wallet, 'age': age, 'tier': t }
-                if p in new_pub:
-                    if age is not None and age < TIMEOUT:
-                        new_sns.append(row)
-                    continue
-                elif p in came_online_after:
-                    returns.append(row)
-                elif p in went_offline:
-                    timeouts.append(row)
-
-            updates = []
-            def add_update(pubkey, msg):
-                updates.append(msg)
-                if pubkey in notifications:
-                    for uid in notifications[pubkey]:
-                        updater.bot.send_message(uid, msg, parse_mode=ParseMode.MARKDOWN)
 
+def startup_milestone(name):
+    """Records that startup reached milestone `name`, and logs the startup report so far"""
+    with startup_lock:
+        if name in startup_milestones:
+            return
+        startup_milestones[name] = time.time() - load_started
+        log_event('startup_report', "Startup: %s after %.3fs (%s)", name, startup_milestones[name],
+                ', '.join('{} {:.3f}s'.format(k, v) for k, v in startup_timings.items()),
+                milestones=dict(startup_milestones), phases=dict(startup_timings))
+
+
+time_to_die = False
+def rta_updater(net):
+    """Loads the network's state (unless that has already been done), then polls the network every
+    POLL_INTERVAL seconds until time_to_die"""
+    if net.globalsns is None:
+        with startup_phase('open ' + net.name):
+            open_network(net)
+    last = 0
+    first = True
+
+    while not time_to_die:
+        try:
+            p = profiling
+            if p is not None and p['mode'] == 'handlers' and time.time() >= p['until']:
+                finish_profile(p)
+            if time.time() - last < net.poll_interval:
+                time.sleep(1.0)
+                continue
+
+            start = time.time()
+            net.poll_timings.clear()
+            if p is not None and p['mode'] == 'polls':
+                ok = profile_call(rta_poll, net)
+            else:
+                ok = rta_poll(net)
+            elapsed = time.time() - start
+            log_event('poll', "Polled %s in %.3fs", net.name, elapsed, level=logging.DEBUG, network=net.name,
+                    ok=ok, height=net.lastheight, seconds=elapsed, phases=dict(net.poll_timings),
+                    sns=len(net.globalsns))
+            if not ok:
+                time.sleep(3)
+                continue
+            last = start
+            metric_observe('graftbot_poll_seconds', elapsed, phase='total', network=net.name)
             if first:
-                updates.append("I'm alive! 🍚 🍅 🍏")
-            for x in new_sns:
-                if x['tier'] > 0:
-                    msg = "💖 New *T{}* supernode appeared: {}".format(x['tier'], format_pubkey(x['pubkey']))
-                else:
-                    msg = "💗 New unstaked supernode appeared: {}".format(format_pubkey(x['pubkey']))
-                add_update(x['pubkey'], msg)
-
-            for p, old_tier in tier_was.items():
-                new_tier = globalsns[p]['tier']
-                msg = None
-                if new_tier > old_tier:
-                    if old_tier == 0:
-                        msg = "💖 {} activated as a *T{}*".format(format_pubkey(p), new_tier)
-                    else:
-                        msg = "💰 {} upgraded from *T{}* to *T{}*".format(format_pubkey(p), old_tier, new_tier)
-                elif new_tier < old_tier:
-                    if new_tier == 0:
-                        msg = "📅 {} expired (was a *T{}*)".format(format_pubkey(p), old_tier)
-                    else:
-                        msg = "😢 {} downgraded from *T{}* to *T{}*".format(format_pubkey(p), old_tier, new_tier)
-                if msg:
-                    add_update(p, msg)
-
-            for x in returns:
-                add_update(x['pubkey'], "💓 {} is back online _(after {})_!".format(
-                    format_pubkey(x['pubkey']),
-                    'unknown' if x['pubkey'] not in came_online_after else friendly_ago(came_online_after[x['pubkey']])))
-            for x in timeouts:
-                add_update(x['pubkey'], "💔 {} is offline!".format(format_pubkey(x['pubkey'])))
-
-            if now - last_summary >= SUMMARY_FREQUENCY:
-                updates.append(get_dist(results))
-                last_summary = now
-                if SEND_DIST_TO and SEND_DIST_TO != SEND_TO:
-                    updater.bot.send_message(SEND_DIST_TO, updates[-1], parse_mode=ParseMode.MARKDOWN)
-
-            if updates:
-                try:
-                    updater.bot.send_message(SEND_TO, '\n'.join(updates), parse_mode=ParseMode.MARKDOWN)
-                    first = False
-                except Exception as e:
-                    print("An exception occured during updating/notifications: {}".format(e))
-                    continue
-            lastresults = results
+                first = False
+                startup_timings['first poll ' + net.name] = elapsed
+                log_event('startup', "Initial RTA stats for %s fetched", net.name)
+                if all(n.lastresults for n in networks.values()):
+                    startup_milestone('ready')
         except Exception:
-            import traceback
-            print("Oh noes! Exception!")
-            print(traceback.format_exc())
+            log_event('poll_error', "Oh noes! Exception while polling %s!", net.name, level=logging.ERROR,
+                    exc_info=True, network=net.name)
 
 
 @nospam
@@ -500,7 +2524,23 @@ Supported commands:
 
 /snodes — shows the status of the graft supernodes this bot talks to.
 
+/disagree — shows which supernodes disagree with the others about SNs' stakes, wallets or expiries.
+
+/top — lists the SNs with the biggest stakes.
+
+/list [T1|T2|T3|T4] [stake|online|offline] — lists SNs (optionally of one tier) by stake, by how long they've been online, or by how long they've been offline (e.g. /list T4 offline).
+
 /height — shows the current height (or heights) on the nodes this bot talks to.
+'''
+    if len(networks) > 1:
+        reply_text += '''
+I watch several networks ({}).  Commands other than /sn and /track are about {}, or about the network this group gets updates for; give a network name first to ask about another one (e.g. /dist {}).
+'''.format(', '.join(net.name for net in networks.values()), primary_network().name, list(networks.values())[-1].name.lower())
+    if any(net.history_dir for net in networks.values()):
+        reply_text += '''
+/uptime PUBKEY [PERIOD] — shows how much of the last PERIOD (e.g. _12h_, _7d_, _1y_) the given SN was online.
+
+/netsize [PERIOD] — shows how many staked SNs were online over the last PERIOD.
 '''
 
     if WALLET_RPC and TESTNET:
@@ -517,11 +2557,12 @@ Supported commands:
     send_reply(bot, update, reply_text)
 
 
-def sn_value(pub, *, key=None, get=None, value_fmt="_{}_", none="_(none)_", join='; ', sn_format=" (_{}_)"):
+def sn_value(net, pub, *, key=None, get=None, value_fmt="_{}_", none="_(none)_", join='; ', sn_format=" (_{}_)"):
     """
     Return '_x_' if all supernodes agree on the value, otherwise something like: '_x_ (_sn1_); _y_ (_sn2, sn3_)'
 
     Required args:
+    net - the network the supernode is on
     pub - the supernode public id
     One of get or key:
         get - a lambda to extract the value from the sn dict inside lastresults
@@ -532,10 +2573,9 @@ def sn_value(pub, *, key=None, get=None, value_fmt="_{}_", none="_(none)_", join
     if key:
         get = lambda r: r[key] if key in r else None
 
-    global lastresults
     results = {}
-    for sn in SUPERNODES:
-        r = lastresults[sn[0]]
+    for sn in net.supernodes:
+        r = net.lastresults.get(sn[0])
         if not r:
             continue
         value = get(r[pub]) if pub in r else None
@@ -548,21 +2588,39 @@ def sn_value(pub, *, key=None, get=None, value_fmt="_{}_", none="_(none)_", join
     return join.join((none if k is None else value_fmt.format(k)) + sn_format.format(', '.join(v)) for k, v in results.items())
 
 
-def get_exp(r):
-    exp = r['StakeExpiringBlock'] if 'StakeExpiringBlock' in r else r['ExpiringBlock'] if 'ExpiringBlock' in r else None
+def stake_expiry(r):
+    return r['StakeExpiringBlock'] if 'StakeExpiringBlock' in r else r['ExpiringBlock'] if 'ExpiringBlock' in r else None
+
+
+def get_exp(net, r):
+    exp = stake_expiry(r)
     if exp is None:
         return None
-    global lastheight
-    minutes = 2 * (exp - lastheight)
-    return '{} (~{})'.format(exp,
-            '{} mins.'.format(minutes) if minutes <= 60 else
-            '{:.1f} hours'.format(minutes/60) if minutes <= 24*60 else
-            '{:.1f} days'.format(minutes/60/24))
+    minutes = 2 * (exp - net.lastheight)
+    return '{} (~{})'.format(exp, friendly_minutes(minutes))
+
+
+def archived_sn_info(pub, sn):
+    now = time.time()
+    msgs = []
+    if sn.get('tier') is not None:
+        msgs.append('*Tier:* {}'.format(sn['tier']))
+    if 'stake' in sn:
+        msgs.append('*Stake:* {} _GRFT_'.format('{:.10f}'.format(sn['stake'] * 1e-10).rstrip('0').rstrip('.')))
+    if sn.get('wallet'):
+        msgs.append('*Wallet:* ' + format_wallet(sn['wallet'], init_len=15, markup=''))
+    if sn.get('last_seen'):
+        msgs.append("*Last announce:* {} ago".format(friendly_ago(now - sn['last_seen'])))
+    msgs.append("*Status:* 🗄 archived — offline _({})_".format(friendly_ago(now - sn['offline_since'])))
+    return '\n'.join(msgs)
 
 
-def sn_info(pub):
-    global globalsns, lastresults
+def sn_info(net, pub):
+    globalsns, lastresults, lastages = net.globalsns, net.lastresults, net.lastages
     if pub not in globalsns:
+        sn = get_archived(net, pub) if pub in net.archived else None
+        if sn:
+            return archived_sn_info(pub, sn)
         return 'Sorry, I have never seen that supernode. 🙁'
     else:
         sn = globalsns[pub]
@@ -571,19 +2629,21 @@ def sn_info(pub):
         now = time.time()
         msgs = []
 
-        msgs.append('*Tier:* ' + sn_value(pub, value_fmt='{}',
+        msgs.append('*Tier:* ' + sn_value(net, pub, value_fmt='{}',
             get=lambda r: tier(r['StakeAmount']) if 'StakeAmount' in r else None))
-        msgs.append('*Stake:* ' + sn_value(pub, join='\n*Stake:* ', value_fmt='{}',
+        msgs.append('*Stake:* ' + sn_value(net, pub, join='\n*Stake:* ', value_fmt='{}',
             get=lambda r: '{:.10f} _GRFT_'.format(r['StakeAmount'] * 1e-10).rstrip('0').rstrip('.') if 'StakeAmount' in r else None))
-        msgs.append('*Stake activated:* Block ' + sn_value(pub,
+        msgs.append('*Stake activated:* Block ' + sn_value(net, pub,
             get=lambda r: r['StakeFirstValidBlock'] if 'StakeFirstValidBlock' in r else None))
-        msgs.append('*Stake expiry:* Block ' + sn_value(pub, get=get_exp))
-        msgs.append('*Wallet:* ' + sn_value(pub, join='\n*Wallet:* ',
+        msgs.append('*Stake expiry:* Block ' + sn_value(net, pub, get=partial(get_exp, net)))
+        msgs.append('*Wallet:* ' + sn_value(net, pub, join='\n*Wallet:* ',
             get=lambda r: format_wallet(r['Address'], init_len=15, markup='') if 'Address' in r else None))
 
         msgs.append("*Last announce:* {} ago".format(friendly_ago(now - sn['last_seen'])))
-        online_for = [sn for sn, r in lastresults.items() if r and pub in r and r[pub]['LastUpdateAge'] <= TIMEOUT]
-        offline_for = [sn for sn, r in lastresults.items() if r and (pub not in r or r[pub]['LastUpdateAge'] > TIMEOUT)]
+        online_for = [sn for sn, r in lastresults.items()
+                if r and pub in r and r[pub]['LastUpdateAge'] + lastages.get(sn, 0) <= TIMEOUT]
+        offline_for = [sn for sn, r in lastresults.items()
+                if r and (pub not in r or r[pub]['LastUpdateAge'] + lastages.get(sn, 0) > TIMEOUT)]
         mixed = online_for and offline_for
         if 'online_since' in sn or mixed:
             msgs.append("*Status:* 💓 online")
@@ -603,74 +2663,101 @@ def sn_info(pub):
                 msgs[-1] += ' — _{0}/{0} nodes_'.format(len(offline_for))
         return '\n'.join(msgs)
 
-if TESTNET:
-    RE_ADDR = r'F[3-9A-D][1-9a-km-zA-HJ-NP-Z]{93}'
-    RE_ADDR_PATTERN = r'(F[3-9A-D][1-9a-km-zA-HJ-NP-Z]{3,93})(?:\.+([1-9a-km-zA-HJ-NP-Z]{0,90}))?'
-else:
-    RE_ADDR = r'G[4-9A-D][1-9a-km-zA-HJ-NP-Z]{93}'
-    RE_ADDR_PATTERN = r'(G[4-9A-D][1-9a-km-zA-HJ-NP-Z]{3,93})(?:\.+([1-9a-km-zA-HJ-NP-Z]{0,90}))?'
+# Wallet addresses of the network configured above (which is the one the /send wallet is on)
+RE_ADDR, RE_ADDR_PATTERN = address_patterns(TESTNET)
 
 RE_PUB = r'[0-9a-f]{64}'
 RE_PUB_PATTERN = r'([0-9a-f]{5,64})(?:\.+([0-9a-f]{0,59}))?'
 
+def find_sns(net, a):
+    """Returns the pubkeys of the network's SNs matching `a` (a full or shortened pubkey or wallet
+    address), or None if `a` doesn't look like either"""
+    globalsns, archived = net.globalsns, net.archived
+    found = []
+    m = re.fullmatch(RE_PUB_PATTERN, a)
+    if m:
+        prefix, suffix = m.group(1), m.group(2)
+        for x in globalsns.keys():
+            if x.startswith(prefix) and (suffix is None or x.endswith(suffix)):
+                found.append(x)
+        if not found:
+            found = [x for x in list(archived) if x.startswith(prefix) and (suffix is None or x.endswith(suffix))]
+        return found
+    m = re.fullmatch(net.re_addr_pattern, a)
+    if not m:
+        return None
+    prefix, suffix = m.group(1), m.group(2)
+    for pub, x in globalsns.items():
+        if 'wallet' not in x:
+            continue
+        addr = x['wallet']
+        if addr.startswith(prefix) and (suffix is None or addr.endswith(suffix)):
+            found.append(pub)
+    if not found and archived:
+        with net.archive_lock:
+            for pub, x in net.archive.items():
+                addr = x.get('wallet')
+                if addr and addr.startswith(prefix) and (suffix is None or addr.endswith(suffix)):
+                    found.append(pub)
+    return found
+
+
+def sn_network(pub):
+    """Returns the network SN `pub` is on (or None if we've never seen it)"""
+    for net in networks.values():
+        if net.globalsns is None:
+            # Not loaded yet (still starting up)
+            continue
+        if pub in net.globalsns or pub in net.archived:
+            return net
+    return None
+
+
 @nospam
 @needs_data
 def show_sn(bot, update, user_data, args):
-    global globalsns
+    nets = [net for net in networks.values() if net.lastresults]
+    if args and args[0].lower() in networks:
+        nets, args = [networks[args[0].lower()]], args[1:]
+        if not nets[0].lastresults:
+            # (needs_data only waits for any network to be polled)
+            return send_reply(bot, update, 'I\'m still starting up; try again later')
     replies = []
     for a in args:
         found = []
-        m = re.fullmatch(RE_PUB_PATTERN, a)
-        if m:
-            prefix, suffix = m.group(1), m.group(2)
-            for x in globalsns.keys():
-                if x.startswith(prefix) and (suffix is None or x.endswith(suffix)):
-                    found.append(x)
-        else:
-            m = re.fullmatch(RE_ADDR_PATTERN, a)
-            if m:
-                prefix, suffix = m.group(1), m.group(2)
-                for pub, x in globalsns.items():
-                    if 'wallet' not in x:
-                        continue
-                    addr = x['wallet']
-                    if addr.startswith(prefix) and (suffix is None or addr.endswith(suffix)):
-                        found.append(pub)
-            else:
-                replies.append('*{}* doesn\'t look like a valid SN id or {}wallet address'.format(a, 'testnet ' if TESTNET else ''))
-                continue
+        valid = False
+        for net in nets:
+            f = find_sns(net, a)
+            if f is not None:
+                valid = True
+                found.extend((net, pub) for pub in f)
+        if not valid:
+            replies.append('*{}* doesn\'t look like a valid SN id or {}wallet address'.format(a,
+                'testnet ' if all(net.testnet for net in nets) else ''))
+            continue
 
         if not found:
             replies.append('Sorry, but I don\'t know of any SNs matching *{}*! 🙁'.format(a))
         elif len(found) == 1:
-            replies.extend(format_pubkey(pub, init_len=20) + ':\n' + sn_info(pub) for pub in found)
+            replies.extend(network_prefix(net.name) + format_pubkey(pub, init_len=20) + ':\n' + sn_info(net, pub)
+                    for net, pub in found)
         else:
             replies.append("Found multiple SNs matching *{}*:".format(a))
-            replies.append("\n".join(format_pubkey(pub, init_len=12) + ': ' + sn_value(pub, value_fmt='*T{}*',
-                get=lambda r: tier(r['StakeAmount']) if 'StakeAmount' in r else None) for pub in found))
+            replies.append("\n".join(network_prefix(net.name) + format_pubkey(pub, init_len=12) + ': ' + (
+                '*T{}* _(archived)_'.format((get_archived(net, pub) or {}).get('tier')) if pub in net.archived else
+                sn_value(net, pub, value_fmt='*T{}*', get=lambda r: tier(r['StakeAmount']) if 'StakeAmount' in r else None))
+                for net, pub in found))
 
     if not replies:
         replies.append("Usage: /sn {PUBKEY|WALLET} -- shows information about matching supernodes")
 
-    msg = ''
-    count = 0
-    while count < len(replies):
-        if msg:
-            msg += '\n\n'
-        msg += replies[count]
-        count += 1
-        if count >= len(replies) or count % 3 == 0:
-            bot.send_message(
-                chat_id=update.message.chat_id,
-                text=msg, parse_mode=ParseMode.MARKDOWN)
-            msg = ''
+    send_replies(bot, update, replies)
 
 
 def track_sn(bot, update, user_data, args):
     if update.message.chat.type != 'private':
         return send_reply(bot, update, 'Sorry, that command can only be used in a direct message')
 
-    global globalsns
     user_id = update.effective_user.id
 
     pks = []
@@ -705,37 +2792,22 @@ def show_tracking(bot, update, user_data, args):
     if update.message.chat.type != 'private':
         return send_reply(bot, update, 'Sorry, that command can only be used in a direct message')
 
-    global globalsns
     user_id = update.effective_user.id
 
     if 'notify_about' not in user_data or not user_data['notify_about']:
         return send_reply(bot, update, "I am not currently tracking an SNs for you")
 
     num = len(user_data['notify_about'])
-    msg = 'Currently tracking *{}* SN{} for you:'.format(num, '' if num == 1 else 's')
-    send_reply(bot, update, msg)
-
-    count = 0
-    def send_if_full(force=False):
-        nonlocal count, msg
-        count += 1
-        if msg and (count >= 3 or force):
-            bot.send_message(
-                chat_id=update.message.chat_id,
-                text=msg, parse_mode=ParseMode.MARKDOWN)
-            count = 0
-            msg = ''
-
+    blocks = ['Currently tracking *{}* SN{} for you:'.format(num, '' if num == 1 else 's')]
     for sn in sorted(user_data['notify_about']):
-        if msg:
-            msg += "\n\n"
-        msg += "*{}*:\n".format(sn)
-        msg += sn_info(sn) if sn in globalsns else '_Not found_'
-        send_if_full()
-    send_if_full(force=True)
+        net = sn_network(sn)
+        blocks.append("{}*{}*:\n".format(network_prefix(net.name) if net else '', sn) +
+                (sn_info(net, sn) if net else '_Not found_' if all(n.lastresults for n in networks.values()) else
+                    '_Not found (I\'m still starting up)_'))
+    send_replies(bot, update, blocks)
 
 
-def filter_nodes(args, select_from=NODES, empty_means_all=True):
+def filter_nodes(args, select_from, empty_means_all=True):
     if not args and empty_means_all:
         return (select_from, [])
     ns, leftover = [], []
@@ -753,22 +2825,24 @@ def filter_nodes(args, select_from=NODES, empty_means_all=True):
 
 
 @nospam
-@needs_data
 @send_action(ChatAction.UPLOAD_DOCUMENT)
-def show_sample(bot, update, user_data, args):
-    sns, leftover = filter_nodes(args, select_from=SUPERNODES)
+@with_network
+@needs_data
+def show_sample(bot, update, user_data, args, net):
+    sns, leftover = filter_nodes(args, select_from=net.supernodes)
     if leftover:
-        send_reply(bot, update, "❌ Bad arguments!\nUsage: /sample [SN ...]"
+        send_reply(bot, update, "❌ Bad arguments!\nUsage: /sample [NETWORK] [SN ...]"
                 "— shows a random auth sample for the given supernodes (or all supernodes if none are specified)")
         return
 
-    loop = asyncio.new_event_loop()
+    import uuid
     payment_id = uuid.uuid4()
     # Buggy supernode doesn't actually accept the payment IDs it generates in the auth sample url:
     payment_id = re.sub('-', '', str(payment_id))
 
-    results = loop.run_until_complete(get_json_data([
-        '{}/debug/auth_sample/{}'.format(sn[1], payment_id) for sn in sns], timeout=2))
+    results = run_io(get_json_data([
+        '{}/debug/auth_sample/{}'.format(sn[1], payment_id) for sn in sns], timeout=2,
+        names=[sn[0] for sn in sns], endpoint='auth_sample'))
     samples = {}
     for sn, r in zip(sns, results):
         if not r:
@@ -792,16 +2866,16 @@ def show_sample(bot, update, user_data, args):
 
 @nospam
 @send_action(ChatAction.UPLOAD_DOCUMENT)
-def show_height(bot, update, user_data, args):
-    ns, leftover = filter_nodes(args)
+@with_network
+def show_height(bot, update, user_data, args, net):
+    ns, leftover = filter_nodes(args, select_from=net.nodes)
     if leftover:
         send_reply(bot, update, "❌ {} isn't a node I know about".format(leftover[0]))
         return
 
     heights = {}
-    loop = asyncio.new_event_loop()
-    results = loop.run_until_complete(get_json_data([
-        n[1] + '/getheight' for n in ns], timeout=2))
+    results = run_io(get_json_data([
+        n[1] + '/getheight' for n in ns], timeout=2, names=[n[0] for n in ns], endpoint='getheight'))
     for n, r in zip(ns, results):
         if not r:
             continue
@@ -825,16 +2899,16 @@ def show_height(bot, update, user_data, args):
 
 @nospam
 @send_action(ChatAction.UPLOAD_DOCUMENT)
-def show_nodes(bot, update, user_data, args):
-    ns, leftover = filter_nodes(args)
+@with_network
+def show_nodes(bot, update, user_data, args, net):
+    ns, leftover = filter_nodes(args, select_from=net.nodes)
     if leftover:
         send_reply(bot, update, "❌ {} isn't a node I know about".format(leftover[0]))
         return
 
     heights = {}
-    loop = asyncio.new_event_loop()
-    results = loop.run_until_complete(get_json_data([
-        n[1] + '/getinfo' for n in ns], timeout=2))
+    results = run_io(get_json_data([
+        n[1] + '/getinfo' for n in ns], timeout=2, names=[n[0] for n in ns], endpoint='getinfo'))
     status = []
     for n, r in zip(ns, results):
         st = None
@@ -850,11 +2924,37 @@ def show_nodes(bot, update, user_data, args):
     send_reply(bot, update, '\n'.join(status))
 
 
+def snode_counts(stats, age=0):
+    """Counts the SNs in a supernode's list by status, uptime and tier.  `age` is how old the list is
+    (see merge_observations)."""
+    count = { x: 0 for x in ('2m', '10m', '30m', '1h', 'online', 'unstaked', 'offline', 'gone') }
+    for t in range(5):
+        count['t{}'.format(t)] = 0
+
+    for x in stats.values():
+        t = tier(x['StakeAmount'])
+        last_update = x['LastUpdateAge'] + age
+        if last_update <= TIMEOUT:
+            count['online' if t >= 1 else 'unstaked'] += 1
+            count['t{}'.format(t)] += 1
+            if last_update <= 120:
+                count['2m'] += 1
+            elif last_update <= 600:
+                count['10m'] += 1
+            elif last_update <= 1800:
+                count['30m'] += 1
+            else:
+                count['1h'] += 1
+        elif last_update <= 1000000000:
+            count['offline' if t >= 1 else 'gone'] += 1
+    return count
+
+
 @nospam
+@with_network
 @needs_data
-def show_snodes(bot, update, user_data, args):
-    global lastresults
-    sns, leftover = filter_nodes(args, select_from=SUPERNODES)
+def show_snodes(bot, update, user_data, args, net):
+    sns, leftover = filter_nodes(args, select_from=net.supernodes)
     if leftover:
         send_reply(bot, update, "❌ {} isn't a supernode I know about".format(leftover[0]))
         return
@@ -862,31 +2962,12 @@ def show_snodes(bot, update, user_data, args):
     stats = []
     for sn in sns:
         st = '*{}*: '.format(sn[0])
-        r = lastresults[sn[0]]
+        r = net.lastresults.get(sn[0])
         if not r:
-            st += '_connection failed_'
+            st += '_no recent data_' if net.poll_sample_size else '_connection failed_'
             stats.append(st)
             continue
-        count = { x: 0 for x in ('2m', '10m', '30m', '1h', 'online', 'unstaked', 'offline', 'gone') }
-        for t in range(5):
-            count['t{}'.format(t)] = 0
-
-        for x in r.values():
-            t = tier(x['StakeAmount'])
-            if x['LastUpdateAge'] <= TIMEOUT:
-                count['online' if t >= 1 else 'unstaked'] += 1
-                count['t{}'.format(t)] += 1
-                if x['LastUpdateAge'] <= 120:
-                    count['2m'] += 1
-                elif x['LastUpdateAge'] <= 600:
-                    count['10m'] += 1
-                elif x['LastUpdateAge'] <= 1800:
-                    count['30m'] += 1
-                else:
-                    count['1h'] += 1
-            elif x['LastUpdateAge'] <= 1000000000:
-                count['offline' if t >= 1 else 'gone'] += 1
-
+        count = snode_counts(r, net.lastages.get(sn[0], 0))
         st += '*{online}* 💖,  *{unstaked}* 💗,  *{offline}* 💔'.format(**count)
         st += '  _({2m}/{10m}/{30m}/{1h})_  *[{t1}-{t2}-{t3}-{t4}]*'.format(**count)
         #st += ' [🔗]({}/debug/supernode_list/1)'.format(sn[1])
@@ -899,6 +2980,180 @@ def show_snodes(bot, update, user_data, args):
     send_reply(bot, update, '\n'.join(stats))
 
 
+@nospam
+@with_network
+@needs_data
+def show_disagree(bot, update, user_data, args, net):
+    show = 10
+    if args:
+        return send_reply(bot, update, "Usage: /disagree [NETWORK] — shows the supernodes whose lists disagree with the others the most, and the SNs they disagree about")
+    disagreements = list(net.disagreements.items())
+    counts = list(net.disagree_counts.items())
+    if not disagreements:
+        return send_reply(bot, update, network_prefix(net.name) + "All supernodes agree on every SN's stake, wallet and expiry 👍")
+
+    fields = [f for f, _ in DISAGREE_FIELDS]
+    msg = network_prefix(net.name) + "*Supernode disagreements:* {} SN{}\n".format(
+            len(disagreements), '' if len(disagreements) == 1 else 's')
+    msg += "Out of line with the others _(SNs)_:\n"
+    for tag, c in sorted(counts, key=lambda x: sum(x[1].values()), reverse=True)[:show]:
+        msg += "*{}*: {}\n".format(tag, ', '.join('{} *{}*'.format(f, c[f]) for f in fields if f in c))
+    msg += "Most disputed:\n"
+    worst = sorted(disagreements, key=lambda x: sum(len(o) for _, o in x[1].values()), reverse=True)[:show]
+    for p, d in worst:
+        msg += "{} — {}\n".format(format_pubkey(p), '; '.join('{}: _{}_'.format(f, ', '.join(sorted(d[f][1])))
+            for f in fields if f in d))
+    if len(disagreements) > show:
+        msg += "_...and {} more_".format(len(disagreements) - show)
+    send_reply(bot, update, msg.rstrip('\n'))
+
+
+def rank_page(net, order, t, offset):
+    """Returns the text and inline keyboard of a page of the network's SNs in `order` (see
+    RANK_ORDERS), of tier `t` (None for all tiers), starting at `offset`.  The page is sliced straight
+    out of the ranked index, so this only costs as much as the page itself."""
+    items = net.ranks.get((order, t), [])
+    total = len(items)
+    if offset >= total:
+        offset = max(total - 1, 0) // RANK_PAGE_SIZE * RANK_PAGE_SIZE
+    page = items[offset:offset + RANK_PAGE_SIZE]
+    msg = network_prefix(net.name) + '*{}*'.format(RANK_ORDERS[order][0])
+    if t is not None:
+        msg += ' ' + format_tier(t)
+    if not page:
+        return msg + '\n_(none right now)_', None
+
+    now = time.time()
+    msg += ' _({}–{} of {})_\n'.format(offset + 1, offset + len(page), total)
+    for i, (_, p) in enumerate(page, offset + 1):
+        g = net.globalsns.get(p) or {}
+        msg += '{}. {}'.format(i, format_pubkey(p))
+        if g.get('tier') is not None:
+            msg += ' ' + format_tier(g['tier'])
+        if g.get('stake'):
+            msg += ' {}'.format(format_balance(g['stake']))
+        if 'online_since' in g:
+            msg += ' — 💓 _{}_'.format(friendly_ago(now - g['online_since']))
+        elif 'offline_since' in g:
+            msg += ' — 💔 _{}_'.format(friendly_ago(now - g['offline_since']))
+        msg += '\n'
+
+    data = 'rank:{}:{}:{}:{{}}'.format(net.name.lower(), order, '-' if t is None else t)
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton('◀ Previous', callback_data=data.format(max(offset - RANK_PAGE_SIZE, 0))))
+    if offset + RANK_PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton('Next ▶', callback_data=data.format(offset + RANK_PAGE_SIZE)))
+    return msg.rstrip('\n'), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@nospam
+@with_network
+@needs_data
+def show_top(bot, update, user_data, args, net):
+    if args:
+        return send_reply(bot, update, "Usage: /top [NETWORK] — lists the SNs with the biggest stakes")
+    text, markup = rank_page(net, 'stake', None, 0)
+    send_reply(bot, update, text, reply_markup=markup)
+
+
+@nospam
+@with_network
+@needs_data
+def show_list(bot, update, user_data, args, net):
+    order, t = 'stake', None
+    for a in args:
+        a = a.lower()
+        if a in RANK_ORDERS:
+            order = a
+        elif re.fullmatch(r't[1-4]', a):
+            t = int(a[1])
+        else:
+            return send_reply(bot, update, "Usage: /list [NETWORK] [T1|T2|T3|T4] [{}] — lists SNs (of the given tier) by stake, "
+                    "by how long they've been online, or by how long they've been offline".format('|'.join(RANK_ORDERS)))
+    text, markup = rank_page(net, order, t, 0)
+    send_reply(bot, update, text, reply_markup=markup)
+
+
+def rank_callback(bot, update):
+    """Shows another page of a /top or /list reply, when one of its buttons is pressed"""
+    query = update.callback_query
+    m = re.fullmatch(r'rank:([^:]+):(\w+):(-|[1-4]):(\d+)', query.data or '')
+    if m and m.group(1) in networks and not networks[m.group(1)].lastresults:
+        return query.answer("I'm still starting up; try again later")
+    if m and m.group(1) in networks and m.group(2) in RANK_ORDERS:
+        text, markup = rank_page(networks[m.group(1)], m.group(2), None if m.group(3) == '-' else int(m.group(3)),
+                int(m.group(4)))
+        try:
+            query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+        except BadRequest:
+            # The page hasn't changed since it was shown (telegram refuses no-op edits)
+            pass
+    query.answer()
+
+
+sparks = ' ▁▂▃▄▅▆▇█'
+
+def sparkline(values, lo, hi):
+    return ''.join('·' if v is None else sparks[round((v - lo) / (hi - lo) * (len(sparks) - 1)) if hi > lo else -1]
+            for v in values)
+
+
+def parse_period(arg):
+    m = re.fullmatch(r'(\d+)([mhdwy])', arg)
+    if not m:
+        return None
+    return int(m.group(1)) * { 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400, 'y': 365*86400 }[m.group(2)]
+
+
+@nospam
+@with_network
+@needs_data
+def show_uptime(bot, update, user_data, args, net):
+    usage = "Usage: /uptime PUBKEY [PERIOD] — shows the uptime of a SN over the last PERIOD (e.g. _12h_, _7d_, _1y_; default _7d_)"
+    history = net.history
+    if history is None:
+        return send_reply(bot, update, "Sorry, uptime history isn't enabled")
+    if not 1 <= len(args) <= 2:
+        return send_reply(bot, update, usage)
+    period = parse_period(args[1]) if len(args) > 1 else 7*86400
+    m = re.fullmatch(RE_PUB_PATTERN, args[0])
+    if not m or not period:
+        return send_reply(bot, update, usage)
+    prefix, suffix = m.group(1), m.group(2)
+    found = [x for x in history['pubs'] if x.startswith(prefix) and (suffix is None or x.endswith(suffix))]
+    if len(found) != 1:
+        return send_reply(bot, update, "Sorry, but I don't know of any SNs matching *{}*! 🙁".format(args[0]) if not found else
+                "*{}* matches multiple SNs; please give more of the public key".format(args[0]))
+
+    now = time.time()
+    uptime, buckets = history_uptime(history, found[0], now - period, now)
+    if uptime is None:
+        return send_reply(bot, update, "I don't have any history for that period yet")
+    send_reply(bot, update, "{} uptime over the last _{}_: *{:.2f}%*\n`{}`".format(
+        format_pubkey(found[0], init_len=12), args[1] if len(args) > 1 else '7d', uptime * 100,
+        sparkline(buckets, 0, 1)))
+
+
+@nospam
+@with_network
+@needs_data
+def show_netsize(bot, update, user_data, args, net):
+    if net.history is None:
+        return send_reply(bot, update, "Sorry, uptime history isn't enabled")
+    period = parse_period(args[0]) if len(args) == 1 else 7*86400 if not args else None
+    if not period:
+        return send_reply(bot, update, "Usage: /netsize [PERIOD] — shows the number of online staked SNs over the last PERIOD (e.g. _12h_, _7d_, _1y_; default _7d_)")
+
+    now = time.time()
+    sizes = history_netsize(net.history, now - period, now)
+    known = [x for x in sizes if x is not None]
+    if not known:
+        return send_reply(bot, update, "I don't have any history for that period yet")
+    send_reply(bot, update, "Online staked SNs over the last _{}_: *{:.0f}*–*{:.0f}* (now *{:.0f}*)\n`{}`".format(
+        args[0] if args else '7d', min(known), max(known), known[-1], sparkline(sizes, min(known), max(known))))
+
+
 def my_id(bot, update, user_data):
     user_id = update.effective_user.id
     send_reply(bot, update, "Your internal telegram ID is: {}".format(user_id))
@@ -933,14 +3188,123 @@ def slap(bot, update, user_data):
 
 
 def sticker_input(bot, update, user_data):
-    print("Got sticker with file_id: {}".format(update.message.sticker.file_id))
+    log_event('sticker', "Got sticker with file_id: %s", update.message.sticker.file_id)
 
 
 
 already_sent = set()
 
+# The stake ledger (`stakes`) is a shelve holding:
+# 'height' - the wallet height up to which outgoing transfers have been synced
+# 'tx:TXID' - { 'height': H, 'destinations': [{'address': ..., 'amount': ...}, ...] } for each transfer
+#             (height is None while the transfer is still pending)
+# 'sent:WALLET' - total amount sent to WALLET across all recorded transfers
+# 'msg:ID' - present for each /send message id that has been acted on (see already_sent)
+stakes_lock = threading.Lock()
+
+
+def load_stakes():
+    global stakes, already_sent
+    import shelve
+    stakes = shelve.open(PERSISTENCE_STAKES_FILENAME)
+    if 'height' not in stakes:
+        stakes['height'] = 0
+    already_sent = set(int(k[4:]) for k in stakes.keys() if k.startswith('msg:'))
+
+
+def stake_sent_to(wallet):
+    """Returns the total amount the ledger has recorded as sent to `wallet`"""
+    with stakes_lock:
+        return stakes.get('sent:' + wallet, 0)
+
+
+def mark_sent(message_id):
+    """Marks a /send message as handled so that it can't be resent, even after a restart"""
+    already_sent.add(message_id)
+    with stakes_lock:
+        stakes['msg:{}'.format(message_id)] = True
+        stakes.sync()
+
+
+def record_stake(txid, destinations, height=None):
+    """Adds an outgoing transfer to the ledger.  Recording an already known txid only updates its
+    height (e.g. once a pending transfer is mined).  Must be called with stakes_lock held."""
+    key = 'tx:' + txid
+    if key in stakes:
+        tx = stakes[key]
+        if height is not None and tx['height'] != height:
+            tx['height'] = height
+            stakes[key] = tx
+        return
+    stakes[key] = { 'height': height, 'destinations': destinations }
+    for d in destinations:
+        stakes['sent:' + d['address']] = stakes.get('sent:' + d['address'], 0) + d['amount']
+
+
+def forget_stake(txid):
+    """Removes a (failed) transfer from the ledger.  Must be called with stakes_lock held."""
+    key = 'tx:' + txid
+    if key not in stakes:
+        return
+    for d in stakes[key]['destinations']:
+        stakes['sent:' + d['address']] = stakes.get('sent:' + d['address'], 0) - d['amount']
+    del stakes[key]
+
+
+def sync_stakes():
+    """Pulls outgoing transfers mined after the last synced height (plus any pending or failed
+    transfers) from the wallet and updates the ledger with them."""
+    import requests
+    data = requests.post(WALLET_RPC + '/json_rpc', timeout=5,
+            json={
+                "jsonrpc":"2.0","id":"0","method":"get_transfers","params":{
+                    "out": True, "pending": True, "failed": True,
+                    "filter_by_height": True, "min_height": stakes['height'],
+                }
+            }).json()['result']
+    with stakes_lock:
+        height = stakes['height']
+        for t in data.get('out', []):
+            record_stake(t['txid'], t.get('destinations', []), t['height'])
+            height = max(height, t['height'])
+        for t in data.get('pending', []):
+            record_stake(t['txid'], t.get('destinations', []))
+        for t in data.get('failed', []):
+            forget_stake(t['txid'])
+        stakes['height'] = height
+        stakes.sync()
+
+# Authorized /send requests waiting for the next batched transfer (see SEND_BATCH_WINDOW), and the
+# batch currently being sent.  Both are counted as already funded until the transfer completes.
+send_batch = []
+send_batch_inflight = []
+send_batch_lock = threading.Lock()
+send_batch_timer = None
+
+
+def batched_amount(wallet=None):
+    """Returns the total amount queued or in flight in /send batches, optionally only to `wallet`"""
+    with send_batch_lock:
+        return sum(x['amount'] for b in send_batch + send_batch_inflight for x in b['dest']
+                if wallet is None or x['address'] == wallet)
+
+
 @send_action(ChatAction.TYPING)
 def send_stake(bot, update, user_data, args):
+    import requests
+    # Make sure the user is authorized to send (before touching the ledger or the wallet); if not, tag
+    # the BOSS(es)
+    user_id = update.effective_user.id
+    if user_id not in BOSS_USERS:
+        log_event('unauthorized', "Unauthorized access denied for %s.", user_id, level=logging.WARNING,
+                user_id=user_id, command='send')
+        send_reply(bot, update, "I'm sorry, Dave.  I'm afraid I can't do that. (You aren't authorized to send funds! — " +
+                " ".join(BOSS_USERS.values()) + " 👆)");
+        return
+
+    if stakes is None:
+        # The stake ledger is only loaded (and synced with the wallet, just below) on first use
+        load_stakes()
 
     bad = None
     dest = []
@@ -963,6 +3327,12 @@ def send_stake(bot, update, user_data, args):
         send_reply(bot, update, "🔴 I'm sorry, Dave, I already opened the pod bay doors 🙁");
         return
 
+    try:
+        sync_stakes()
+    except Exception as e:
+        log_event('stake_error', "An exception occured while syncing the stake ledger: %s", e,
+                level=logging.WARNING, exc_info=True)
+
     append_usage = "\nUsage: /send {NNN,T1,T2,T3,T4} WALLET [TIER WALLET [...]]"
     stake_details = []
     if len(args) < 2 or len(args) % 2 != 0:
@@ -982,8 +3352,7 @@ def send_stake(bot, update, user_data, args):
                     break
                 stake_details.append(format_wallet(wallet) + ' 👈 ' + format_balance(amount))
             elif tier.upper() in amounts:
-                staked_already = (sum(globalsns[wallet]['funded'].values())
-                        if wallet in globalsns and 'funded' in globalsns[wallet] else 0)
+                staked_already = stake_sent_to(wallet) + batched_amount(wallet)
                 amount = amounts[tier.upper()] - staked_already
                 if amount > 0:
                     stake_details.append(format_wallet(wallet) + ' 👈 ' + format_balance(amount) + (' more' if staked_already else ''))
@@ -1002,14 +3371,15 @@ def send_stake(bot, update, user_data, args):
         return
 
     total_to_send = sum(x["amount"] for x in dest)
+    if SEND_BATCH_WINDOW:
+        total_to_send += batched_amount()
 
     try:
         data = requests.post(WALLET_RPC + '/json_rpc', timeout=2,
                 json={"jsonrpc":"2.0","id":"0","method":"getbalance"}).json()['result']
         available_balance, available_unlocked = data["balance"], data["unlocked_balance"]
     except Exception as e:
-        print("An exception occured while fetching the balance:")
-        print(e)
+        log_event('wallet_error', "An exception occured while fetching the balance: %s", e, level=logging.WARNING)
         return send_reply(bot, update, "⚠ *Something getting wrong* while fetching wallet balance 💩")
 
     if total_to_send > available_balance:
@@ -1018,18 +3388,70 @@ def send_stake(bot, update, user_data, args):
         return send_reply(bot, update, "I don't have enough unlocked funds right now: try again in a few blocks (🔓 *{}* unlocked)".format(
             format_balance(available_unlocked)))
 
-    # Make sure the user is authorized to send; if not, tag the BOSS(es)
-    user_id = update.effective_user.id
-    if user_id not in BOSS_USERS:
-        print("Unauthorized access denied for {}.".format(user_id))
-        send_reply(bot, update, "I'm sorry, Dave.  I'm afraid I can't do that. (You aren't authorized to send funds! — " +
-                " ".join(BOSS_USERS.values()) + " 👆)");
-        return
-
     assert(len(dest) > 0)
 
-    already_sent.add(reply_to.message_id)
+    mark_sent(reply_to.message_id)
 
+    request = { 'update': update, 'reply_to': reply_to, 'dest': dest, 'stake_details': stake_details,
+            'queued': time.time() }
+    if SEND_BATCH_WINDOW:
+        queue_stake(bot, request)
+    else:
+        send_transfer(bot, [request])
+
+
+def queue_stake(bot, request):
+    """Adds an authorized /send request to the pending batch.  The batch is sent once
+    SEND_BATCH_WINDOW seconds have passed since its first request, or as soon as it reaches
+    SEND_BATCH_MAX_DESTINATIONS destinations."""
+    global send_batch_timer
+    with send_batch_lock:
+        overflow = send_batch and (
+                sum(len(b['dest']) for b in send_batch) + len(request['dest']) > SEND_BATCH_MAX_DESTINATIONS)
+    if overflow:
+        flush_send_batch(bot)
+
+    with send_batch_lock:
+        send_batch.append(request)
+        full = sum(len(b['dest']) for b in send_batch) >= SEND_BATCH_MAX_DESTINATIONS
+        if not full and send_batch_timer is None:
+            send_batch_timer = threading.Timer(SEND_BATCH_WINDOW, flush_send_batch, args=(bot,))
+            send_batch_timer.daemon = True
+            send_batch_timer.start()
+
+    if full:
+        flush_send_batch(bot)
+    else:
+        send_reply(bot, request['update'], "⏳ Stake request queued; it will go out with the next batch",
+                reply_to=request['reply_to'])
+
+
+def flush_send_batch(bot):
+    global send_batch, send_batch_inflight, send_batch_timer
+    with send_batch_lock:
+        batch, send_batch = send_batch, []
+        send_batch_inflight += batch
+        if send_batch_timer:
+            send_batch_timer.cancel()
+            send_batch_timer = None
+    if not batch:
+        return
+    try:
+        send_transfer(bot, batch)
+    except Exception:
+        # Already reported by send_transfer
+        pass
+    finally:
+        with send_batch_lock:
+            send_batch_inflight = [b for b in send_batch_inflight if b not in batch]
+
+
+def send_transfer(bot, batch):
+    """Sends one transfer paying the destinations of all the /send requests in `batch`, then replies
+    to each of the original requests with the result."""
+    import requests
+    dest = [x for b in batch for x in b['dest']]
+    start = time.time()
     try:
         data = requests.post(WALLET_RPC + '/json_rpc', timeout=5,
                 json={
@@ -1039,36 +3461,44 @@ def send_stake(bot, update, user_data, args):
                     }
                 }).json()
         if 'error' in data and data['error']:
-            print("transfer error occured: {}".format(data['error']['message']))
+            log_event('stake_error', "transfer error occured: %s", data['error']['message'], level=logging.WARNING,
+                    requests=len(batch), destinations=len(dest), seconds=time.time() - start)
             reply = "⚠ <b>Something getting wrong</b> while sending payment:\n<i>{}</i>".format(
                     html.escape(data['error']['message']))
-            send_reply(bot, update, reply, parse_mode=ParseMode.HTML, reply_to=reply_to)
+            for b in batch:
+                send_reply(bot, b['update'], reply, parse_mode=ParseMode.HTML, reply_to=b['reply_to'])
         else:
             tx_hash = data['result']['tx_hash']
-            print("Sent stakes:")
-            for x in dest:
-                addr, amt = x['address'], x['amount']
-                print('\n    {} -- {}'.format(addr, amt))
-            send_reply(bot, update, "💸 Stake{} sent in [{}...](https://testnet.graft.observer/tx/{}):\n{}".format(
-                    '' if len(dest) == 1 else 's',
-                    tx_hash[0:8], tx_hash, '\n'.join(stake_details)),
-                reply_to=reply_to)
+            with stakes_lock:
+                record_stake(tx_hash, dest)
+                stakes.sync()
+            log_event('stake', "Sent stakes in %s: %s", tx_hash, ', '.join('{} -- {}'.format(x['address'], x['amount']) for x in dest),
+                    tx_hash=tx_hash, destinations=dest, requests=len(batch), seconds=time.time() - start,
+                    waited=[start - b['queued'] for b in batch])
+            for b in batch:
+                msg = "💸 Stake{} sent in [{}...](https://testnet.graft.observer/tx/{}):\n{}".format(
+                        '' if len(b['dest']) == 1 else 's',
+                        tx_hash[0:8], tx_hash, '\n'.join(b['stake_details']))
+                if len(batch) > 1:
+                    msg += "\n_(batched with {} other request{})_".format(len(batch) - 1, '' if len(batch) == 2 else 's')
+                send_reply(bot, b['update'], msg, reply_to=b['reply_to'])
     except Exception as e:
-        print("An exception occured while sending:")
-        print(e)
-        send_reply(bot, update, "⚠ *Something getting wrong* while sending payment 💩", reply_to=reply_to)
+        log_event('stake_error', "An exception occured while sending: %s", e, level=logging.ERROR, exc_info=True,
+                requests=len(batch), destinations=len(dest), seconds=time.time() - start)
+        for b in batch:
+            send_reply(bot, b['update'], "⚠ *Something getting wrong* while sending payment 💩", reply_to=b['reply_to'])
         raise e
 
 
 @send_action(ChatAction.TYPING)
 def balance(bot, update, user_data):
+    import requests
     try:
         data = requests.post(WALLET_RPC + '/json_rpc', timeout=2,
                 json={"jsonrpc":"2.0","id":"0","method":"getbalance"}).json()['result']
         balance, unlocked = data["balance"], data["unlocked_balance"]
     except Exception as e:
-        print("An exception occured while fetching the balance:")
-        print(e)
+        log_event('wallet_error', "An exception occured while fetching the balance: %s", e, level=logging.WARNING)
         send_reply(bot, update, "⚠ *Something getting wrong* while fetching wallet balance 💩")
         return
     msg = "💰 *{}* total".format(format_balance(balance))
@@ -1079,34 +3509,54 @@ def balance(bot, update, user_data):
 
 @send_action(ChatAction.TYPING)
 def donate(bot, update, user_data):
+    import requests
     try:
         addr = requests.post(WALLET_RPC + '/json_rpc', timeout=2,
                 json={"jsonrpc":"2.0","id":"0","method":"getaddress"}).json()['result']['address']
     except Exception as e:
-        print("An exception occured while fetching the address:")
-        print(e)
+        log_event('wallet_error', "An exception occured while fetching the address: %s", e, level=logging.WARNING)
         send_reply(bot, update, "⚠ *Something getting wrong* while fetching wallet address 💩")
         return
     send_reply(bot, update, "Send donations of unneeded RTA testnet GRFT to *" + addr + "*")
 
 
-rta_thread = None
 def start_rta_update_thread():
-    global rta_thread, lastresults
-    rta_thread = threading.Thread(target=rta_updater)
-    rta_thread.start()
-    while True:
-        if lastresults and any(lastresults):
-            print("Initial RTA stats fetched")
-            return
-        print("Waiting for initial RTA stats")
-        time.sleep(0.5)
+    """Starts a polling thread for each network, which loads the network's state and then polls it;
+    commands answer that the bot is still starting up until their network has been polled"""
+    for net in networks.values():
+        net.thread = threading.Thread(target=rta_updater, args=(net,), name='poll-' + net.name)
+        net.thread.start()
 
 
 def stop_rta_thread(signum, frame):
-    global time_to_die, rta_thread
+    global time_to_die
     time_to_die = True
-    rta_thread.join()
+    for net in networks.values():
+        if net.thread is not None:
+            net.thread.join()
+
+
+def profile(bot, update, user_data, args):
+    global profiling
+    user_id = update.effective_user.id
+    if user_id not in OWNER_USERS:
+        log_event('unauthorized', "Unauthorized /profile denied for %s.", user_id, level=logging.WARNING,
+                user_id=user_id, command='profile')
+        return send_reply(bot, update, "I'm sorry, Dave.  I'm afraid I can't do that.")
+
+    usage = ("Usage: /profile polls N — profiles the next N poll cycles\n"
+            "/profile handlers N — profiles command handlers for the next N seconds")
+    if len(args) != 2 or args[0] not in ('polls', 'handlers') or not re.fullmatch(r'[1-9]\d*', args[1]):
+        return send_reply(bot, update, usage)
+
+    n = int(args[1])
+    with profiling_lock:
+        if profiling is not None:
+            return send_reply(bot, update, "Already profiling; try again once that finishes")
+        profiling = { 'mode': args[0], 'count': n, 'until': time.time() + n, 'chat_id': update.message.chat_id,
+                'profiles': [], 'lock': threading.Lock() }
+    send_reply(bot, update, "Profiling the next {} {}".format(n, 'poll cycle' + ('s' if n != 1 else '')
+        if args[0] == 'polls' else 'second' + ('s' if n != 1 else '') + ' of command handling'))
 
 
 def error(bot, update, error):
@@ -1114,64 +3564,237 @@ def error(bot, update, error):
     logger.warning('Update "%s" caused error "%s"', update, error)
 
 
-def main():
-    print("Starting bot")
-    global pp, updater, globalsns, notifications
+# Updates received by webhook waiting for a worker, as (update, time received), and the webhook's HTTP
+# server and worker threads; see start_webhook()
+webhook_queue = None
+webhook_server = None
+webhook_threads = []
 
-    globalsns = shelve.open(PERSISTENCE_GLOBAL_SNS_FILENAME, writeback=True)
 
-    # Create the Updater and pass it your bot's token.
-    pp = PicklePersistence(filename=PERSISTENCE_USER_FILENAME, store_user_data=True, store_chat_data=False, on_flush=True)
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Receives the updates telegram posts to the webhook and queues them for the webhook workers.  If
+    WEBHOOK_BACKLOG updates are already waiting, the update is dropped and answered in the response
+    (which costs no API call) with a "busy" reply."""
+    def do_POST(self):
+        path = (urllib.parse.urlsplit(WEBHOOK_URL).path if WEBHOOK_URL else None) or '/'
+        if self.path.split('?')[0] != path:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(),
+                WEBHOOK_SECRET.encode()):
+            metric_inc('graftbot_webhook_updates_total', outcome='forbidden')
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > WEBHOOK_MAX_BODY:
+                metric_inc('graftbot_webhook_updates_total', outcome='too_large')
+                self.send_error(413)
+                return
+            update = Update.de_json(json.loads(self.rfile.read(max(length, 0))), updater.bot)
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
 
-    for uid, data in pp.get_user_data().items():
-        if 'notify_about' in data:
-            for pubkey in data['notify_about']:
-                if pubkey not in notifications:
-                    notifications[pubkey] = set()
-                notifications[pubkey].add(uid)
+        reply = None
+        try:
+            webhook_queue.put_nowait((update, time.monotonic()))
+            metric_inc('graftbot_webhook_updates_total', outcome='queued')
+        except queue.Full:
+            metric_inc('graftbot_webhook_updates_total', outcome='busy')
+            if update.callback_query:
+                reply = { 'method': 'answerCallbackQuery', 'callback_query_id': update.callback_query.id,
+                        'text': "I'm busy right now; try again in a minute" }
+            elif update.message:
+                reply = { 'method': 'sendMessage', 'chat_id': update.message.chat_id,
+                        'reply_to_message_id': update.message.message_id,
+                        'text': "I'm busy right now; try again in a minute" }
+        body = json.dumps(reply).encode() if reply else b''
+        self.send_response(200)
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def webhook_worker():
+    while True:
+        item = webhook_queue.get()
+        if item is None:
+            return
+        update, received = item
+        metric_observe('graftbot_dispatch_seconds', time.monotonic() - received)
+        try:
+            updater.dispatcher.process_update(update)
+        except Exception as e:
+            log_event('webhook_error', "An exception occured while handling a webhook update: %s", e,
+                    level=logging.ERROR, exc_info=True)
+
+
+def start_webhook():
+    """Starts receiving updates on WEBHOOK_LISTEN, handled by HANDLER_WORKERS (or one) worker threads,
+    and registers WEBHOOK_URL (if set) with telegram.  Returns the HTTP server."""
+    global webhook_queue, webhook_server
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET or ''):
+        raise ValueError("WEBHOOK_SECRET must be set (to 1-256 letters, digits, _ and -) to receive updates by webhook")
+    webhook_queue = queue.Queue(WEBHOOK_BACKLOG)
+    for i in range(HANDLER_WORKERS or 1):
+        t = threading.Thread(target=webhook_worker, name='webhook-{}'.format(i), daemon=True)
+        t.start()
+        webhook_threads.append(t)
+    webhook_server = start_http_server(WEBHOOK_LISTEN, WebhookHandler)
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    return webhook_server
+
+
+def stop_webhook():
+    """Stops accepting webhook updates and waits for the workers to finish the ones already queued"""
+    webhook_server.shutdown()
+    webhook_server.server_close()
+    for _ in webhook_threads:
+        webhook_queue.put(None)
+    for t in webhook_threads:
+        t.join()
+    del webhook_threads[:]
+
+
+def add_handlers(dispatcher, wrap=timed_handler):
+    """Registers the bot's command handlers with `dispatcher`.  Each command's callback is passed
+    through wrap(command, callback) first (by default adding latency metrics)."""
+    from telegram.ext import CommandHandler, MessageHandler, Filters, CallbackQueryHandler
+    serial_lock = threading.Lock()
+    def serial(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with serial_lock:
+                return func(*args, **kwargs)
+        return wrapped
+
+    def command(name, func, run_async=True, **kwargs):
+        func = wrap(name, func)
+        if not run_async:
+            func = serial(func)
+        elif HANDLER_WORKERS and not WEBHOOK_LISTEN:
+            # (webhook updates are already handled on a pool of HANDLER_WORKERS threads)
+            func = partial(dispatcher.run_async, func)
+        dispatcher.add_handler(CommandHandler(name, func, pass_user_data=True, **kwargs))
+
+    command('start', start)
+    command('dist', show_dist, pass_args=True)
+    if WALLET_RPC and TESTNET:
+        # Commands that move funds are always handled one at a time
+        command('send', send_stake, run_async=False, pass_args=True)
+        command('balance', balance, run_async=False)
+        command('donate', donate, run_async=False)
+    command('sn', show_sn, pass_args=True)
+    command('track', track_sn, pass_args=True)
+    command('tracking', show_tracking, pass_args=True)
+    command('sample', show_sample, pass_args=True)
+    command('height', show_height, pass_args=True)
+    command('nodes', show_nodes, pass_args=True)
+    command('snodes', show_snodes, pass_args=True)
+    command('disagree', show_disagree, pass_args=True)
+    command('top', show_top, pass_args=True)
+    command('list', show_list, pass_args=True)
+    dispatcher.add_handler(CallbackQueryHandler(wrap('rank_page', rank_callback), pattern=r'^rank:'))
+    if any(net.history_dir for net in networks.values()):
+        command('uptime', show_uptime, pass_args=True)
+        command('netsize', show_netsize, pass_args=True)
+    command('myid', my_id)
+    command('chatid', chat_id)
+    if OWNER_USERS:
+        dispatcher.add_handler(CommandHandler('profile', profile, pass_user_data=True, pass_args=True))
+    command('slap', slap)
+    dispatcher.add_handler(MessageHandler(Filters.sticker, sticker_input, pass_user_data=True))
 
-    updater = Updater(TELEGRAM_TOKEN, persistence=pp,
-            user_sig_handler=stop_rta_thread)
+    # log all errors
+    dispatcher.add_error_handler(error)
 
-    start_rta_update_thread()
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+def main():
+    global pp, updater, notifications
+    startup_timings['imports'] = time.time() - load_started
+    with startup_phase('logging'):
+        start_logging()
+    log_event('startup', "Starting bot")
+
+    # Everything needed to answer commands comes first; the networks' state is loaded by their
+    # pollers, and the stake ledger on first use
+    with startup_phase('telegram'):
+        from telegram.ext import Updater, PicklePersistence
+        create_networks()
+        # Create the Updater and pass it your bot's token.
+        pp = PicklePersistence(filename=PERSISTENCE_USER_FILENAME, store_user_data=True, store_chat_data=False, on_flush=True)
+        updater = Updater(TELEGRAM_TOKEN, persistence=pp, workers=HANDLER_WORKERS or 4,
+                user_sig_handler=stop_rta_thread)
+
+    with startup_phase('user data'):
+        for uid, data in pp.get_user_data().items():
+            if 'notify_about' in data:
+                for pubkey in data['notify_about']:
+                    if pubkey not in notifications:
+                        notifications[pubkey] = set()
+                    notifications[pubkey].add(uid)
+
+    with startup_phase('handlers'):
+        add_handlers(updater.dispatcher)
+        start_subscribers()
+        if METRICS_LISTEN:
+            start_http_server(METRICS_LISTEN, MetricsHandler)
+        if API_LISTEN:
+            start_http_server(API_LISTEN, ApiHandler)
 
-    updater.dispatcher.add_handler(CommandHandler('start', start, pass_user_data=True))
-    updater.dispatcher.add_handler(CommandHandler('dist', show_dist, pass_user_data=True))
-    if WALLET_RPC and TESTNET:
-        updater.dispatcher.add_handler(CommandHandler('send', send_stake, pass_user_data=True, pass_args=True))
-        updater.dispatcher.add_handler(CommandHandler('balance', balance, pass_user_data=True))
-        updater.dispatcher.add_handler(CommandHandler('donate', donate, pass_user_data=True))
-    updater.dispatcher.add_handler(CommandHandler('sn', show_sn, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('track', track_sn, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('tracking', show_tracking, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('sample', show_sample, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('height', show_height, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('nodes', show_nodes, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('snodes', show_snodes, pass_user_data=True, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('myid', my_id, pass_user_data=True))
-    updater.dispatcher.add_handler(CommandHandler('chatid', chat_id, pass_user_data=True))
-    updater.dispatcher.add_handler(CommandHandler('slap', slap, pass_user_data=True))
-    updater.dispatcher.add_handler(MessageHandler(Filters.sticker, sticker_input, pass_user_data=True))
+    # Start the Bot
+    with startup_phase('listen'):
+        if WEBHOOK_LISTEN:
+            start_webhook()
+        else:
+            updater.start_polling()
+    log_event('startup', "Bot started")
+    startup_milestone('answering')
 
-    # log all errors
-    dp.add_error_handler(error)
+    start_rta_update_thread()
 
-    # Start the Bot
-    updater.start_polling()
+    if WEBHOOK_LISTEN:
+        # The updater isn't running, so its idle() would exit immediately on a signal
+        stopping = threading.Event()
+        def stop(signum, frame):
+            stop_webhook()
+            # idle() would otherwise stop the dispatcher, and with it any run_async worker threads that
+            # were started; they aren't daemon threads, so the process couldn't exit until they do
+            updater.dispatcher.stop()
+            stop_rta_thread(signum, frame)
+            stopping.set()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(sig, stop)
+        while not stopping.wait(1):
+            pass
+        updater.dispatcher.update_persistence()
+    else:
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
 
-    print("Bot started")
+    if WALLET_RPC and TESTNET:
+        flush_send_batch(updater.bot)
+    stop_subscribers()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    stop_io()
 
-    print("Saving persistence and shutting down")
+    log_event('shutdown', "Saving persistence and shutting down")
     pp.flush()
-    globalsns.close()
+    for net in networks.values():
+        if net.globalsns is not None:
+            close_network(net)
+    if stakes is not None:
+        stakes.close()
+    stop_logging()
 
 
 if __name__ == '__main__':
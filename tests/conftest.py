@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench'))
+
+import botloader
+
+
+@pytest.fixture(scope='session')
+def bot():
+    """The bot module, loaded without running main()"""
+    return botloader.load_bot()
+
+
+@pytest.fixture
+def net(bot):
+    """A fresh network with an empty (in-memory) globalsns and archive"""
+    net = bot.Network('test')
+    net.globalsns = {}
+    net.archive = {}
+    return net
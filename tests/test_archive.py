@@ -0,0 +1,72 @@
+import pytest
+
+
+def test_archive_and_restore(bot, net):
+    g = net.globalsns['a'] = { 'tier': 1, 'offline_since': 1000 }
+    bot.archive_sn(net, 'a')
+    assert 'a' not in net.globalsns
+    assert net.archived == {'a'}
+    assert bot.get_archived(net, 'a') is g
+    assert bot.unarchive_sn(net, 'a') is g
+    assert net.globalsns['a'] is g
+    assert net.archived == set() and net.archive == {}
+    assert bot.get_archived(net, 'a') is None
+
+
+def test_restore_reschedules_expiry(bot, net):
+    net.globalsns['a'] = { 'tier': 1, 'expiry': 10000, 'expiry_alerted': 1 }
+    bot.archive_sn(net, 'a')
+    bot.unarchive_sn(net, 'a')
+    # The day warning was already sent before the SN was archived, so the hour one is next
+    assert bot.pop_expiry_alerts(net, 10000 - 30) == [('a', 10000, 1)]
+
+
+# reconcile() tests: supernodes a, b and c each report SN sn1 with the given LastUpdateAge
+T0 = 1500000000
+
+
+@pytest.fixture
+def polled(net):
+    net.lastheight = 1000
+    return net
+
+
+def poll(bot, net, now, *ages):
+    results = {}
+    for tag, age in zip('abc', ages):
+        results[tag] = { 'sn1': { 'PublicId': 'sn1', 'Address': 'F' + 'x' * 94, 'StakeAmount': 50000 * bot.GRFT,
+            'StakeExpiringBlock': 100000, 'LastUpdateAge': age } }
+    bot.reconcile(net, results, now)
+
+
+def archive_one(bot, net):
+    poll(bot, net, T0, 10, 10, 10)
+    t1 = T0 + 2 * bot.TIMEOUT
+    poll(bot, net, t1, *(t1 - T0,) * 3)
+    assert 'offline_since' in net.globalsns['sn1']
+    t2 = t1 + bot.ARCHIVE_AFTER
+    poll(bot, net, t2, *(t2 - T0,) * 3)
+    return t2
+
+
+def test_reconcile_archives_long_offline(bot, net, polled):
+    archive_one(bot, net)
+    assert 'sn1' not in net.globalsns
+    assert net.archived == {'sn1'}
+    assert bot.get_archived(net, 'sn1')['tier'] == 1
+
+
+def test_reconcile_restores_when_online(bot, net, polled):
+    t = archive_one(bot, net) + 60
+    poll(bot, net, t, 10, 10, 10)
+    g = net.globalsns['sn1']
+    assert net.archived == set()
+    assert g['online_since'] == t - 10
+    assert 'offline_since' not in g
+
+
+def test_reconcile_needs_enough_supernodes_to_restore(bot, net, polled):
+    t = archive_one(bot, net) + 60
+    poll(bot, net, t, 10, 10, t - T0)
+    assert 'sn1' not in net.globalsns
+    assert net.archived == {'sn1'}
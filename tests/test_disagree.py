@@ -0,0 +1,31 @@
+def item(stake=100, wallet='F1', expiry=5000):
+    return { 'StakeAmount': stake, 'Address': wallet, 'StakeExpiringBlock': expiry }
+
+
+def test_sn_disagreement(bot):
+    results = { 'a': { 'p': item() }, 'b': { 'p': item(stake=90) }, 'c': { 'p': item() }, 'd': None }
+    assert bot.sn_disagreement('p', results) == { 'stake': (100, { 'b': 90 }) }
+    results['b']['p'] = item()
+    assert bot.sn_disagreement('p', results) == {}
+
+
+def test_set_disagreement_counts(bot, net):
+    bot.set_disagreement(net, 'p1', { 'stake': (100, { 'b': 90 }), 'wallet': ('F1', { 'b': 'F2' }) })
+    bot.set_disagreement(net, 'p2', { 'stake': (100, { 'b': 90, 'c': 80 }) })
+    assert net.disagree_counts == { 'b': { 'stake': 2, 'wallet': 1 }, 'c': { 'stake': 1 } }
+
+    # Replacing an entry takes the old one's counts back out
+    bot.set_disagreement(net, 'p1', { 'expiry': (5000, { 'c': 4000 }) })
+    assert net.disagree_counts == { 'b': { 'stake': 1 }, 'c': { 'stake': 1, 'expiry': 1 } }
+
+    # ... and clearing one drops supernodes left with nothing to disagree about
+    bot.set_disagreement(net, 'p2', {})
+    assert net.disagree_counts == { 'c': { 'expiry': 1 } }
+    assert list(net.disagreements) == ['p1']
+    bot.set_disagreement(net, 'p1', None)
+    assert net.disagree_counts == {} and net.disagreements == {}
+
+
+def test_set_disagreement_agreeing_sn(bot, net):
+    bot.set_disagreement(net, 'p', {})
+    assert net.disagreements == {} and net.disagree_counts == {}
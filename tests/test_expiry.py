@@ -0,0 +1,64 @@
+# With the default EXPIRY_WARNINGS (a day, an hour, expired) and 2-minute blocks, the warnings for a
+# stake expiring at EXPIRY are due at these heights:
+EXPIRY = 10000
+DAY, HOUR, EXPIRED = EXPIRY - 720, EXPIRY - 30, EXPIRY
+
+
+def add_sn(bot, net, pub, expiry, height):
+    g = net.globalsns[pub] = {}
+    bot.observe_expiry(net, pub, g, expiry, height)
+    return g
+
+
+def test_warnings_in_order(bot, net):
+    add_sn(bot, net, 'a', EXPIRY, 1000)
+    assert bot.pop_expiry_alerts(net, DAY - 1) == []
+    assert bot.pop_expiry_alerts(net, DAY) == [('a', EXPIRY, 0)]
+    assert bot.pop_expiry_alerts(net, DAY + 1) == []
+    assert bot.pop_expiry_alerts(net, HOUR) == [('a', EXPIRY, 1)]
+    assert bot.pop_expiry_alerts(net, EXPIRED) == [('a', EXPIRY, 2)]
+    assert net.expiry_alerts == []
+
+
+def test_only_latest_of_several_crossed(bot, net):
+    add_sn(bot, net, 'a', EXPIRY, 1000)
+    assert bot.pop_expiry_alerts(net, HOUR + 5) == [('a', EXPIRY, 1)]
+    assert bot.pop_expiry_alerts(net, EXPIRED) == [('a', EXPIRY, 2)]
+
+
+def test_first_seen_past_thresholds(bot, net):
+    # A stake first seen within its last hour only gets the latest warning it has crossed
+    add_sn(bot, net, 'a', EXPIRY, HOUR + 1)
+    assert bot.pop_expiry_alerts(net, HOUR + 1) == [('a', EXPIRY, 1)]
+    # ... and one that has already expired gets none at all
+    add_sn(bot, net, 'b', EXPIRY, EXPIRED + 1)
+    assert bot.pop_expiry_alerts(net, EXPIRED + 1) == [('a', EXPIRY, 2)]
+
+
+def test_renewed_stake(bot, net):
+    g = add_sn(bot, net, 'a', EXPIRY, 1000)
+    assert bot.pop_expiry_alerts(net, DAY) == [('a', EXPIRY, 0)]
+    bot.observe_expiry(net, 'a', g, EXPIRY + 5040, DAY + 1)
+    # The warnings for the old expiry are stale and get skipped
+    assert bot.pop_expiry_alerts(net, EXPIRED) == []
+    assert bot.pop_expiry_alerts(net, EXPIRY + 5040 - 720) == [('a', EXPIRY + 5040, 0)]
+
+
+def test_removed_sn(bot, net):
+    add_sn(bot, net, 'a', EXPIRY, 1000)
+    add_sn(bot, net, 'b', EXPIRY + 1, 1000)
+    del net.globalsns['a']
+    assert bot.pop_expiry_alerts(net, DAY + 1) == [('b', EXPIRY + 1, 0)]
+
+
+def test_heap_order(bot, net):
+    for i, exp in enumerate((EXPIRY + 300, EXPIRY, EXPIRY + 100, EXPIRY + 200)):
+        add_sn(bot, net, str(i), exp, 1000)
+    assert [pub for pub, _, _ in bot.pop_expiry_alerts(net, EXPIRY + 300 - 720)] == ['1', '2', '3', '0']
+
+
+def test_lapsed_stake_not_reported_twice(bot, net):
+    add_sn(bot, net, 'a', EXPIRY, 1000)['tier'] = 1
+    add_sn(bot, net, 'b', EXPIRY, 1000)['tier'] = 0
+    # b's stake has already dropped it to tier 0, which was reported as a TierChanged
+    assert [(type(e).__name__, e.pubkey) for e in bot.expiry_events(net, EXPIRED, 0)] == [('Expired', 'a')]
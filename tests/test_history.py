@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def hnet(bot, net, tmp_path):
+    net.history_dir = str(tmp_path / 'history')
+    net.globalsns.update({
+        'a': { 'tier': 1, 'stake': 50000 * bot.GRFT },
+        'b': { 'tier': 2, 'stake': 90000 * bot.GRFT },
+        'c': { 'tier': 0 },
+    })
+    bot.history_open(net)
+    return net
+
+
+def record(bot, net, ts, online):
+    for p, g in net.globalsns.items():
+        if p in online:
+            g['online_since'] = ts
+        else:
+            g.pop('online_since', None)
+    bot.history_record(net, ts)
+
+
+def hour_frames(bot, net, t0, t1):
+    return [(ts, online, staked, bot.history_frame_values('hour', slots, data, offset))
+            for ts, slots, online, staked, data, offset in bot.history_frames(net.history, 'hour', t0, t1)]
+
+
+@pytest.fixture
+def hour():
+    return (int(time.time()) // 3600 - 3) * 3600
+
+
+def test_poll_frames_roll_up_into_hours(bot, hnet, hour):
+    # a is always online, b for the first half of the hour, c never
+    for m in range(60):
+        record(bot, hnet, hour + m * 60, 'ab' if m < 30 else 'a')
+    assert hour_frames(bot, hnet, hour, hour + 3600) == []
+    # The hour is written once a poll from the next one comes in
+    record(bot, hnet, hour + 3600, 'a')
+    slots = hnet.history['slots']
+    [(ts, online, staked, values)] = hour_frames(bot, hnet, hour, hour + 3600)
+    assert ts == hour
+    assert online == 2 and staked == 2  # 1.5 rounded
+    assert values[slots['a']] == pytest.approx(1)
+    assert values[slots['b']] == pytest.approx(0.5, abs=1e-4)
+    assert values[slots['c']] == 0
+
+
+def test_rollup_survives_restart(bot, hnet, hour):
+    for m in range(30):
+        record(bot, hnet, hour + m * 60, 'ab')
+    # Reopening rebuilds the partial hour from the poll frames already written
+    bot.history_open(hnet)
+    for m in range(30, 60):
+        record(bot, hnet, hour + m * 60, 'a')
+    record(bot, hnet, hour + 3600, 'a')
+    [(_, _, _, values)] = hour_frames(bot, hnet, hour, hour + 3600)
+    assert values[hnet.history['slots']['b']] == pytest.approx(0.5, abs=1e-4)
+
+
+def test_uptime_and_netsize(bot, hnet, hour):
+    for m in range(120):
+        record(bot, hnet, hour + m * 60, 'abc' if m % 2 else 'a')
+    up, buckets = bot.history_uptime(hnet.history, 'b', hour, hour + 7200, buckets=2)
+    assert up == pytest.approx(0.5)
+    assert buckets == [pytest.approx(0.5), pytest.approx(0.5)]
+    up, _ = bot.history_uptime(hnet.history, 'a', hour, hour + 7200)
+    assert up == pytest.approx(1)
+    # c is online too, but isn't staked
+    assert bot.history_netsize(hnet.history, hour, hour + 7200, buckets=2) == [pytest.approx(1.5)] * 2
+
+
+def test_duplicate_poll_ignored(bot, hnet, hour):
+    record(bot, hnet, hour, 'a')
+    record(bot, hnet, hour, 'ab')
+    assert len(list(bot.history_frames(hnet.history, 'poll', hour, hour + 60))) == 1
@@ -0,0 +1,23 @@
+import json
+import logging
+import queue
+
+
+def test_queued_records_are_rendered(bot):
+    handler = bot.LogQueueHandler(queue.Queue(10))
+    state = { 'n': 1 }
+    try:
+        raise RuntimeError('boom')
+    except RuntimeError as e:
+        record = logging.LogRecord('graftbot', logging.ERROR, __file__, 1, 'state is %s', (state,), (type(e), e, e.__traceback__))
+    record.event, record.fields = 'test', { 'x': 1 }
+    handler.handle(record)
+    state['n'] = 2
+
+    queued = handler.queue.get_nowait()
+    assert queued.getMessage() == "state is {'n': 1}"
+    assert queued.args is None and queued.exc_info is None
+    assert 'RuntimeError: boom' in queued.exc_text
+    d = json.loads(bot.JsonLogFormatter().format(queued))
+    assert d['msg'] == "state is {'n': 1}" and d['x'] == 1 and 'RuntimeError: boom' in d['traceback']
+    assert logging.Formatter('%(message)s').format(queued).endswith('RuntimeError: boom')
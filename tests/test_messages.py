@@ -0,0 +1,72 @@
+import random
+import re
+
+RE_ENTITY = r'```.*?```|`[^`\n]*`|\*[^*\n]*\*|_[^_\n]*_'
+
+
+def squash(text):
+    return re.sub(r'\s+', '', text)
+
+
+def test_split_markdown_breaks_at_lines(bot):
+    text = '\n'.join('line {}'.format(i) for i in range(100))
+    pieces = bot.split_markdown(text, 50)
+    assert all(len(p) <= 50 for p in pieces)
+    assert '\n'.join(pieces) == text
+
+
+def test_split_markdown_keeps_entities_whole(bot):
+    text = ' '.join('*SN {}* is _online_'.format(i) for i in range(200))
+    pieces = bot.split_markdown(text, 64)
+    assert all(len(p) <= 64 for p in pieces)
+    for p in pieces:
+        assert p.count('*') % 2 == 0 and p.count('_') % 2 == 0
+    assert squash(''.join(pieces)) == squash(text)
+
+
+def test_split_markdown_splits_long_entity(bot):
+    text = '`' + 'x' * 250 + '`'
+    pieces = bot.split_markdown(text, 100)
+    assert all(len(p) <= 100 and p.startswith('`') and p.endswith('`') for p in pieces)
+    assert ''.join(p.strip('`') for p in pieces) == 'x' * 250
+
+
+def test_split_markdown_random(bot):
+    rng = random.Random(1)
+    words = ['word', '*bold text*', '_italic_', '`code`', '[link](http://x)', '\\_', '\n']
+    for _ in range(200):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randrange(1, 200)))
+        limit = rng.randrange(20, 200)
+        pieces = bot.split_markdown(text, limit)
+        assert all(p.strip() and len(p) <= limit for p in pieces)
+        assert squash(''.join(pieces)) == squash(text)
+        for p in pieces:
+            # Every entity in a piece is one that was in the text (nothing was cut in half)
+            for m in re.finditer(RE_ENTITY, p, re.S):
+                assert m.group() in text
+
+
+def test_pack_messages_packs_blocks(bot):
+    blocks = ['block {}'.format(i) for i in range(10)]
+    assert bot.pack_messages(blocks, sep='\n') == ['\n'.join(blocks)]
+
+
+def test_pack_messages_respects_limit(bot):
+    blocks = ['x' * 30 for _ in range(10)]
+    messages = bot.pack_messages(blocks, sep='\n', header='H\n', limit=100)
+    assert all(len(m) <= 100 and m.startswith('H\n') for m in messages)
+    # Three 30-character blocks (plus separators) fit after the header; blocks are never split
+    assert [m[2:].split('\n') for m in messages] == [['x' * 30] * 3] * 3 + [['x' * 30]]
+
+
+def test_pack_messages_splits_only_long_blocks(bot):
+    blocks = ['short', 'y ' * 100, 'end']
+    messages = bot.pack_messages(blocks, limit=80)
+    assert all(len(m) <= 80 for m in messages)
+    assert messages[0].startswith('short')
+    assert messages[-1].endswith('\n\nend')
+    assert squash(''.join(messages)) == squash(''.join(blocks))
+
+
+def test_pack_messages_empty(bot):
+    assert bot.pack_messages([]) == []
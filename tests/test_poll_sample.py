@@ -0,0 +1,55 @@
+import collections
+import random
+
+
+def sample_net(bot, hosts, size):
+    """A network whose supernodes are spread over hosts with the given numbers of supernodes each"""
+    net = bot.Network('test')
+    net.supernodes = [('sn{}-{}'.format(h, i), 'http://host{}:{}'.format(h, 18690 + i))
+            for h, n in enumerate(hosts) for i in range(n)]
+    net.poll_sample_size = size
+    return net
+
+
+def test_sample_size_and_rotation(bot):
+    net = sample_net(bot, [5, 3, 1], 3)
+    polled = collections.Counter()
+    for _ in range(30):
+        sample = bot.poll_sample(net)
+        assert len(sample) == 3 and len(set(sample)) == 3
+        polled.update(sample)
+    # Every supernode gets polled equally often over time
+    assert set(polled.values()) == {10}
+
+
+def test_sample_size_random(bot):
+    rng = random.Random(1)
+    for _ in range(300):
+        hosts = [rng.choice((1, 1, 2, 3, 5, 8, 20)) for _ in range(rng.randrange(1, 8))]
+        total = sum(hosts)
+        net = sample_net(bot, hosts, rng.randrange(1, total + 5))
+        for _ in range(rng.randrange(1, 10)):
+            if rng.random() < 0.2:
+                # Supernodes come and go (e.g. SUPERNODES_FILE changes); credit carries over
+                net.supernodes = rng.sample(net.supernodes, rng.randrange(1, len(net.supernodes) + 1))
+                total = len(net.supernodes)
+            sample = bot.poll_sample(net)
+            assert len(sample) == min(net.poll_sample_size, total)
+            assert len(set(sample)) == len(sample)
+            assert set(sample) <= set(net.supernodes)
+
+
+def test_merge_observations(bot, monkeypatch):
+    monkeypatch.setattr(bot, 'OBSERVATION_MAX_AGE', 900)
+    net = sample_net(bot, [3], 1)
+    a, b = { 'p': { 'LastUpdateAge': 10 } }, { 'p': { 'LastUpdateAge': 20 } }
+    bot.merge_observations(net, { 'sn0-0': a, 'sn0-1': None, 'sn0-2': None }, 1000)
+    merged, weights, ages = bot.merge_observations(net, { 'sn0-0': None, 'sn0-1': b, 'sn0-2': None }, 1300)
+    # The older observation is passed on untouched, with its age given separately
+    assert merged == { 'sn0-0': a, 'sn0-1': b, 'sn0-2': None }
+    assert merged['sn0-0'] is a and a['p']['LastUpdateAge'] == 10
+    assert ages == { 'sn0-0': 300 }
+    assert weights == { 'sn0-0': 1 - 300 / 900, 'sn0-1': 1 }
+    # ... until it is too old to count at all
+    merged, weights, ages = bot.merge_observations(net, { 'sn0-0': None, 'sn0-1': None, 'sn0-2': None }, 1900)
+    assert merged['sn0-0'] is None and ages == { 'sn0-1': 600 }
@@ -0,0 +1,53 @@
+def add(bot, net, p, **g):
+    net.globalsns[p] = g
+    bot.update_ranks(net, p, g)
+    return g
+
+
+def test_update_ranks(bot, net):
+    add(bot, net, 'a', stake=50000, tier=1, online_since=100)
+    b = add(bot, net, 'b', stake=90000, tier=2, online_since=50)
+    add(bot, net, 'c', stake=60000, tier=1, offline_since=70)
+    assert [p for _, p in net.ranks[('stake', None)]] == ['b', 'c', 'a']
+    assert [p for _, p in net.ranks[('stake', 1)]] == ['c', 'a']
+    assert [p for _, p in net.ranks[('online', None)]] == ['b', 'a']
+    assert [p for _, p in net.ranks[('offline', None)]] == ['c']
+
+    # A stake change moves the SN, within its tier and between tiers
+    b['stake'], b['tier'] = 55000, 1
+    bot.update_ranks(net, 'b', b)
+    assert [p for _, p in net.ranks[('stake', None)]] == ['c', 'b', 'a']
+    assert [p for _, p in net.ranks[('stake', 1)]] == ['c', 'b', 'a']
+    assert net.ranks[('stake', 2)] == []
+
+    bot.update_ranks(net, 'c', None)
+    assert [p for _, p in net.ranks[('stake', None)]] == ['b', 'a']
+    assert net.ranks[('offline', None)] == []
+    assert 'c' not in net.rank_state
+
+
+def buttons(markup):
+    return [(b.text, b.callback_data) for b in markup.inline_keyboard[0]] if markup else []
+
+
+def test_rank_page(bot, net):
+    size = bot.RANK_PAGE_SIZE
+    for i in range(2 * size + 5):
+        add(bot, net, 'sn{:02d}'.format(i), stake=(50000 + i) * bot.GRFT, tier=1)
+
+    text, markup = bot.rank_page(net, 'stake', None, 0)
+    assert '_(1–{} of {})_'.format(size, 2 * size + 5) in text
+    # Biggest stake first
+    assert text.split('\n')[1].startswith('1. *sn{}...'.format(2 * size + 4))
+    assert buttons(markup) == [('Next ▶', 'rank:test:stake:-:{}'.format(size))]
+
+    _, markup = bot.rank_page(net, 'stake', 1, size)
+    assert buttons(markup) == [('◀ Previous', 'rank:test:stake:1:0'), ('Next ▶', 'rank:test:stake:1:{}'.format(2 * size))]
+
+    # An offset past the end shows the last page
+    text, markup = bot.rank_page(net, 'stake', None, 1000)
+    assert '_({}–{} of {})_'.format(2 * size + 1, 2 * size + 5, 2 * size + 5) in text
+    assert buttons(markup) == [('◀ Previous', 'rank:test:stake:-:{}'.format(size))]
+
+    text, markup = bot.rank_page(net, 'stake', 2, 0)
+    assert text.endswith('_(none right now)_') and markup is None
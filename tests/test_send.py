@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+def test_unauthorized_send_leaves_ledger_alone(bot, monkeypatch):
+    def touched():
+        pytest.fail("the stake ledger was loaded or synced for an unauthorized /send")
+    replies = []
+    monkeypatch.setattr(bot, 'BOSS_USERS', { 1: '@boss' })
+    monkeypatch.setattr(bot, 'stakes', None)
+    monkeypatch.setattr(bot, 'load_stakes', touched)
+    monkeypatch.setattr(bot, 'sync_stakes', touched)
+    monkeypatch.setattr(bot, 'send_reply', lambda bot, update, msg, **kwargs: replies.append(msg))
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=2),
+            message=SimpleNamespace(message_id=10, chat_id=2, reply_to_message=None))
+    bot.send_stake.__wrapped__(None, update, user_data={}, args=['T1', 'F' + 'x' * 94])
+    assert len(replies) == 1 and "aren't authorized" in replies[0]
@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+
+def test_sn_waits_for_the_named_network(bot, monkeypatch):
+    loaded, loading = bot.Network('Main'), bot.Network('Other')
+    loaded.globalsns, loaded.lastresults = {}, { 'a': {} }
+    monkeypatch.setattr(bot, 'networks', { 'main': loaded, 'other': loading })
+    monkeypatch.setattr(bot, 'SEE_SEND_TO', None)
+    replies = []
+    monkeypatch.setattr(bot, 'send_reply', lambda bot, update, msg, **kwargs: replies.append(msg))
+    monkeypatch.setattr(bot, 'send_replies', lambda bot, update, msgs, **kwargs: replies.extend(msgs))
+    update = SimpleNamespace(message=SimpleNamespace(chat_id=1, chat=SimpleNamespace(type='private')))
+
+    bot.show_sn(None, update, user_data={}, args=['other', 'x' * 64])
+    assert replies == ["I'm still starting up; try again later"]
+    del replies[:]
+    bot.show_sn(None, update, user_data={}, args=['main', 'x' * 64])
+    assert replies and 'starting up' not in replies[0]
@@ -0,0 +1,20 @@
+import collections
+
+import pytest
+
+
+def window(bot, block_time, n=None):
+    n = n or bot.STIMULUS_WINDOW
+    return collections.deque(((h, 1000000 + h * block_time, 300 * bot.GRFT, b'') for h in range(n)), maxlen=n)
+
+
+def test_stimulus_follows_block_time(bot):
+    s = bot.stimulus_estimate(window(bot, 120))
+    assert s['block_time'] == pytest.approx(120)
+    assert s['per_day'] == pytest.approx(bot.STIMULUS_PER_BLOCK * 720)
+    # Slower blocks mean less stimulus per day
+    assert bot.stimulus_estimate(window(bot, 124))['per_day'] < s['per_day']
+
+
+def test_stimulus_needs_full_window(bot):
+    assert bot.stimulus_estimate(window(bot, 120, bot.STIMULUS_WINDOW - 1)) is None